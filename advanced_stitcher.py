@@ -3,27 +3,34 @@
 import cv2
 import numpy as np
 import os
-import re
 import gc
 import math
 import tempfile
 from tqdm import tqdm
-from scipy.sparse import lil_matrix, vstack
-from scipy.sparse.linalg import lsqr
-import psutil
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import json
 
-try:
-    import matplotlib.pyplot as plt
-    HAS_MATPLOTLIB = True
-except Exception:
-    HAS_MATPLOTLIB = False
+import tile_formats
+import tile_container
+import grid_index as grid_index_mod
+import stitch_checkpoint
+import stitch_layout
+from stitch_checkpoint import StitchCancelled
+from run_metrics import RunMetrics
+from chunked_canvas import ChunkedCanvas, feather_weights
+import quality_map
+
+# ORB の特徴点の周囲に必要な余白 (ORB の patchSize / edgeThreshold の既定値 31px)
+ORB_PATCH_MARGIN = 32
 
 # --- 【変更点】ここから日本語パス対応のためのヘルパー関数を追加 ---
 def imread_safe(filename, flags=cv2.IMREAD_UNCHANGED):
     """日本語(マルチバイト文字)を含むパスの画像を正しく読み込むためのラッパー関数"""
     try:
+        if tile_container.is_container_ref(filename):
+            return tile_container.read_ref(filename, flags)
+        if os.path.splitext(filename)[1].lower() == '.npy':
+            return tile_formats.load_npy(filename, flags)
         n = np.fromfile(filename, dtype=np.uint8)
         img = cv2.imdecode(n, flags)
         return img
@@ -31,6 +38,24 @@ def imread_safe(filename, flags=cv2.IMREAD_UNCHANGED):
         print(f"ERROR: imread_safe でファイルの読み込みに失敗しました: {filename}, error: {e}")
         return None
 
+def imread_rows_safe(filename, n, flags=cv2.IMREAD_UNCHANGED):
+    """画像の先頭 n 行だけを読み込む (形式が対応していれば n 行目でデコードを打ち切る)"""
+    try:
+        if tile_container.is_container_ref(filename):
+            return tile_container.read_ref_rows(filename, n, flags)
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == '.npy':
+            return tile_formats.load_npy_rows(filename, n, flags)
+        if ext == '.png':
+            with open(filename, 'rb') as f:
+                img = tile_formats.decode_png_rows(f, n, flags)
+            if img is not None:
+                return img
+    except Exception as e:
+        print(f"ERROR: imread_rows_safe でファイルの読み込みに失敗しました: {filename}, error: {e}")
+    img = imread_safe(filename, flags)
+    return None if img is None else img[:n]
+
 def imwrite_safe(filename, img, params=None):
     """日本語(マルチバイト文字)を含むパスへ画像を正しく書き込むためのラッパー関数"""
     try:
@@ -48,12 +73,41 @@ def imwrite_safe(filename, img, params=None):
 # --- 【変更点】ここまでヘルパー関数の追加 ---
 
 
+def _knn_arrays(knn_matches):
+    """knnMatch (k=2) の結果を (query 番号, train 番号, 最良の距離, 2番目の距離) の配列にする"""
+    q = np.array([m[0].queryIdx for m in knn_matches if m], dtype=np.int64)
+    t = np.array([m[0].trainIdx for m in knn_matches if m], dtype=np.int64)
+    best = np.array([m[0].distance for m in knn_matches if m], dtype=np.float64)
+    second = np.array([m[1].distance if len(m) > 1 else np.inf for m in knn_matches if m], dtype=np.float64)
+    return q, t, best, second
+
+
+def _one_to_one(q, t, dist):
+    """同じ target の特徴点に複数の base の特徴点が対応していれば、距離が最も小さいものだけを残す"""
+    order = np.lexsort((dist, t))
+    t_sorted = t[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = t_sorted[1:] != t_sorted[:-1]
+    keep = np.sort(order[first])
+    return q[keep], t[keep]
+
+
 class AdvancedStitcher:
-    def __init__(self, input_dir, output_file, status_queue=None, config=None):
+    def __init__(self, input_dir, output_file, status_queue=None, config=None, resources=None, cancel_event=None, grid_index=None):
+        # resources: 常駐ワーカー (stitch_service) がジョブ間で使い回す検出器やキャッシュ
+        #   {"detector", "matcher", "gray_cache", "rgb_cache"} のうち指定されたものを使う
+        # cancel_event: セットされるとチェックポイントを書いてから StitchCancelled で中断する
+        # grid_index: GUI 側で作ったタイル一覧 (grid_index.GridIndex)。省略時はここで走査する
+        resources = resources or {}
         self.input_dir = input_dir
         self.output_file = output_file
         self.status_queue = status_queue
         self.config = config if config else {}
+        self.cancel_event = cancel_event
+        # 計測 (フェーズごとの時間とカウンター)。run() の最後に <output>_report.json へ書き出す
+        self.metrics = RunMetrics()
+        self._outcome = None
+        self.calibration = None  # auto_calibrate で決めた値 (calibrate())
 
         # thresholds and params
         self.min_score_threshold = self.config.get("min_score_threshold", 0.75)
@@ -62,71 +116,122 @@ class AdvancedStitcher:
         self.cache_max_items = self.config.get("cache_max_items", 128)
         self.sentinel_color = tuple(self.config.get("sentinel_color", (1, 0, 255)))  # BGR sentinel for memmap
         
-        #self.blend = self.config.get("blend", True)  # enable simple feather blending
-        self.blend = False
+        # 境界のフェザーブレンド (タイルの端から blend_width px で重みを 0 -> 1 にして重なりを混ぜる)
+        self.blend = bool(self.config.get("blend", False))
+        self._feather_cache = {}
 
         self.blend_width = self.config.get("blend_width", 64)  # px
 
-        self.image_files = self._get_image_files()
-        if not self.image_files:
-            raise ValueError("指定されたフォルダに Rxx_Cxx.png 形式のファイルが見つかりません。")
+        # checkpoint / resume
+        self.resume = self.config.get("resume", False)
+        self.checkpoint_every = max(1, int(self.config.get("checkpoint_every", 50)))  # ペア数
+        self.checkpoints = None  # run() で作業フォルダを開く
+        self._resumed = False
+
+        # タイル一覧 (単一ファイルのタイルコンテナ tiles.dat + tiles.idx があればそちらを優先)
+        self.grid_index = grid_index or grid_index_mod.build_grid_index(self.input_dir)
+        if not self.grid_index.file_map:
+            raise ValueError("指定されたフォルダに Rxx_Cxx 形式の画像ファイル (.png/.npy/.webp/.qoi) が見つかりません。")
 
-        self.grid_info = self._get_grid_info()
-        if self.grid_info is None:
+        if self.grid_index.grid_info is None:
             raise ValueError("画像ファイル名からグリッド情報を構築できませんでした。")
 
+        # 部分結合では、範囲とその外側 range_halo 行/列 (境界の位置を安定させるため) のタイルだけを
+        # 検証・マッチング・最適化の対象にする。描画するのは範囲内のタイルのみ
+        self.range_halo = max(0, int(self.config.get("range_halo", 1)))
+        rows, cols = self.grid_index.active_area(self.stitch_range, self.range_halo)
+        if not rows or not cols:
+            raise ValueError("指定された範囲に画像ファイルがありません。")
+        self.grid_info = {"min_r": rows[0], "max_r": rows[-1], "min_c": cols[0], "max_c": cols[-1],
+                          "rows": rows, "cols": cols}
+
+        # file map: (r, c) -> path
+        if self.stitch_range:
+            rs, cs = set(rows), set(cols)
+            self._file_map = {k: p for k, p in self.grid_index.file_map.items() if k[0] in rs and k[1] in cs}
+        else:
+            self._file_map = self.grid_index.file_map
+
         self.positions = {}
-        self.base_image_shape = self._get_base_image_shape()
+        self.base_image_shape = self.grid_index.tile_shape
+        self._apply_memory_budget()
         self.pairwise_matches = {}
+        # マッチングに失敗した(または閾値未満の)ペア: (base_key, target_key) -> (direction, score, reason)
+        self.failed_pairs = {}
 
         # ORB and matcher
-        self.detector = cv2.ORB_create(nfeatures=self.config.get("nfeatures", 2000))
-        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+        self.detector = resources.get("detector") or cv2.ORB_create(nfeatures=self.config.get("nfeatures", 2000))
+        self.matcher = resources.get("matcher") or cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+        # ORB の対応付けで、予測位置から何 px 以内の特徴点と比べるか (0 は総当たり)
+        self.guided_radius = self.config.get("orb_guide_radius", 48)
+        self._recent_offsets = {"h": deque(maxlen=50), "v": deque(maxlen=50)}
+        # 縦方向のテンプレートの幅 (タイル幅に対する割合) と、測れる左右のずれの最大値 (px)
+        self.v_template_width_pct = self.config.get("v_template_width_pct", 50) / 100.0
+        self.v_max_drift_px = max(0, int(self.config.get("v_max_drift_px", 64)))
+        # 全域木と標本のペアだけをマッチングし、予測と合わない場所だけ全てのペアをマッチングする
+        self.adaptive_pairs = bool(self.config.get("adaptive_pairs", False))
+        self.adaptive_sample_pct = float(self.config.get("adaptive_sample_pct", 20))
+        self.adaptive_tolerance_px = float(self.config.get("adaptive_tolerance_px", 4))
 
         # simple LRU cache for image reads (grayscale for matching, rgb for render cached separately)
-        self._gray_cache = OrderedDict()
-        self._rgb_cache = OrderedDict()
-
-        # file map (lowercase keys)
-        self._file_map = {os.path.basename(f).lower(): os.path.join(self.input_dir, f) for f in os.listdir(self.input_dir)}
+        self._gray_cache = resources.get("gray_cache")
+        if self._gray_cache is None:
+            self._gray_cache = OrderedDict()
+        self._rgb_cache = resources.get("rgb_cache")
+        if self._rgb_cache is None:
+            self._rgb_cache = OrderedDict()
+        # 複数のワーカーでデコード済みのタイルを共有するストア (shared_tile_store)。
+        # ストアから借りたグレー画像はキャッシュにある間だけ参照し、キャッシュから外すときに返す
+        self.tile_store = resources.get("tile_store")
+        self._store_keys = set()
 
     # ----------------------- utilities -----------------------
     def _update_status(self, message_type, value):
+        if message_type in ("done", "error", "cancelled"):
+            self._outcome = message_type
         if self.status_queue:
             self.status_queue.put((message_type, value))
 
-    def _get_image_files(self):
-        files = [f for f in os.listdir(self.input_dir) if re.match(r'R\d+_C\d+\.png', f, re.IGNORECASE)]
-        return sorted(files, key=lambda f: [int(i) for i in re.findall(r'\d+', f)])
+    def _check_cancel(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise StitchCancelled("処理を中断しました。「再開」を有効にして実行すると続きから処理します。")
+
+    def _open_checkpoints(self):
+        work_dir = self.config.get("work_dir") or stitch_checkpoint.default_work_dir(self.output_file)
+        fp = stitch_checkpoint.fingerprint(self.input_dir, self.config, self._file_map.keys())
+        self.checkpoints = stitch_checkpoint.CheckpointStore(work_dir, fp)
+        self._resumed = bool(self.resume) and self.checkpoints.is_valid()
+        if self._resumed:
+            self._update_status("status", "前回のチェックポイントから再開します...")
+        else:
+            if self.resume:
+                self._update_status("status", "再開できるチェックポイントが無いため、最初から実行します。")
+            self.checkpoints.reset()
+
+    def _checkpoint_matches(self, done):
+        if self.checkpoints:
+            self.checkpoints.save_matches(done, self.pairwise_matches, self.failed_pairs)
 
     def _get_image_path(self, r, c):
-        target_filename = f"R{r:02d}_C{c:02d}.png".lower()
-        return self._file_map.get(target_filename)
-
-    def _get_grid_info(self):
-        rows, cols = set(), set()
-        for f in self.image_files:
-            match = re.search(r'R(\d+)_C(\d+)', f, re.IGNORECASE)
-            if match:
-                rows.add(int(match.group(1)))
-                cols.add(int(match.group(2)))
-        if not rows or not cols:
-            return None
-        return {"min_r": min(rows), "max_r": max(rows), "min_c": min(cols), "max_c": max(cols), "rows": sorted(list(rows)), "cols": sorted(list(cols))}
+        return self._file_map.get((r, c))
 
-    def _get_base_image_shape(self):
-        first_image_path = os.path.join(self.input_dir, self.image_files[0])
-        # 【変更点】cv2.imread を imread_safe に置き換え
-        img = imread_safe(first_image_path)
-        if img is None:
-            raise ValueError(f"基準画像の読み込みに失敗しました: {first_image_path}")
-        return img.shape
+    def _apply_memory_budget(self):
+        # メモリ上限が指定されていれば、キャッシュ(グレー+カラー)がその1/4に収まるよう枚数を制限する
+        budget_mb = self.config.get("memory_budget_mb")
+        if not budget_mb:
+            return
+        h, w = self.base_image_shape[:2]
+        per_item = h * w * 4  # gray(1ch) + rgb(3ch)
+        self.cache_max_items = max(4, min(self.cache_max_items, int(budget_mb * 1024 * 1024 * 0.25 // per_item)))
 
     # ----------------------- caching reads -----------------------
     def _cache_trim(self):
         # enforce cache sizes
         while len(self._gray_cache) > self.cache_max_items:
-            self._gray_cache.popitem(last=False)
+            key, _ = self._gray_cache.popitem(last=False)
+            if key in self._store_keys:
+                self._store_keys.discard(key)
+                self.tile_store.release(key)
         while len(self._rgb_cache) > self.cache_max_items:
             self._rgb_cache.popitem(last=False)
 
@@ -134,7 +239,20 @@ class AdvancedStitcher:
         key = (path, downscale)
         if key in self._gray_cache:
             self._gray_cache.move_to_end(key)
+            self.metrics.count("gray_cache_hits")
             return self._gray_cache[key]
+        self.metrics.count("gray_cache_misses")
+        if self.tile_store is not None and downscale == 1:
+            img, shared, decoded = self.tile_store.get(key, lambda: imread_safe(path, cv2.IMREAD_GRAYSCALE))
+            self.metrics.count("decodes" if decoded else "tile_store_hits")
+            if img is None:
+                return None
+            if shared:
+                self._store_keys.add(key)
+            self._gray_cache[key] = img
+            self._cache_trim()
+            return img
+        self.metrics.count("decodes")
         # 【変更点】cv2.imread を imread_safe に置き換え
         img = imread_safe(path, cv2.IMREAD_GRAYSCALE)
         if img is None:
@@ -145,10 +263,38 @@ class AdvancedStitcher:
         self._cache_trim()
         return img
 
+    def read_gray_rows(self, path, n):
+        """グレースケールの先頭 n 行 (縦方向のペアの下側のタイルの重なり部分)"""
+        if self.tile_store is not None:
+            # 共有ストアがあれば全体をデコードして入れておく (他のワーカーが同じタイルを使えるように)
+            full = self.read_gray(path)
+            return None if full is None else full[:n]
+        full = self._gray_cache.get((path, 1))
+        if full is not None:
+            self._gray_cache.move_to_end((path, 1))
+            self.metrics.count("gray_cache_hits")
+            return full[:n]
+        key = (path, "rows", n)
+        if key in self._gray_cache:
+            self._gray_cache.move_to_end(key)
+            self.metrics.count("gray_cache_hits")
+            return self._gray_cache[key]
+        self.metrics.count("gray_cache_misses")
+        self.metrics.count("strip_decodes")
+        img = imread_rows_safe(path, n, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            return None
+        self._gray_cache[key] = img
+        self._cache_trim()
+        return img
+
     def read_rgb(self, path):
         if path in self._rgb_cache:
             self._rgb_cache.move_to_end(path)
+            self.metrics.count("rgb_cache_hits")
             return self._rgb_cache[path]
+        self.metrics.count("rgb_cache_misses")
+        self.metrics.count("decodes")
         # 【変更点】cv2.imread を imread_safe に置き換え
         img = imread_safe(path, cv2.IMREAD_COLOR)
         if img is None:
@@ -157,20 +303,17 @@ class AdvancedStitcher:
         self._cache_trim()
         return img
 
+    def release_tile_store(self):
+        """共有ストアから借りているタイルを全て返す (キャッシュからも外す)"""
+        for key in list(self._store_keys):
+            self._gray_cache.pop(key, None)
+            self.tile_store.release(key)
+        self._store_keys.clear()
+
     # ----------------------- verification -----------------------
     def verify_grid(self):
         self._update_status("status", "画像グリッドの完全性を検証中...")
-        missing_files = []
-        rows, cols = self.grid_info["rows"], self.grid_info["cols"]
-        for r in rows:
-            for c in cols:
-                if self._get_image_path(r, c) is None:
-                    missing_files.append(f"R{r:02d}_C{c:02d}.png")
-        if missing_files:
-            error_msg = (f"画像ファイルが{len(missing_files)}件見つかりません。\n"
-                         "撮影が不完全であるか、入力フォルダが正しくありません。\n\n"
-                         "見つからないファイル (最初の5件):\n" + "\n".join(missing_files[:5]))
-            raise ValueError(error_msg)
+        self.grid_index.verify(self.grid_info["rows"], self.grid_info["cols"])
         self._update_status("status", "グリッドは完全です。")
         return True
 
@@ -195,17 +338,17 @@ class AdvancedStitcher:
             template = base_img[:, int(w*(1-edge_pct)):]
             search_area = target_img[:, :int(w*search_pct)]
         else: # direction == 'v' の場合
-            # テンプレートは上の画像の下端
-            template = base_img[int(h*(1-edge_pct)):, :]
-            
-            # ★★★ ここが重要な修正 ★★★
-            # 検索範囲を、下の画像の「上部」かつ「横幅すべて」に広げる
-            # これにより、左右50pxのズレを完全に許容できる
-            search_area = target_img[:int(h*search_pct), :] # X座標の指定を削除し、横幅全体を対象にする
-            # ★★★ 修正ここまで ★★★
+            # テンプレートは上の画像の下端の中央部分 (横幅いっぱいだと結果が1列になり、左右のずれを測れない)
+            # 検索範囲は下の画像の上部で、テンプレートの左右に v_max_drift_px ずつ広げた範囲
+            tw = min(w, max(1, int(w * self.v_template_width_pct)))
+            tx0 = (w - tw) // 2
+            sx0 = max(0, tx0 - self.v_max_drift_px)
+            template = base_img[int(h*(1-edge_pct)):, tx0:tx0 + tw]
+            search_area = target_img[:int(h*search_pct), sx0:min(w, tx0 + tw + self.v_max_drift_px)]
 
         if template.size == 0 or search_area.size == 0:
             return None, 0
+        self.metrics.count("template_pixels", search_area.size)
 
         res = cv2.matchTemplate(search_area, template, cv2.TM_CCOEFF_NORMED)
         min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
@@ -217,43 +360,118 @@ class AdvancedStitcher:
                 # オフセット計算は、テンプレートの開始位置と、見つかった位置の差
                 offset = (int(w*(1-edge_pct)) - max_loc[0], -max_loc[1])
             else:
-                # 縦方向の場合も同様に計算
-                offset = (-max_loc[0], int(h*(1-edge_pct)) - max_loc[1])
+                # 縦方向の場合も同様に計算 (テンプレートと検索範囲の左端の違いを足す)
+                offset = (tx0 - sx0 - max_loc[0], int(h*(1-edge_pct)) - max_loc[1])
             return offset, max_val
         return None, max_val
     
     
 
-    def _match_features(self, base_img, target_img):
+    def _overlap_regions(self, shape, direction):
+        """重なり部分として調べる範囲 (y0, y1, x0, x1) を (base, target) の順に返す
+
+        テンプレートマッチングの検索範囲と同じ割合に、ORB のパッチ (31px) が収まる余白を加える。
+        """
+        h, w = shape[:2]
+        if direction.startswith('h'):
+            ratio = self.config.get("overlap_h_pct", 60) / 100.0
+            n = min(w, int(w * min(ratio * 1.2, 0.9)) + ORB_PATCH_MARGIN)
+            return (0, h, w - n, w), (0, h, 0, n)
+        ratio = self.config.get("overlap_v_pct", 40) / 100.0
+        n = min(h, int(h * min(ratio * 1.2, 0.9)) + ORB_PATCH_MARGIN)
+        return (h - n, h, 0, w), (0, n, 0, w)
+
+    def _predicted_diff(self, direction, shape):
+        """base の特徴点が target で見つかるはずの位置へのずれ (target 座標 - base 座標) の予測
+
+        同じ方向で直近に採用したオフセットの中央値を使い、まだ少なければ重なり率の設定から求める。
+        """
+        key = 'h' if direction.startswith('h') else 'v'
+        recent = self._recent_offsets[key]
+        if len(recent) >= 5:
+            dx, dy = np.median(np.array(recent), axis=0)
+            return np.float32([-dx, -dy])
+        h, w = shape[:2]
+        if key == 'h':
+            return np.float32([-w * (1 - self.config.get("overlap_h_pct", 60) / 100.0), 0])
+        return np.float32([0, -h * (1 - self.config.get("overlap_v_pct", 40) / 100.0)])
+
+    def _guided_knn(self, pts1, des1, pts2, des2, predicted, radius):
+        """base の各特徴点について、予測位置から radius 以内のセルにある target の特徴点とだけ knn (k=2) を行う
+
+        戻り値: (base の番号, target の番号, 最良の距離, 2番目の距離) の配列。2番目が無ければ距離は inf
+        """
+        cells1 = np.floor((pts1 + predicted) / radius).astype(np.int64)
+        cells2 = np.floor(pts2 / radius).astype(np.int64)
+        # target の特徴点をセルごとにまとめる
+        uniq2, inv2 = np.unique(cells2, axis=0, return_inverse=True)
+        inv2 = inv2.ravel()
+        order2 = np.argsort(inv2, kind="stable")
+        bounds2 = np.searchsorted(inv2[order2], np.arange(len(uniq2) + 1))
+        cell_index = {tuple(c): n for n, c in enumerate(uniq2.tolist())}
+
+        uniq1, inv1 = np.unique(cells1, axis=0, return_inverse=True)
+        inv1 = inv1.ravel()
+        q_all, t_all, best_all, second_all = [], [], [], []
+        for n, (cx, cy) in enumerate(uniq1.tolist()):
+            cand = [order2[bounds2[m]:bounds2[m + 1]] for m in
+                    (cell_index.get((cx + dx, cy + dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1)) if m is not None]
+            if not cand:
+                continue
+            cand = np.concatenate(cand)
+            idx1 = np.flatnonzero(inv1 == n)
+            q, t, best, second = _knn_arrays(self.matcher.knnMatch(des1[idx1], des2[cand], k=2))
+            q_all.append(idx1[q]); t_all.append(cand[t]); best_all.append(best); second_all.append(second)
+        if not q_all:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0), np.zeros(0)
+        return np.concatenate(q_all), np.concatenate(t_all), np.concatenate(best_all), np.concatenate(second_all)
+
+    def _match_features(self, base_img, target_img, direction=None):
+            # direction を指定すると、特徴点は重なり部分だけで探す (ORB の計算量とマッチングの組み合わせが減る)
+            base_origin = target_origin = (0, 0)
+            shape = base_img.shape
+            if direction:
+                (by0, by1, bx0, bx1), (ty0, ty1, tx0, tx1) = self._overlap_regions(base_img.shape, direction)
+                base_img, base_origin = base_img[by0:by1, bx0:bx1], (bx0, by0)
+                target_img, target_origin = target_img[ty0:ty1, tx0:tx1], (tx0, ty0)
+
             # 特徴点検出 (ここは変更なし)
             kp1, des1 = self.detector.detectAndCompute(base_img, None)
             kp2, des2 = self.detector.detectAndCompute(target_img, None)
             if des1 is None or des2 is None or len(des1) < 8 or len(des2) < 8:
                 return None, 0, 0
 
-            # マッチング (ここは変更なし)
-            knn_matches = self.matcher.knnMatch(des1, des2, k=2)
-            good_matches = []
-            for pair in knn_matches:
-                if len(pair) < 2:
-                    continue
-                m, n = pair
-                # 誤検出を減らすため、判定を少し厳しくする (0.75 -> 0.7)
-                if m.distance < 0.7 * n.distance:
-                    good_matches.append(m)
+            # 特徴点の座標 (切り出した範囲の原点を足して画像全体の座標に戻す)
+            pts1 = np.float32([k.pt for k in kp1]) + np.float32(base_origin)
+            pts2 = np.float32([k.pt for k in kp2]) + np.float32(target_origin)
 
-            match_count = len(good_matches)
+            # マッチング: 相手の特徴点が来るはずの位置の近くだけを比べる。候補が少なすぎれば全体で総当たりする
+            good = None
+            if direction and self.guided_radius > 0:
+                predicted = self._predicted_diff(direction, shape)
+                q, t, best, second = self._guided_knn(pts1, des1, pts2, des2, predicted, self.guided_radius)
+                near = np.sum((pts2[t] - pts1[q] - predicted) ** 2, axis=1) <= self.guided_radius ** 2
+                # 誤検出を減らすため、判定を少し厳しくする (0.75 -> 0.7)
+                keep = (best < 0.7 * second) & near
+                if np.count_nonzero(keep) >= 8:
+                    good = (q[keep], t[keep], best[keep])
+                    self.metrics.count("orb_guided")
+            if good is None:
+                q, t, best, second = _knn_arrays(self.matcher.knnMatch(des1, des2, k=2))
+                keep = best < 0.7 * second
+                good = (q[keep], t[keep], best[keep])
+                self.metrics.count("orb_bruteforce")
+            q, t = _one_to_one(*good)
+
+            match_count = len(q)
             if match_count < 8:
                 return None, 0, match_count
 
-            # 座標の抽出 (ここは変更なし)
-            src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches])
-            dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches])
-
             # ---【変更箇所】ここから平行移動限定ロジック---
             
             # 各マッチング点ごとの移動量 (dx, dy) を計算
-            diff = dst_pts - src_pts
+            diff = pts2[t] - pts1[q]
             
             # 中央値 (Median) を採用して、外れ値（誤マッチ）の影響を排除する
             # これにより、回転や拡大縮小を無視した「純粋なズレ」だけを取得できる
@@ -263,7 +481,7 @@ class AdvancedStitcher:
             # スコア計算（中央値に近い移動量を持つ点の割合）
             # 許容誤差 2.0ピクセル以内
             inliers = np.sum((np.abs(diff[:, 0] - dx) < 2.0) & (np.abs(diff[:, 1] - dy) < 2.0))
-            score = inliers / len(good_matches)
+            score = inliers / match_count
 
             # スコアが低すぎる場合はマッチング失敗とみなす
             # (以前のRANSACより厳密になるため、少し低めでもOKだが、信頼性重視で0.2程度)
@@ -275,37 +493,70 @@ class AdvancedStitcher:
             return (-int(round(dx)), -int(round(dy))), float(score), match_count
 
     # ----------------------- pairwise calculation -----------------------
-    def calculate_all_pairwise_matches(self):
-        self._update_status("status", "隣接ペアのリストを作成中...")
+    def build_pair_jobs(self):
+        """マッチングする隣接ペア [(base_key, target_key, direction)] を作る"""
         rows, cols = self.grid_info["rows"], self.grid_info["cols"]
+        # 撮影の往復 (蛇行) の向きは、部分結合でもグリッド全体での行番号で決める
+        row_order = {r: i for i, r in enumerate(self.grid_index.grid_info["rows"])}
         jobs = []
         for r_idx, r in enumerate(rows):
-            is_forward = (r_idx % 2 == 0)
+            is_forward = (row_order[r] % 2 == 0)
             for c_idx, c in enumerate(cols):
                 if c_idx + 1 < len(cols):
                     direction = "h_forward" if is_forward else "h_backward"
                     jobs.append(((r, c), (r, cols[c_idx+1]), direction))
                 if r_idx + 1 < len(rows):
                     jobs.append(((r, c), (rows[r_idx+1], c), "v"))
+        return jobs
 
-        if self.stitch_range:
-            sr = self.stitch_range
-            filtered = []
-            for a, b, d in jobs:
-                if sr["r_min"] <= a[0] <= sr["r_max"] and sr["c_min"] <= a[1] <= sr["c_max"]:
-                    filtered.append((a, b, d))
-            jobs = filtered
-
+    def calculate_all_pairwise_matches(self, jobs=None):
+        # jobs: マッチングするペアの一覧。省略時はグリッド全体 (block_stitcher はブロック内のペアだけを渡す)
+        if jobs is None:
+            self._update_status("status", "隣接ペアのリストを作成中...")
+            jobs = self.build_pair_jobs()
         if not jobs:
             raise ValueError("マッチング対象の画像ペアが見つかりません。")
 
+        start = 0
+        if self.checkpoints and self._resumed:
+            saved = self.checkpoints.load_matches()
+            if saved:
+                start, self.pairwise_matches, self.failed_pairs = saved
+                start = min(start, len(jobs))
+                self._update_status("status", f"マッチング済みの {start} ペアを読み込みました。")
+
+        if self.adaptive_pairs:
+            self._match_adaptive(jobs, start)
+            return
         self._update_status("status", f"ハイブリッドマッチングを逐次処理中 ({len(jobs)}ペア)...")
-        pbar = tqdm(jobs, desc="Hybrid Matching")
-        for i, job in enumerate(pbar):
+        self._match_jobs(jobs, start, 0, len(jobs))
+
+    def _match_jobs(self, jobs, start, done_before, total):
+        """jobs[start:] を順にマッチングする
+
+        done_before: jobs より前に処理したペアの数 (チェックポイントに記録する処理済みの数は done_before + i)
+        total: 進捗表示の分母
+        """
+        # 縦方向のペアの下側のタイルは、次の行の処理で全体を読む。全体を読んでもそれまでキャッシュに残らない
+        # (1行分のタイルがキャッシュに収まらない) 場合や、横方向のペアが無いタイルは、重なり部分の上端だけを読む
+        full_needed = {k for a, b, d in jobs if d.startswith('h') for k in (a, b)}
+        row_fits_cache = 2 * len(self.grid_info["cols"]) <= self.cache_max_items
+        strip_rows = self._overlap_regions(self.base_image_shape, "v")[1][1]
+
+        pbar = tqdm(jobs[start:], desc="Hybrid Matching", initial=done_before + start, total=total)
+        for i, job in enumerate(pbar, done_before + start):
+            # ここまでの i ペアは処理済み
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                self._checkpoint_matches(i)
+                self._check_cancel()
+            if i > done_before + start and i % self.checkpoint_every == 0:
+                self._checkpoint_matches(i)
             base_key, target_key, direction = job
             base_path = self._get_image_path(base_key[0], base_key[1])
             target_path = self._get_image_path(target_key[0], target_key[1])
             if not base_path or not target_path:
+                self.failed_pairs[(base_key, target_key)] = (direction, 0.0, "missing")
+                self.metrics.count("pairs_rejected_missing")
                 continue
 
             # status: which pair
@@ -313,15 +564,23 @@ class AdvancedStitcher:
             self._update_status("progress_pair", (base_key, target_key))
 
             base_img_gray = self.read_gray(base_path)
-            target_img_gray = self.read_gray(target_path)
+            if direction == "v" and not (row_fits_cache and target_key in full_needed):
+                target_img_gray = self.read_gray_rows(target_path, strip_rows)
+            else:
+                target_img_gray = self.read_gray(target_path)
             if base_img_gray is None or target_img_gray is None:
+                self.failed_pairs[(base_key, target_key)] = (direction, 0.0, "unreadable")
+                self.metrics.count("pairs_rejected_unreadable")
                 continue
 
             offset, score = self._match_template(base_img_gray, target_img_gray, direction)
             match_count = 0
             template_val = score
             if offset is None:
-                offset, score, match_count = self._match_features(base_img_gray, target_img_gray)
+                self.metrics.count("orb_matches")
+                offset, score, match_count = self._match_features(base_img_gray, target_img_gray, direction)
+            else:
+                self.metrics.count("template_matches")
 
             # weight correction using match_count
             if offset and score > 0:
@@ -331,9 +590,260 @@ class AdvancedStitcher:
 
             if offset and effective_score > self.min_score_threshold:
                 self.pairwise_matches[(base_key, target_key)] = (offset, float(score), direction, int(match_count), float(template_val))
+                self._recent_offsets['h' if direction.startswith('h') else 'v'].append(offset)
+                self.metrics.count("pairs_accepted")
+            else:
+                reason = "no_match" if not offset else "low_score"
+                self.failed_pairs[(base_key, target_key)] = (direction, float(effective_score or 0.0), reason)
+                self.metrics.count("pairs_rejected_" + reason)
 
-            progress_percent = int(((i + 1) / len(jobs)) * 50)
+            progress_percent = int(((i + 1) / total) * 50)
             self._update_status("progress", progress_percent)
+        if start < len(jobs):
+            self._checkpoint_matches(done_before + len(jobs))
+
+    # ----------------------- adaptive pair sampling -----------------------
+    def _spanning_jobs(self, jobs):
+        """jobs のうち、タイルを全てつなぐ木になるペアを選ぶ
+
+        各列の縦のペアを優先し、列同士は中央に近い行の横のペアでつなぐ (Kruskal 法)。
+        """
+        rows = sorted({k[0] for job in jobs for k in job[:2]})
+        mid = rows[len(rows) // 2]
+        order = sorted(range(len(jobs)), key=lambda n: (jobs[n][2].startswith('h'), abs(jobs[n][0][0] - mid), n))
+        parent = {}
+
+        def find(k):
+            parent.setdefault(k, k)
+            while parent[k] != k:
+                parent[k] = parent[parent[k]]
+                k = parent[k]
+            return k
+
+        chosen = set()
+        for n in order:
+            a, b = find(jobs[n][0]), find(jobs[n][1])
+            if a != b:
+                parent[a] = b
+                chosen.add(n)
+        return [job for n, job in enumerate(jobs) if n in chosen]
+
+    def _tree_positions(self):
+        """採用済みのペアを辿って、つながっているタイルの座標を求める
+
+        戻り値: ({key: (x, y)}, {key: 連結成分の番号})。座標は連結成分ごとに原点が異なる
+        """
+        neighbors = {}
+        for (a, b), match in self.pairwise_matches.items():
+            offset = match[0]
+            neighbors.setdefault(a, []).append((b, offset[0], offset[1]))
+            neighbors.setdefault(b, []).append((a, -offset[0], -offset[1]))
+        positions, component = {}, {}
+        for root in sorted(neighbors):
+            if root in positions:
+                continue
+            positions[root] = (0, 0)
+            component[root] = root
+            stack = [root]
+            while stack:
+                k = stack.pop()
+                for n, dx, dy in neighbors[k]:
+                    if n not in positions:
+                        positions[n] = (positions[k][0] + dx, positions[k][1] + dy)
+                        component[n] = root
+                        stack.append(n)
+        return positions, component
+
+    def _match_adaptive(self, jobs, start):
+        """全域木になるペアだけを先にマッチングし、残りのペアは一部だけを確かめる
+
+        1. 全域木のペアをマッチングし、木を辿った座標から残りのペアのオフセットを予測する
+        2. 残りのペアのうち、予測できないもの (木が途切れた部分をつなぐペア) と、一定の割合の標本をマッチングする
+        3. 標本が予測と adaptive_tolerance_px より大きくずれた (またはマッチングに失敗した) 場所の周りは、
+           残りのペアを全てマッチングする
+        予測と合っている場所のペアはマッチングしない。全体最適化は木と標本のペアだけで解ける。
+        各段階のペアは前の段階の結果だけから決まるので、チェックポイントからの再開では同じ順に処理し直せる。
+        """
+        rows = sorted({k[0] for job in jobs for k in job[:2]})
+        cols = sorted({k[1] for job in jobs for k in job[:2]})
+        row_idx = {r: i for i, r in enumerate(rows)}
+        col_idx = {c: i for i, c in enumerate(cols)}
+        step = max(1, int(round(100.0 / max(self.adaptive_sample_pct, 1))))
+
+        def run_stage(stage_jobs, done, message):
+            self._update_status("status", message)
+            self._match_jobs(stage_jobs, min(max(start - done, 0), len(stage_jobs)), done, len(jobs))
+            return done + len(stage_jobs)
+
+        tree = self._spanning_jobs(jobs)
+        done = run_stage(tree, 0, f"全域木のペアをマッチング中 ({len(tree)}/{len(jobs)}ペア)...")
+
+        positions, component = self._tree_positions()
+        in_tree = set(tree)
+        rest = [job for job in jobs if job not in in_tree]
+        predicted, bridges, samples = {}, [], []
+        for job in rest:
+            a, b = job[:2]
+            if a not in positions or b not in positions or component[a] != component[b]:
+                bridges.append(job)
+                continue
+            predicted[(a, b)] = (positions[b][0] - positions[a][0], positions[b][1] - positions[a][1])
+            if (row_idx[a[0]] + col_idx[a[1]]) % step == 0:
+                samples.append(job)
+        done = run_stage(bridges + samples, done,
+                         f"予測できないペア {len(bridges)} と標本 {len(samples)} ペアをマッチング中...")
+
+        # 予測と合わない標本の周り (両端のタイルから1行/1列以内) を、全てマッチングする範囲にする
+        suspect = set()
+        for job in samples:
+            a, b = job[:2]
+            match = self.pairwise_matches.get((a, b))
+            pred = predicted[(a, b)]
+            if match and max(abs(match[0][0] - pred[0]), abs(match[0][1] - pred[1])) <= self.adaptive_tolerance_px:
+                self.metrics.count("adaptive_samples_agreed")
+                continue
+            self.metrics.count("adaptive_samples_disagreed")
+            for key in (a, b):
+                for dr in (-1, 0, 1):
+                    for dc in (-1, 0, 1):
+                        suspect.add((row_idx[key[0]] + dr, col_idx[key[1]] + dc))
+        matched = in_tree | set(bridges) | set(samples)
+        escalated = [job for job in rest if job not in matched and
+                     any((row_idx[k[0]], col_idx[k[1]]) in suspect for k in job[:2])]
+        done = run_stage(escalated, done, f"予測と合わなかった場所の {len(escalated)} ペアをマッチング中...")
+
+        skipped = len(jobs) - done
+        self.metrics.count("adaptive_pairs_skipped", skipped)
+        self._update_status("status", f"予測と合っている {skipped}/{len(jobs)} ペアのマッチングを省略しました。")
+
+    # ----------------------- calibration -----------------------
+    def _match_wide(self, base_img, target_img, direction):
+        """重なり率を仮定せずに、base の端の細い帯を target 全体から探す (キャリブレーション用)
+
+        戻り値: (offset or None, score)
+        """
+        h, w = base_img.shape[:2]
+        if direction.startswith('h'):
+            tw, margin = max(16, int(w * 0.1)), int(h * 0.1)
+            tx, ty = w - tw, margin
+            template = base_img[margin:h - margin, tx:]
+        else:
+            th, margin = max(16, int(h * 0.1)), int(w * 0.1)
+            tx, ty = margin, h - th
+            template = base_img[ty:, margin:w - margin]
+        res = cv2.matchTemplate(target_img, template, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        if max_val < 0.6:
+            return None, max_val
+        return (tx - max_loc[0], ty - max_loc[1]), max_val
+
+    def calibrate(self, jobs=None):
+        """ランダムに選んだ少数のペアを広い範囲で探し、重なり率・ずれの幅・信頼度閾値を決める
+
+        1. 横/縦それぞれ calibration_pairs 組を _match_wide() で調べ、オフセットから実際の重なり率を求める
+        2. 求めた重なり率で同じペアを通常どおりマッチングし、スコアの分布から閾値を決める
+        決めた値は self.config に入れる (呼び出し元の設定の辞書は書き換えない)。戻り値: 決めた値の辞書
+        """
+        import random
+        jobs = jobs or self.build_pair_jobs()
+        rng = random.Random(0)
+        n = int(self.config.get("calibration_pairs", 12))
+        h, w = self.base_image_shape[:2]
+        self._update_status("status", "重なり率と閾値をキャリブレーション中...")
+
+        found = {"h": [], "v": []}
+        for key in ("h", "v"):
+            candidates = [j for j in jobs if j[2].startswith(key)]
+            for base_key, target_key, direction in rng.sample(candidates, min(n, len(candidates))):
+                base_path, target_path = self._get_image_path(*base_key), self._get_image_path(*target_key)
+                base = self.read_gray(base_path) if base_path else None
+                target = self.read_gray(target_path) if target_path else None
+                if base is None or target is None:
+                    continue
+                offset, _ = self._match_wide(base, target, direction)
+                if offset is not None:
+                    found[key].append((base, target, direction, offset))
+
+        chosen = {}
+        spreads = []
+        for key, size, name in (("h", w, "overlap_h_pct"), ("v", h, "overlap_v_pct")):
+            if len(found[key]) < 3:
+                self._update_status("status", f"{name}: 見つかったペアが少ないため、設定値 {self.config.get(name)} のままにします。")
+                continue
+            offsets = np.array([f[3] for f in found[key]], dtype=float)
+            step = offsets[:, 0] if key == "h" else offsets[:, 1]
+            overlaps = (size - step) / size * 100
+            # 検索範囲 (重なり率の1.2倍) に最も重なりの大きいペアも収まるようにする
+            overlap = max(np.median(overlaps), overlaps.max() / 1.15)
+            chosen[name] = int(min(95, max(5, math.ceil(overlap))))
+            spreads.append(np.abs(offsets - np.median(offsets, axis=0)).max())
+            if key == "v":
+                chosen["v_max_drift_px"] = int(np.abs(offsets[:, 0]).max()) + 16
+        if spreads:
+            chosen["orb_guide_radius"] = int(min(96, max(24, 2 * max(spreads) + 16)))
+        self._apply_calibration(chosen)
+
+        # 決めた重なり率で通常どおりマッチングしたときのスコア (本処理と同じ重み付け) から閾値を決める
+        scores = []
+        for base, target, direction, _ in found["h"] + found["v"]:
+            offset, score = self._match_template(base, target, direction)
+            match_count = 0
+            if offset is None:
+                offset, score, match_count = self._match_features(base, target, direction)
+            if offset:
+                scores.append(float(score) * (math.log(match_count + 1) if match_count > 0 else 1.0))
+        if len(scores) >= 3:
+            chosen["min_score_threshold"] = round(float(min(0.95, max(0.3, np.percentile(scores, 10) * 0.8))), 2)
+            self._apply_calibration(chosen)
+
+        self.calibration = dict(chosen, sample_pairs={k: len(v) for k, v in found.items()})
+        self._update_status("status", "キャリブレーション結果: " + ", ".join(f"{k}={v}" for k, v in chosen.items()))
+        return chosen
+
+    def _apply_calibration(self, chosen):
+        self.config = dict(self.config, **chosen)
+        self.min_score_threshold = self.config.get("min_score_threshold", self.min_score_threshold)
+        self.v_max_drift_px = self.config.get("v_max_drift_px", self.v_max_drift_px)
+        self.guided_radius = self.config.get("orb_guide_radius", self.guided_radius)
+
+    # ----------------------- retake list -----------------------
+    def build_retake_list(self):
+        """失敗・低スコアのペアから、撮り直すべきタイルの一覧を作る
+
+        両端のタイルのどちらが悪いかはペア単体では判断できないため、両方を候補にし、
+        失敗したペアの数が多いタイルほど先頭に並べる。
+        """
+        pair_count = {}
+        for (a, b) in list(self.pairwise_matches.keys()) + list(self.failed_pairs.keys()):
+            pair_count[a] = pair_count.get(a, 0) + 1
+            pair_count[b] = pair_count.get(b, 0) + 1
+
+        suspects = {}
+        pairs = []
+        for (a, b), (direction, score, reason) in sorted(self.failed_pairs.items()):
+            pairs.append({"a": list(a), "b": list(b), "direction": direction, "score": round(float(score), 4), "reason": reason})
+            for key in (a, b):
+                entry = suspects.setdefault(key, {"r": key[0], "c": key[1], "failed_pairs": 0, "total_pairs": pair_count.get(key, 0), "reasons": []})
+                entry["failed_pairs"] += 1
+                if reason not in entry["reasons"]:
+                    entry["reasons"].append(reason)
+
+        tiles = sorted(suspects.values(), key=lambda e: (-e["failed_pairs"] / max(e["total_pairs"], 1), e["r"], e["c"]))
+        return {
+            "input_dir": os.path.abspath(self.input_dir),
+            "min_score_threshold": self.min_score_threshold,
+            "tiles": tiles,
+            "pairs": pairs,
+        }
+
+    def save_retake_list(self, out_path):
+        retake = self.build_retake_list()
+        if not retake["tiles"]:
+            return None
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump(retake, f, ensure_ascii=False, indent=2)
+        self._update_status("status", f"撮り直し候補 {len(retake['tiles'])} 枚のリストを保存しました: {out_path}")
+        return retake
 
     # ----------------------- initial estimation -----------------------
     def estimate_initial_positions(self):
@@ -371,7 +881,11 @@ class AdvancedStitcher:
                 self.positions[(r, c)] = (pos_x, pos_y)
 
     # ----------------------- global optimization -----------------------
-    def run_global_optimization(self):
+    def run_global_optimization(self, initial_guess=None):
+        # initial_guess: {key: (x, y)} 反復の初期値。省略時は self.positions (格子の初期位置) から始める
+        # scipy は読み込みが重いので、最適化を行うときだけ読み込む
+        from scipy.sparse import lil_matrix, vstack
+        from scipy.sparse.linalg import lsqr
         self._update_status("status", "グローバル最適化を実行中...")
         image_keys = sorted(self.positions.keys())
         key_to_idx = {key: i for i, key in enumerate(image_keys)}
@@ -467,12 +981,13 @@ class AdvancedStitcher:
         A = vstack([A, A_extra])
         b = np.concatenate([b, b_extra])
 
-        initial_guess = np.array([self.positions[key] for key in image_keys]).flatten()
+        initial_guess = initial_guess or {}
+        x0 = np.array([initial_guess.get(key, self.positions[key]) for key in image_keys], dtype=float).flatten()
         # if initial guess length < solution, pad
-        if initial_guess.shape[0] < A.shape[1]:
-            initial_guess = np.pad(initial_guess, (0, A.shape[1] - initial_guess.shape[0]))
+        if x0.shape[0] < A.shape[1]:
+            x0 = np.pad(x0, (0, A.shape[1] - x0.shape[0]))
 
-        result = lsqr(A, b, x0=initial_guess, iter_lim=self.config.get("lsqr_iter", 200))
+        result = lsqr(A, b, x0=x0, iter_lim=self.config.get("lsqr_iter", 200))
         optimized_coords = result[0].reshape((num_images, 2))
 
         for key, idx in key_to_idx.items():
@@ -482,9 +997,24 @@ class AdvancedStitcher:
 
 
     # ----------------------- rendering -----------------------
+    def _render_keys(self):
+        # 部分結合では範囲の外側 (range_halo) のタイルは描画しない
+        return [k for k in self.positions.keys() if not self.stitch_range or (self.stitch_range["r_min"] <= k[0] <= self.stitch_range["r_max"] and self.stitch_range["c_min"] <= k[1] <= self.stitch_range["c_max"])]
+
+    def save_layout(self, out_path):
+        """最適化後の配置を保存する (stitch_layout.render_layout で描画し直せる)"""
+        render_keys = self._render_keys()
+        if not render_keys:
+            return
+        layout = stitch_layout.build_layout(self.input_dir, self.base_image_shape, {k: self.positions[k] for k in render_keys},
+                                            self._file_map, self.pairwise_matches, self.failed_pairs, self.positions,
+                                            blend=self.blend, blend_width=self.blend_width)
+        stitch_layout.save_layout(out_path, layout)
+        self._update_status("status", f"レイアウトを保存しました: {out_path}")
+
     def render_final_image(self):
         self._update_status("status", "最終画像のレンダリング準備中...")
-        render_keys = [k for k in self.positions.keys() if not self.stitch_range or (self.stitch_range["r_min"] <= k[0] <= self.stitch_range["r_max"] and self.stitch_range["c_min"] <= k[1] <= self.stitch_range["c_max"])]
+        render_keys = self._render_keys()
         if not render_keys:
             self._update_status("error", "指定範囲に描画対象画像がありません。"); return
 
@@ -501,85 +1031,128 @@ class AdvancedStitcher:
             self._update_status("error", f"計算された画像サイズ({canvas_width}x{canvas_height})が非現実的です。"); return
 
         # === 【ここからが新しい戦略の核心部分】 ===
-        temp_dir = tempfile.gettempdir()
-        
-        # 1. カラー情報用の一時ファイル (BGR, 3チャンネル)
-        canvas_filename = os.path.join(temp_dir, f"stitcher_canvas_{os.getpid()}.mmap")
-        
-        # 2. 形状記録用の一時ファイル (Grayscale, 1チャンネル)
-        mask_filename = os.path.join(temp_dir, f"stitcher_mask_{os.getpid()}.mmap")
+        # キャンバスはタイルが触れたチャンクだけをディスクに確保する (chunked_canvas)。
+        # 色と形状マスクは同じファイルにチャンクごとに並ぶ。チェックポイントが有効なら作業フォルダに置いて中断後も残す
+        if self.checkpoints:
+            canvas_filename = self.checkpoints.path("canvas.chunks")
+        else:
+            canvas_filename = os.path.join(tempfile.gettempdir(), f"stitcher_canvas_{os.getpid()}.chunks")
 
-        for f in [canvas_filename, mask_filename]:
-            if os.path.exists(f):
-                try: os.remove(f)
-                except Exception: pass
+        # 前回の描画の続きから再開できるか。
+        # ブレンドする場合は、中断したバンドの途中までに混ぜたタイルを描き直すと2重に混ざるので、描画は最初からやり直す
+        start = 0
+        saved = self.checkpoints.load_render() if (self.checkpoints and self._resumed and not self.blend) else None
+        if saved and saved["canvas_shape"] == [canvas_height, canvas_width] and saved["origin"] == [min_x, min_y] \
+                and ChunkedCanvas.exists(canvas_filename):
+            start = min(saved["rendered"], len(render_keys))
 
         try:
-            self._update_status("status", "ディスク上に2種類の一時ファイルを作成中...")
-            # カラー用キャンバスは黒(0,0,0)で初期化
-            canvas = np.memmap(canvas_filename, dtype='uint8', mode='w+', shape=(canvas_height, canvas_width, 3))
-            canvas[:] = 255
-            
-            # 形状記録用マスクは0(透明)で初期化
-            canvas_mask = np.memmap(mask_filename, dtype='uint8', mode='w+', shape=(canvas_height, canvas_width))
-            canvas_mask[:] = 0
+            if start:
+                self._update_status("status", f"描画済みの {start} 枚を読み込みました。続きから描画します...")
+                canvas = ChunkedCanvas.open(canvas_filename)
+            else:
+                self._update_status("status", "ディスク上に一時ファイルを作成中...")
+                # 確保されていないチャンクは背景色 (白) として書き出す
+                canvas = ChunkedCanvas(canvas_filename, canvas_height, canvas_width,
+                                       chunk=self.config.get("canvas_chunk_px", 1024), background=255, weighted=self.blend)
+                if self.checkpoints:
+                    canvas.flush()
+                    self.checkpoints.save_render(0, (canvas_height, canvas_width), (min_x, min_y))
         except Exception as e:
             self._update_status("error", f"一時ファイルの作成に失敗しました: {e}"); return
         
         # === 【ここまでが新しい戦略の核心部分】 ===
 
-        self._update_status("status", "画像をレンダリング中...")
-        total_render_images = len(render_keys)
-        last_progress = -1
-
-        for i, key in enumerate(tqdm(render_keys, desc="Rendering")):
-            img_path = self._get_image_path(key[0], key[1])
-            if not img_path: continue
+        with self.metrics.phase("render"):
+            self._update_status("status", "画像をレンダリング中...")
+            total_render_images = len(render_keys)
+            last_progress = -1
+
+            prev_row = render_keys[start][0] if start < total_render_images else None
+            for i, key in enumerate(tqdm(render_keys[start:], desc="Rendering", initial=start, total=total_render_images), start):
+                # 行 (バンド) が変わるたびに、描画済みの枚数を記録する。
+                # 中断した場合はバンドの先頭から描き直す (同じ順で上書きするので結果は変わらない。ブレンド時は記録しない)
+                if key[0] != prev_row:
+                    prev_row = key[0]
+                    if self.checkpoints and not self.blend:
+                        canvas.flush()
+                        self.checkpoints.save_render(i, (canvas_height, canvas_width), (min_x, min_y))
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    canvas.flush(); canvas.close()
+                    del canvas
+                    self._check_cancel()
+
+                img_path = self._get_image_path(key[0], key[1])
+                if not img_path: continue
             
-            # 【変更点】cv2.imread を imread_safe に置き換え
-            img = imread_safe(img_path, cv2.IMREAD_UNCHANGED)
-            if img is None: continue
-
-            has_alpha = img.shape[2] == 4
-            img_rgb = img[:, :, :3] if has_alpha else img
+                # 【変更点】cv2.imread を imread_safe に置き換え
+                img = imread_safe(img_path, cv2.IMREAD_UNCHANGED)
+                self.metrics.count("decodes")
+                if img is None: continue
+                self.metrics.count("tiles_rendered")
+
+                has_alpha = img.shape[2] == 4
+                img_rgb = img[:, :, :3] if has_alpha else img
+
+                # --- 座標計算とクリッピング ---
+                pos = self.positions[key]; h, w, _ = img_rgb.shape
+                canvas_x_start, canvas_y_start = pos[0] - min_x, pos[1] - min_y
+                img_x_start, img_y_start = 0, 0; copy_w, copy_h = w, h
+
+                if canvas_x_start < 0: img_x_start = -canvas_x_start; copy_w -= img_x_start; canvas_x_start = 0
+                if canvas_y_start < 0: img_y_start = -canvas_y_start; copy_h -= img_y_start; canvas_y_start = 0
+                if canvas_x_start + copy_w > canvas_width: copy_w = canvas_width - canvas_x_start
+                if canvas_y_start + copy_h > canvas_height: copy_h = canvas_height - canvas_y_start
+
+                if copy_w <= 0 or copy_h <= 0: continue
+            
+                # --- 描画領域のビューを取得 ---
+                img_rgb_view = img_rgb[img_y_start:img_y_start+copy_h, img_x_start:img_x_start+copy_w]
+
+                # --- キャンバス (色と形状マスク) への書き込み ---
+                if self.blend:
+                    weight = self._feather_weights(h, w)[img_y_start:img_y_start+copy_h, img_x_start:img_x_start+copy_w]
+                    if has_alpha:
+                        weight = np.where(img[img_y_start:img_y_start+copy_h, img_x_start:img_x_start+copy_w, 3] > 0, weight, 0).astype(np.uint8)
+                    canvas.paste(canvas_y_start, canvas_x_start, img_rgb_view, weight=weight)
+                elif has_alpha:
+                    alpha_view = img[img_y_start:img_y_start+copy_h, img_x_start:img_x_start+copy_w, 3]
+                    # 完全に透明でないピクセルをマスクとして使用
+                    canvas.paste(canvas_y_start, canvas_x_start, img_rgb_view, alpha_view > 0)
+                else:
+                    # アルファがなければ全面上書き
+                    canvas.paste(canvas_y_start, canvas_x_start, img_rgb_view)
+
+                # --- 進捗更新 ---
+                progress_percent = int(50 + ((i + 1) / total_render_images) * 50)
+                if progress_percent > last_progress:
+                    self._update_status("status", f"レンダリング中 ({i+1}/{total_render_images})"); self._update_status("progress", progress_percent)
+                    last_progress = progress_percent
+        
+            canvas.flush()
+        self.metrics.count("canvas_chunks", len(canvas.slots))
+        self.metrics.count("canvas_bytes", canvas.allocated_bytes)
+        with self.metrics.phase("encode"):
+            self._trim_and_save(canvas)
 
-            # --- 座標計算とクリッピング ---
-            pos = self.positions[key]; h, w, _ = img_rgb.shape
-            canvas_x_start, canvas_y_start = pos[0] - min_x, pos[1] - min_y
-            img_x_start, img_y_start = 0, 0; copy_w, copy_h = w, h
+        # 一時ファイルをクリーンアップ
+        canvas.close(); gc.collect()
+        try:
+            canvas.remove()
+        except Exception as e:
+            self._update_status("status", f"一時ファイル'{os.path.basename(canvas_filename)}'の削除に失敗: {e}")
+        del canvas
+        if self.checkpoints:
+            self.checkpoints.remove()
 
-            if canvas_x_start < 0: img_x_start = -canvas_x_start; copy_w -= img_x_start; canvas_x_start = 0
-            if canvas_y_start < 0: img_y_start = -canvas_y_start; copy_h -= img_y_start; canvas_y_start = 0
-            if canvas_x_start + copy_w > canvas_width: copy_w = canvas_width - canvas_x_start
-            if canvas_y_start + copy_h > canvas_height: copy_h = canvas_height - canvas_y_start
+    def _feather_weights(self, h, w):
+        """タイルの端からの距離で 1-255 に増える重み (uint8)。タイルの大きさごとに1度だけ作る"""
+        key = (h, w)
+        if key not in self._feather_cache:
+            self._feather_cache[key] = feather_weights(h, w, self.blend_width)
+        return self._feather_cache[key]
 
-            if copy_w <= 0 or copy_h <= 0: continue
-            
-            # --- 描画領域のビューを取得 ---
-            img_rgb_view = img_rgb[img_y_start:img_y_start+copy_h, img_x_start:img_x_start+copy_w]
-            dest_slice = canvas[canvas_y_start:canvas_y_start+copy_h, canvas_x_start:canvas_x_start+copy_w]
-            mask_slice = canvas_mask[canvas_y_start:canvas_y_start+copy_h, canvas_x_start:canvas_x_start+copy_w]
-
-            # --- 2つのキャンバスへの書き込み ---
-            if has_alpha:
-                alpha_view = img[img_y_start:img_y_start+copy_h, img_x_start:img_x_start+copy_w, 3]
-                # 完全に透明でないピクセルをマスクとして使用
-                visible_mask = alpha_view > 0
-                dest_slice[visible_mask] = img_rgb_view[visible_mask]
-                mask_slice[visible_mask] = 255
-            else:
-                # アルファがなければ全面上書き
-                dest_slice[:] = img_rgb_view
-                mask_slice[:] = 255
-
-            # --- 進捗更新 ---
-            progress_percent = int(50 + ((i + 1) / total_render_images) * 50)
-            if progress_percent > last_progress:
-                self._update_status("status", f"レンダリング中 ({i+1}/{total_render_images})"); self._update_status("progress", progress_percent)
-                last_progress = progress_percent
-        
-        canvas.flush()
-        canvas_mask.flush()
+    def _trim_and_save(self, canvas):
 
 
 
@@ -588,25 +1161,19 @@ class AdvancedStitcher:
         # ############## 【ここからがメモリ効率の良い、新しいトリミング処理です】 ##############
         self._update_status("status", "形状マスクを基に、最適なトリミング領域を計算中...")
 
-        # canvas_maskをチェックして、画像データが存在する行と列を探す
+        # 確保されたチャンクの形状マスクだけを調べて、画像データが存在する範囲を探す
         # これにより、巨大な座標配列をメモリ上に作成するのを回避する
-        rows_with_data = np.any(canvas_mask, axis=1)
-        cols_with_data = np.any(canvas_mask, axis=0)
-        
-        # データが存在する最初の行と最後の行、最初の列と最後の列を見つける
-        y_indices = np.where(rows_with_data)[0]
-        x_indices = np.where(cols_with_data)[0]
+        bounds = canvas.bounds()
 
-        if y_indices.size == 0 or x_indices.size == 0:
+        if bounds is None:
             self._update_status("status", "有効な画像領域が見つかりませんでした。")
             final_canvas_view = np.zeros((1, 1, 3), dtype=np.uint8)
         else:
-            y0, y1 = y_indices[0], y_indices[-1]
-            x0, x1 = x_indices[0], x_indices[-1]
+            y0, y1, x0, x1 = bounds
 
             self._update_status("status", "最終領域をメモリにコピー中...")
-            # 計算した座標を使い、カラーキャンバスから最終画像を切り出す
-            final_canvas_view = np.array(canvas[y0:y1+1, x0:x1+1])
+            # 計算した範囲をキャンバスから切り出す (確保されていないチャンクは背景色になる)
+            final_canvas_view = canvas.read(y0, y1, x0, x1)
         # ############## 【新しいトリミング処理ここまで】 ##############
 
 
@@ -617,15 +1184,9 @@ class AdvancedStitcher:
         self._update_status("status", "最終画像をファイルに保存中...")
         # 【変更点】cv2.imwrite を imwrite_safe に置き換え
         imwrite_safe(self.output_file, final_canvas_view, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        self._count_written(self.output_file)
         self._update_status("done", "画像結合が完了しました！")
-
-        # 一時ファイルをクリーンアップ
-        del final_canvas_view; del canvas; del canvas_mask; gc.collect()
-        for f in [canvas_filename, mask_filename]:
-            try:
-                os.remove(f)
-            except Exception as e:
-                self._update_status("status", f"一時ファイル'{os.path.basename(f)}'の削除に失敗: {e}")
+        del final_canvas_view
 
 
 
@@ -657,43 +1218,88 @@ class AdvancedStitcher:
         if out_preview_path:
             # 【変更点】cv2.imwrite を imwrite_safe に置き換え
             imwrite_safe(out_preview_path, canvas)
+            self._count_written(out_preview_path)
             self._update_status("status", f"プレビュー画像を保存しました: {out_preview_path}")
         return canvas
 
-    # ----------------------- heatmap of offsets -----------------------
-    def save_offset_heatmap(self, out_path):
-        if not HAS_MATPLOTLIB:
-            self._update_status("status", "matplotlib が無いためヒートマップは生成できません。")
+    # ----------------------- per-tile quality map -----------------------
+    def save_quality_map(self, out_path):
+        """タイルごとの残差・スコア・ORB の有無と不採用ペアを1枚の画像にする (quality_map.py)"""
+        if not self.positions:
+            self._update_status("status", "座標がないため品質マップの生成をスキップします。")
             return
-        offsets = []
-        for (k1, k2), (offset, score, direction, match_count, tmpl_val) in self.pairwise_matches.items():
-            offsets.append((k1, k2, offset[0], offset[1]))
-        if not offsets:
-            self._update_status("status", "オフセットデータがないためヒートマップ生成をスキップします。")
+        try:
+            quality_map.save_quality_map(out_path, self.grid_info["rows"], self.grid_info["cols"], self.positions,
+                                         self.pairwise_matches, self.failed_pairs)
+        except Exception as e:
+            self._update_status("status", f"品質マップの保存に失敗しました: {e}")
             return
-        dx = [o[2] for o in offsets]
-        dy = [o[3] for o in offsets]
-        plt.figure(figsize=(6,6))
-        plt.scatter(dx, dy, c=np.hypot(dx, dy), cmap='jet')
-        plt.colorbar(label='magnitude')
-        plt.xlabel('dx'); plt.ylabel('dy'); plt.title('Pairwise offsets heatmap')
-        plt.grid(True)
-        plt.savefig(out_path)
-        plt.close()
-        self._update_status("status", f"オフセットのヒートマップを保存しました: {out_path}")
+        self._count_written(out_path)
+        self._update_status("status", f"品質マップを保存しました: {out_path}")
+
+    # ----------------------- run report -----------------------
+    def _count_written(self, path):
+        try:
+            self.metrics.count("bytes_written", os.path.getsize(path))
+        except OSError:
+            pass
+
+    def save_run_report(self, out_path):
+        """フェーズごとの時間・カウンター・最大メモリを JSON で書き出す"""
+        try:
+            self.metrics.save(out_path, status=self._outcome or "error", input_dir=self.input_dir,
+                              output_file=self.output_file, tiles=len(self._file_map),
+                              pairs={"matched": len(self.pairwise_matches), "failed": len(self.failed_pairs)},
+                              resumed=self._resumed, calibration=self.calibration)
+        except Exception as e:
+            self._update_status("status", f"実行レポートの保存に失敗しました: {e}")
 
     # ----------------------- main run -----------------------
     def run(self):
-        self.verify_grid()
-        self.calculate_all_pairwise_matches()
-        self.estimate_initial_positions()
-        self.run_global_optimization()
+        try:
+            self._run_phases()
+        except StitchCancelled as e:
+            self._update_status("cancelled", str(e))
+        finally:
+            if self.config.get('run_report', True):
+                report_path = self.config.get('report_path', os.path.splitext(self.output_file)[0] + '_report.json')
+                self.save_run_report(report_path)
+
+    def _run_phases(self):
+        m = self.metrics
+        with m.phase("verify_grid"):
+            self.verify_grid()
+        self._open_checkpoints()
+        if self.config.get('auto_calibrate'):
+            with m.phase("calibration"):
+                self.calibrate()
+        with m.phase("matching"):
+            self.calculate_all_pairwise_matches()
+        if self.config.get('retake_list', True):
+            retake_path = self.config.get('retake_path', os.path.splitext(self.output_file)[0] + '_retake.json')
+            self.save_retake_list(retake_path)
+        positions = self.checkpoints.load_positions() if self._resumed else None
+        if positions:
+            self._update_status("status", "最適化済みの座標を読み込みました。")
+            self.positions = positions
+        else:
+            self._check_cancel()
+            with m.phase("estimate_initial_positions"):
+                self.estimate_initial_positions()
+            with m.phase("run_global_optimization"):
+                self.run_global_optimization()
+            self.checkpoints.save_positions(self.positions)
+        if self.config.get('save_layout', True):
+            self.save_layout(self.config.get('layout_path') or stitch_layout.default_layout_path(self.output_file))
+        self._check_cancel()
         # optional preview
         if self.config.get('generate_preview'):
             preview_path = self.config.get('preview_path', os.path.splitext(self.output_file)[0] + '_preview.png')
-            self.preview_stitch(preview_path)
-        # optional heatmap
+            with m.phase("preview"):
+                self.preview_stitch(preview_path)
+        # optional quality map (旧オフセットヒートマップの設定キーをそのまま使う)
         if self.config.get('generate_heatmap'):
-            hm_path = self.config.get('heatmap_path', os.path.splitext(self.output_file)[0] + '_heatmap.png')
-            self.save_offset_heatmap(hm_path)
+            hm_path = self.config.get('heatmap_path', os.path.splitext(self.output_file)[0] + '_quality.png')
+            with m.phase("quality_map"):
+                self.save_quality_map(hm_path)
         self.render_final_image()
\ No newline at end of file
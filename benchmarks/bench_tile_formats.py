@@ -0,0 +1,115 @@
+# bench_tile_formats.py
+# タイル保存形式ごとの 書き込み時間 / ディスク使用量 / デコード速度 を比較するベンチマーク
+#
+# 使い方:
+#   python benchmarks/bench_tile_formats.py                 # 合成タイルで計測
+#   python benchmarks/bench_tile_formats.py --input-dir D   # 既存の撮影フォルダのタイルで計測
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tile_formats  # noqa: E402
+from advanced_stitcher import imread_safe  # noqa: E402
+
+
+def make_synthetic_tile(width, height, seed):
+    """地図風の合成タイル (平坦な背景・道路・文字) を作る"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), (232, 238, 242), dtype=np.uint8)
+    for _ in range(12):
+        color = tuple(int(v) for v in rng.integers(150, 255, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        cv2.rectangle(img, (x, y), (x + int(rng.integers(20, 200)), y + int(rng.integers(20, 200))), color, -1)
+    for _ in range(20):
+        p1 = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        p2 = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.line(img, p1, p2, (255, 255, 255), int(rng.integers(2, 10)), cv2.LINE_AA)
+        cv2.line(img, p1, p2, (120, 120, 120), 1, cv2.LINE_AA)
+    for _ in range(15):
+        org = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.putText(img, f"Label{int(rng.integers(0, 999))}", org, cv2.FONT_HERSHEY_SIMPLEX, 0.5, (40, 40, 40), 1, cv2.LINE_AA)
+    return img
+
+
+def load_source_tiles(args):
+    if args.input_dir:
+        names = sorted(f for f in os.listdir(args.input_dir) if tile_formats.parse_tile_filename(f))[:args.tiles]
+        tiles = [imread_safe(os.path.join(args.input_dir, f), cv2.IMREAD_COLOR) for f in names]
+        return [t for t in tiles if t is not None]
+    return [make_synthetic_tile(args.width, args.height, i) for i in range(args.tiles)]
+
+
+def bench_format(fmt, tiles, work_dir, png_compress_level, repeat):
+    fmt_dir = os.path.join(work_dir, fmt)
+    os.makedirs(fmt_dir, exist_ok=True)
+
+    paths = []
+    t0 = time.perf_counter()
+    for i, img in enumerate(tiles):
+        path = os.path.join(fmt_dir, tile_formats.tile_filename(1, i + 1, fmt))
+        tile_formats.write_tile(path, img, fmt, png_compress_level)
+        paths.append(path)
+    write_time = time.perf_counter() - t0
+    disk_bytes = sum(os.path.getsize(p) for p in paths)
+
+    results = {}
+    for label, flags in [("gray", cv2.IMREAD_GRAYSCALE), ("color", cv2.IMREAD_COLOR)]:
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            for p in paths:
+                img = imread_safe(p, flags)
+                assert img is not None, p
+        results[label] = (len(paths) * repeat) / (time.perf_counter() - t0)
+
+    raw_bytes = sum(t.nbytes for t in tiles)
+    return {
+        "write_ms_per_tile": write_time / len(tiles) * 1000,
+        "disk_mb": disk_bytes / 1024 / 1024,
+        "ratio": disk_bytes / raw_bytes,
+        "decode_gray_tps": results["gray"],
+        "decode_color_tps": results["color"],
+        "decode_color_mbps": results["color"] * (raw_bytes / len(tiles)) / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="タイル保存形式のベンチマーク")
+    parser.add_argument("--tiles", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--input-dir", default=None, help="既存の撮影フォルダ (指定時は合成タイルの代わりに使用)")
+    parser.add_argument("--formats", default=",".join(tile_formats.available_formats()))
+    parser.add_argument("--png-compress-level", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    tiles = load_source_tiles(args)
+    if not tiles:
+        print("計測対象のタイルがありません。")
+        return 1
+
+    work_dir = tempfile.mkdtemp(prefix="bench_tile_formats_")
+    try:
+        print(f"tiles={len(tiles)} size={tiles[0].shape[1]}x{tiles[0].shape[0]}")
+        print(f"{'format':<8}{'write ms/tile':>14}{'disk MB':>10}{'ratio':>8}{'gray tile/s':>13}{'color tile/s':>14}{'color MB/s':>12}")
+        for fmt in args.formats.split(","):
+            if not tile_formats.is_format_available(fmt):
+                print(f"{fmt:<8}  (この環境では利用できません)")
+                continue
+            r = bench_format(fmt, tiles, work_dir, args.png_compress_level, args.repeat)
+            print(f"{fmt:<8}{r['write_ms_per_tile']:>14.2f}{r['disk_mb']:>10.2f}{r['ratio']:>8.2f}"
+                  f"{r['decode_gray_tps']:>13.1f}{r['decode_color_tps']:>14.1f}{r['decode_color_mbps']:>12.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+# synthetic_map.py
+# 合成した地図画像で AdvancedStitcher の処理速度と位置精度を計測するベンチマーク
+#
+# 道路・文字・平坦な領域・繰り返し模様 (同じ形の建物が並ぶ街区) を含む大きな地図を手続き的に作り、
+# 既知のずれ (ジッター) を加えた位置で R##_C##.png に切り出してから結合する。
+# 正解の座標と比べた位置誤差と、実行レポート (run_metrics) のフェーズごとの時間・最大メモリを出力する。
+# ブラウザやネットワークは使わないので、普通の Linux マシンでそのまま実行できる。
+#
+# 使い方:
+#   python benchmarks/synthetic_map.py                          # 既定のグリッドサイズ (4x5, 8x10, 16x20) で計測
+#   python benchmarks/synthetic_map.py --grids 10x10,20x30 --noise 4 --blank-ratio 0.02
+#   python benchmarks/synthetic_map.py --keep-dir out/ --json result.json
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tile_formats  # noqa: E402
+
+BACKGROUND = (232, 238, 242)
+BLANK_COLOR = (255, 255, 255)  # 読み込みが終わっていない地図タイルを想定した無地の色
+
+
+def _rand_color(rng, low, high):
+    return tuple(int(v) for v in rng.integers(low, high, 3))
+
+
+def make_map(width, height, seed=0):
+    """地図風の大きな画像 (BGR) を作る。特徴の数は面積に比例させる"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), BACKGROUND, dtype=np.uint8)
+    density = width * height / (1000 * 1000)
+
+    # 平坦な領域 (水域・公園など)。内部に特徴が無いのでマッチングが難しい
+    for _ in range(max(1, int(3 * density))):
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        pts = np.array([(cx + int(rng.integers(-250, 250)), cy + int(rng.integers(-250, 250))) for _ in range(6)], np.int32)
+        cv2.fillPoly(img, [cv2.convexHull(pts)], _rand_color(rng, 170, 235))
+
+    # 繰り返し模様 (同じ大きさの建物が等間隔に並ぶ街区)。周期の分だけずれた誤マッチが起きやすい
+    for _ in range(max(1, int(2 * density))):
+        x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        bw, bh = int(rng.integers(12, 24)), int(rng.integers(12, 24))
+        gap = int(rng.integers(6, 12))
+        color = _rand_color(rng, 190, 225)
+        for by in range(y0, min(height, y0 + int(rng.integers(150, 400))), bh + gap):
+            for bx in range(x0, min(width, x0 + int(rng.integers(150, 400))), bw + gap):
+                cv2.rectangle(img, (bx, by), (bx + bw, by + bh), color, -1)
+
+    # 建物 (大きさのばらばらな矩形)
+    for _ in range(int(60 * density)):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        cv2.rectangle(img, (x, y), (x + int(rng.integers(8, 60)), y + int(rng.integers(8, 60))), _rand_color(rng, 180, 235), -1)
+
+    # 道路 (折れ線。白い本線と灰色の縁取り)
+    for _ in range(int(25 * density) + 2):
+        pts = [(int(rng.integers(0, width)), int(rng.integers(0, height)))]
+        for _ in range(int(rng.integers(2, 6))):
+            x, y = pts[-1]
+            pts.append((x + int(rng.integers(-400, 400)), y + int(rng.integers(-400, 400))))
+        pts = np.array(pts, np.int32)
+        thickness = int(rng.integers(3, 12))
+        cv2.polylines(img, [pts], False, (150, 150, 150), thickness + 2, cv2.LINE_AA)
+        cv2.polylines(img, [pts], False, (255, 255, 255), thickness, cv2.LINE_AA)
+
+    # 文字 (地名)
+    for _ in range(int(40 * density)):
+        org = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        text = "".join(chr(int(c)) for c in rng.integers(65, 91, int(rng.integers(3, 9))))
+        cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, float(rng.uniform(0.4, 0.8)), (50, 50, 50), 1, cv2.LINE_AA)
+    return img
+
+
+def make_dataset(out_dir, rows, cols, tile_w=640, tile_h=400, overlap_h_pct=60, overlap_v_pct=40,
+                 jitter=4, noise=0.0, blank_ratio=0.0, seed=0):
+    """合成地図をタイルに切り出し、正解の座標 (左上の px) を ground_truth.json に書く"""
+    rng = np.random.default_rng(seed + 1)
+    step_x = int(round(tile_w * (1 - overlap_h_pct / 100.0)))
+    step_y = int(round(tile_h * (1 - overlap_v_pct / 100.0)))
+    margin = jitter + 1
+    map_img = make_map(step_x * (cols - 1) + tile_w + 2 * margin, step_y * (rows - 1) + tile_h + 2 * margin, seed)
+
+    os.makedirs(out_dir, exist_ok=True)
+    truth, blanks = {}, []
+    for r in range(1, rows + 1):
+        for c in range(1, cols + 1):
+            x = margin + (c - 1) * step_x + int(rng.integers(-jitter, jitter + 1))
+            y = margin + (r - 1) * step_y + int(rng.integers(-jitter, jitter + 1))
+            tile = map_img[y:y + tile_h, x:x + tile_w]
+            if blank_ratio and rng.random() < blank_ratio:
+                tile = np.full_like(tile, BLANK_COLOR)
+                blanks.append([r, c])
+            elif noise:
+                tile = np.clip(tile + rng.normal(0, noise, tile.shape), 0, 255).astype(np.uint8)
+            truth[f"{r},{c}"] = [x, y]
+            tile_formats.write_tile(os.path.join(out_dir, tile_formats.tile_filename(r, c, "png")), tile, "png")
+    del map_img
+
+    ground_truth = {"rows": rows, "cols": cols, "tile_w": tile_w, "tile_h": tile_h,
+                    "overlap_h_pct": overlap_h_pct, "overlap_v_pct": overlap_v_pct,
+                    "positions": truth, "blank": blanks}
+    with open(os.path.join(out_dir, "ground_truth.json"), "w", encoding="utf-8") as f:
+        json.dump(ground_truth, f)
+    return ground_truth
+
+
+def position_errors(positions, ground_truth):
+    """推定座標と正解の誤差 (px)。全体の平行移動は任意なので、差の中央値を引いてから比べる"""
+    blanks = {tuple(k) for k in ground_truth["blank"]}
+    keys = [k for k in positions if k not in blanks and f"{k[0]},{k[1]}" in ground_truth["positions"]]
+    if not keys:
+        return None
+    est = np.array([positions[k] for k in keys], dtype=np.float64)
+    gt = np.array([ground_truth["positions"][f"{k[0]},{k[1]}"] for k in keys], dtype=np.float64)
+    diff = est - gt
+    diff -= np.median(diff, axis=0)
+    err = np.hypot(diff[:, 0], diff[:, 1])
+    return {"mean": float(err.mean()), "p95": float(np.percentile(err, 95)), "max": float(err.max()),
+            "over_5px": int(np.sum(err > 5))}
+
+
+def run_stitch(input_dir, output_file, config):
+    """AdvancedStitcher を1回実行し、実行レポートと推定座標を返す (別プロセスで呼ぶ)"""
+    from advanced_stitcher import AdvancedStitcher
+
+    class _Messages:
+        def __init__(self):
+            self.last = {}
+
+        def put(self, item):
+            self.last[item[0]] = item[1]
+
+    messages = _Messages()
+    stitcher = AdvancedStitcher(input_dir, output_file, messages, dict(config, run_report=False))
+    try:
+        stitcher.run()
+    except Exception as e:  # マッチングが1件も無い場合など。結果にエラーとして残して次のグリッドへ進む
+        messages.put(("error", str(e)))
+    report = stitcher.metrics.to_dict(status=stitcher._outcome or "error", error=messages.last.get("error"),
+                                      pairs={"matched": len(stitcher.pairwise_matches), "failed": len(stitcher.failed_pairs)})
+    return report, {k: tuple(v) for k, v in stitcher.positions.items()}
+
+
+def bench_grid(rows, cols, args, work_dir):
+    data_dir = os.path.join(work_dir, f"grid_{rows}x{cols}")
+    t0 = time.perf_counter()
+    gt = make_dataset(data_dir, rows, cols, args.tile_width, args.tile_height, args.overlap_h, args.overlap_v,
+                      args.jitter, args.noise, args.blank_ratio, args.seed)
+    gen_time = time.perf_counter() - t0
+
+    config = {"overlap_h_pct": args.overlap_h, "overlap_v_pct": args.overlap_v, "retake_list": False}
+    # 最大メモリ使用量がグリッドごとに測れるよう、結合は毎回新しいプロセスで行う
+    ctx = multiprocessing.get_context("spawn")
+    pool = ctx.Pool(1)
+    try:
+        report, positions = pool.apply(run_stitch, (data_dir, os.path.join(work_dir, f"stitched_{rows}x{cols}.png"), config))
+    finally:
+        pool.close()
+        pool.join()
+
+    tiles = rows * cols
+    phases = report["phases"]
+    throughput = {}
+    if "matching" in phases:
+        pairs = report["pairs"]["matched"] + report["pairs"]["failed"]
+        throughput["matching_pairs_per_s"] = pairs / max(phases["matching"]["wall_s"], 1e-9)
+    if "render" in phases:
+        throughput["render_tiles_per_s"] = tiles / max(phases["render"]["wall_s"], 1e-9)
+    throughput["total_tiles_per_s"] = tiles / max(report["wall_s"], 1e-9)
+    return {"grid": f"{rows}x{cols}", "tiles": tiles, "blank": len(gt["blank"]), "generate_s": gen_time,
+            "report": report, "throughput": throughput, "error_px": position_errors(positions, gt)}
+
+
+def _parse_grids(text):
+    grids = []
+    for part in text.split(","):
+        r, c = part.lower().split("x")
+        grids.append((int(r), int(c)))
+    return grids
+
+
+def print_result(res):
+    rep = res["report"]
+    err = res["error_px"]
+    phases = " ".join(f"{k}={v['wall_s']:.2f}s" for k, v in rep["phases"].items())
+    print(f"[{res['grid']}] tiles={res['tiles']} blank={res['blank']} status={rep['status']} "
+          f"pairs={rep['pairs']['matched']}/{rep['pairs']['matched'] + rep['pairs']['failed']}")
+    print(f"  total={rep['wall_s']:.2f}s cpu={rep['cpu_s']:.2f}s peak_rss={rep['peak_rss_mb']:.0f}MB "
+          f"(生成 {res['generate_s']:.2f}s)")
+    print(f"  phases: {phases}")
+    print("  throughput: " + " ".join(f"{k}={v:.1f}" for k, v in res["throughput"].items()))
+    if err:
+        print(f"  error px: mean={err['mean']:.2f} p95={err['p95']:.2f} max={err['max']:.2f} >5px={err['over_5px']}")
+    if rep.get("error"):
+        print(f"  error: {rep['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成地図による結合処理のベンチマーク")
+    parser.add_argument("--grids", type=_parse_grids, default=_parse_grids("4x5,8x10,16x20"),
+                        help="グリッドサイズ (行x列) のカンマ区切り")
+    parser.add_argument("--tile-width", type=int, default=640)
+    parser.add_argument("--tile-height", type=int, default=400)
+    parser.add_argument("--overlap-h", type=int, default=60, help="横の重なり率 %%")
+    parser.add_argument("--overlap-v", type=int, default=40, help="縦の重なり率 %%")
+    parser.add_argument("--jitter", type=int, default=4, help="タイル位置のずれの最大値 px")
+    parser.add_argument("--noise", type=float, default=0.0, help="ガウスノイズの標準偏差")
+    parser.add_argument("--blank-ratio", type=float, default=0.0, help="無地にするタイルの割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-dir", default=None, help="生成したタイルと結合結果を残すフォルダ")
+    parser.add_argument("--json", default=None, help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    work_dir = args.keep_dir or tempfile.mkdtemp(prefix="bench_synthetic_map_")
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        for rows, cols in args.grids:
+            res = bench_grid(rows, cols, args, work_dir)
+            print_result(res)
+            results.append(res)
+    finally:
+        if not args.keep_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0 if all(r["report"]["status"] == "done" for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
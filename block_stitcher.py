@@ -0,0 +1,278 @@
+# block_stitcher.py
+# 大きなグリッドをブロックに分けて、マッチングと局所最適化をワーカーごとに並列に行う
+#
+# グリッドを rows_per_block 行 (cols_per_block 列) ごとの、境界の block_overlap 行/列を共有するブロックに分ける。
+# 各ブロックはワーカープロセスで独立に「ペアマッチング -> 初期位置 -> 局所最適化」を行い、
+# ブロック内の座標 (ブロックごとに原点が異なる) を返す。統合では
+#   1. 隣り合うブロックが共有するタイルの座標の差から、ブロックごとの平行移動を最小二乗で求め
+#   2. 平行移動した座標を初期値として、全ペアで通常と同じ全体最適化を行う
+# ので、最終的な座標は1台で全体を処理した場合と同じ問題の解になる。
+# multiprocessing のプロセスを計算ノードの代わりに使っており、ブロックの処理 (_stitch_block) は
+# 入力と出力がすべて pickle できる値なので、別のマシンで実行するように置き換えられる。
+# 複数のワーカーで処理するときは、デコード済みのタイルを共有メモリのストア (shared_tile_store) で共有し、
+# ブロックの境界のタイルをワーカーごとにデコードし直さないようにする (shared_tile_store_mb で大きさを指定、0 で無効)。
+import multiprocessing
+import os
+
+import numpy as np
+
+from advanced_stitcher import AdvancedStitcher
+from shared_tile_store import SharedTileStore
+
+# ワーカープロセスで使う資源 (Pool の initializer で設定する)
+_worker_resources = None
+
+
+def _init_block_worker(store_handle):
+    global _worker_resources
+    _worker_resources = {"tile_store": SharedTileStore.attach(store_handle)} if store_handle else None
+
+
+def split_with_overlap(items, size, overlap):
+    """items を size 個ずつ、隣と overlap 個を共有する区間に分ける"""
+    if size <= 0 or len(items) <= size:
+        return [list(items)]
+    size = max(size, overlap + 1)
+    chunks, start = [], 0
+    while True:
+        end = min(start + size, len(items))
+        chunks.append(list(items[start:end]))
+        if end >= len(items):
+            return chunks
+        start = end - overlap
+
+
+def plan_blocks(rows, cols, rows_per_block, cols_per_block=0, overlap=1):
+    """[(ブロックの行リスト, 列リスト)] を返す"""
+    return [(r, c) for r in split_with_overlap(rows, rows_per_block, overlap)
+            for c in split_with_overlap(cols, cols_per_block, overlap)]
+
+
+def _stitch_block(block_idx, input_dir, output_file, config, grid_index, jobs, resources=None):
+    """1ブロック分のマッチングと局所最適化 (ワーカーで実行する)
+
+    resources: AdvancedStitcher に渡す資源。省略時はワーカーの初期化で設定したもの (共有ストア)
+    戻り値: (block_idx, pairwise_matches, failed_pairs, ブロック内の座標 or None, カウンター)
+    """
+    stitcher = AdvancedStitcher(input_dir, output_file, None, config, grid_index=grid_index,
+                                resources=resources or _worker_resources)
+    try:
+        stitcher.calculate_all_pairwise_matches(jobs)
+    finally:
+        if stitcher.tile_store is not None:
+            stitcher.release_tile_store()
+    keys = {k for job in jobs for k in job[:2] if k in grid_index.file_map}
+    positions = None
+    try:
+        stitcher.estimate_initial_positions()
+        stitcher.positions = {k: v for k, v in stitcher.positions.items() if k in keys}
+        stitcher.run_global_optimization()
+        positions = stitcher.positions
+    except Exception:
+        # 水平/垂直のマッチングが無いブロック (無地ばかり等)。統合時は全体の格子の初期位置を使う
+        pass
+    return block_idx, stitcher.pairwise_matches, stitcher.failed_pairs, positions, dict(stitcher.metrics.counters)
+
+
+def solve_block_offsets(block_positions):
+    """共有タイルの座標の差から、各ブロックを全体の座標系に移す平行移動を求める
+
+    block_positions: [ブロック内の座標 {key: (x, y)} or None]
+    戻り値: [(tx, ty) or None]。最初に座標のあるブロックを基準 (0, 0) とし、
+    基準とつながらないブロックは None
+    """
+    valid = [i for i, p in enumerate(block_positions) if p]
+    if not valid:
+        return [None] * len(block_positions)
+    # 共有タイルでつながっているブロックを、基準ブロックから辿る
+    shared = {}
+    for a_pos, a in enumerate(valid):
+        for b in valid[a_pos + 1:]:
+            common = block_positions[a].keys() & block_positions[b].keys()
+            if common:
+                shared[(a, b)] = common
+    connected, frontier = {valid[0]}, [valid[0]]
+    while frontier:
+        i = frontier.pop()
+        for (a, b) in shared:
+            for x, y in [(a, b), (b, a)]:
+                if x == i and y not in connected:
+                    connected.add(y)
+                    frontier.append(y)
+    blocks = [i for i in valid if i in connected]
+    col = {i: n for n, i in enumerate(blocks)}
+
+    # 共有タイル t ごとに T_b - T_a = p_a(t) - p_b(t)。基準ブロックは T = 0 に固定する
+    A_rows, b_rows = [], []
+    for (a, b), common in shared.items():
+        if a not in col or b not in col:
+            continue
+        for key in common:
+            row = np.zeros(len(blocks))
+            row[col[b]] = 1.0
+            row[col[a]] = -1.0
+            A_rows.append(row)
+            b_rows.append(np.subtract(block_positions[a][key], block_positions[b][key]))
+    fix = np.zeros(len(blocks))
+    fix[0] = 1.0
+    A_rows.append(fix)
+    b_rows.append(np.zeros(2))
+    T = np.linalg.lstsq(np.array(A_rows), np.array(b_rows, dtype=float), rcond=None)[0]
+
+    offsets = [None] * len(block_positions)
+    for i, n in col.items():
+        offsets[i] = (float(T[n, 0]), float(T[n, 1]))
+    return offsets
+
+
+class BlockStitcher(AdvancedStitcher):
+    """AdvancedStitcher と同じ使い方で、マッチングと局所最適化をブロックごとに並列に行う"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rows_per_block = int(self.config.get("rows_per_block", 10))
+        self.cols_per_block = int(self.config.get("cols_per_block", 0))  # 0 は列方向に分けない
+        self.block_overlap = max(1, int(self.config.get("block_overlap", 1)))
+        self.block_workers = int(self.config.get("block_workers", 0))
+        if self.block_workers <= 0:
+            self.block_workers = os.cpu_count() or 1
+        self._block_positions = None
+
+    def plan_blocks(self):
+        return plan_blocks(self.grid_info["rows"], self.grid_info["cols"],
+                           self.rows_per_block, self.cols_per_block, self.block_overlap)
+
+    def calculate_all_pairwise_matches(self, jobs=None):
+        blocks = self.plan_blocks()
+        if jobs is not None or len(blocks) <= 1:
+            return super().calculate_all_pairwise_matches(jobs)
+
+        self._update_status("status", "隣接ペアのリストを作成中...")
+        jobs = self.build_pair_jobs()
+        if not jobs:
+            raise ValueError("マッチング対象の画像ペアが見つかりません。")
+        if self.checkpoints and self._resumed:
+            saved = self.checkpoints.load_matches()
+            if saved and saved[0] >= len(jobs):
+                # マッチングは完了済み。ブロックの座標も読み込み、中断しなかった場合と同じ初期値で全体最適化する
+                # (ブロックの座標が無い古いチェックポイントでは、格子の初期位置から最適化する)
+                _, self.pairwise_matches, self.failed_pairs = saved
+                self._block_positions = self.checkpoints.load_block_positions()
+                self._update_status("status", f"マッチング済みの {len(jobs)} ペアを読み込みました。")
+                return
+
+        # 両端のタイルがブロックに含まれるペアをそのブロックに割り当てる (共有する行/列のペアは両方で処理する)
+        block_jobs = []
+        for block_rows, block_cols in blocks:
+            rs, cs = set(block_rows), set(block_cols)
+            block_jobs.append([j for j in jobs if all(k[0] in rs and k[1] in cs for k in j[:2])])
+        tasks = [(i, self.input_dir, self.output_file, self.config, self.grid_index, bj)
+                 for i, bj in enumerate(block_jobs) if bj]
+        self.metrics.count("blocks", len(tasks))
+
+        workers = min(self.block_workers, len(tasks))
+        self._update_status("status", f"{len(tasks)} ブロックに分けてマッチング中 ({len(jobs)}ペア, {workers}プロセス)...")
+        results = [None] * len(block_jobs)
+        for done, result in enumerate(self._map_blocks(tasks, workers), 1):
+            results[result[0]] = result
+            self._update_status("status", f"ブロック {done}/{len(tasks)} の処理が完了しました。")
+            self._update_status("progress", int(done / len(tasks) * 50))
+
+        # 同じペアは複数のブロックで処理しても同じ結果になるので、どれか1つを採用する
+        self._block_positions = []
+        for result in results:
+            if result is None:
+                continue
+            _, matches, failed, positions, counters = result
+            self.failed_pairs.update(failed)
+            self.pairwise_matches.update(matches)
+            self._block_positions.append(positions)
+            for name, n in counters.items():
+                self.metrics.count(name, n)
+        for pair in self.pairwise_matches:
+            self.failed_pairs.pop(pair, None)
+        # ブロックの座標はマッチング結果より先に保存する (マッチングが完了済みなら必ずブロックの座標もある)
+        if self.checkpoints:
+            self.checkpoints.save_block_positions(self._block_positions)
+        self._checkpoint_matches(len(jobs))
+
+    def _map_blocks(self, tasks, workers):
+        # 常駐サービスのワーカーなど daemon プロセスの中では子プロセスを作れないので、順に処理する
+        # (同じプロセスなので、画像キャッシュをブロック間で使い回す)
+        if workers <= 1 or multiprocessing.current_process().daemon:
+            for task in tasks:
+                self._check_cancel()
+                yield _stitch_block(*task, resources={"gray_cache": self._gray_cache})
+            return
+        store = self._create_tile_store(tasks)
+        pool = multiprocessing.Pool(workers, initializer=_init_block_worker,
+                                    initargs=(store.handle() if store else None,))
+        try:
+            pending = [pool.apply_async(_stitch_block, task) for task in tasks]
+            while pending:
+                for res in [p for p in pending if p.ready()]:
+                    pending.remove(res)
+                    yield res.get()
+                if pending:
+                    if self.cancel_event is not None and self.cancel_event.is_set():
+                        pool.terminate()
+                        self._check_cancel()
+                    pending[0].wait(0.2)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            if store:
+                store.close()
+                store.unlink()
+
+    def _create_tile_store(self, tasks):
+        """ブロックのワーカーで共有するタイルのストアを作る (全タイルか shared_tile_store_mb に収まる枚数)"""
+        budget_mb = self.config.get("shared_tile_store_mb", 512)
+        if not budget_mb:
+            return None
+        h, w = self.base_image_shape[:2]
+        tiles = {k for task in tasks for job in task[5] for k in job[:2]}
+        slots = min(len(tiles), int(budget_mb * 1024 * 1024 // (h * w)))
+        if slots < 1:
+            return None
+        try:
+            return SharedTileStore.create(h * w, slots)
+        except OSError as e:
+            self._update_status("status", f"共有メモリを確保できませんでした。タイルを共有せずに処理します: {e}")
+            return None
+
+    def run_global_optimization(self, initial_guess=None):
+        if initial_guess is not None or not self._block_positions:
+            return super().run_global_optimization(initial_guess)
+
+        self._update_status("status", "ブロックの座標を統合中...")
+        offsets = solve_block_offsets(self._block_positions)
+        sums = {}
+        for positions, offset in zip(self._block_positions, offsets):
+            if offset is None:
+                continue
+            for key, (x, y) in positions.items():
+                s = sums.setdefault(key, [0.0, 0.0, 0])
+                s[0] += x + offset[0]
+                s[1] += y + offset[1]
+                s[2] += 1
+        merged = {key: (sx / n, sy / n) for key, (sx, sy, n) in sums.items()}
+        if not merged:
+            return super().run_global_optimization()
+
+        # 全体最適化は最初のタイルを原点に固定するので、統合した座標もその座標系に合わせる
+        # (最初のタイルの座標が無ければ、格子の初期位置との差の中央値で合わせる)
+        first = min(self.positions)
+        if first in merged:
+            shift = np.subtract(self.positions[first], merged[first])
+        else:
+            keys = [k for k in merged if k in self.positions]
+            shift = np.median([np.subtract(self.positions[k], merged[k]) for k in keys], axis=0)
+        merged = {k: (x + shift[0], y + shift[1]) for k, (x, y) in merged.items()}
+        return super().run_global_optimization(initial_guess=merged)
+
+
+def stitcher_class_for(config):
+    """設定に合わせて AdvancedStitcher か BlockStitcher を返す (block_workers が 0 以外ならブロック分割)"""
+    return BlockStitcher if (config or {}).get("block_workers") else AdvancedStitcher
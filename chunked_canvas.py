@@ -0,0 +1,186 @@
+# chunked_canvas.py
+# タイルが触れた部分だけをディスクに確保する、疎なキャンバス
+#
+# キャンバスを chunk x chunk px の正方形 (チャンク) に分け、タイルを書き込んだときに初めてチャンクを確保する。
+# チャンクは1つのファイルに確保した順に並べ、1チャンクは「カラー (chunk*chunk*3) + 形状マスク (chunk*chunk、weighted なら uint16)」。
+# 1度も書き込まれないチャンク (L字型の撮影、範囲内の穴、斜めのずれで広がった外接矩形の隅など) は
+# ファイルに存在せず、読み出すときに背景色 (マスクは 0) として扱う。
+# そのため一時ファイルの大きさとページキャッシュの使用量は、外接矩形ではなくタイルが覆う面積に比例する。
+# どのチャンクがファイルのどこにあるかは <path>.idx (JSON) に書き、flush() 後なら open() で続きから描ける。
+#
+# フェザーブレンド (paste の weight) では、形状マスクを「その画素に描いた重みの合計」として使う。
+# すでに描かれた画素とだけ (old*W + img*w) / (W + w) で混ぜるので、キャンバス全体の浮動小数点の累積バッファは要らない。
+# 重みの合計は 255 を超えるので、ブレンドするキャンバスは weighted=True で作り、マスクを uint16 で持つ
+# (3枚以上重なる画素でも、重みの合計が頭打ちにならず描画順によらない加重平均になる)。
+# 重みは重なりの部分だけでなく、タイルが触れたチャンクの全画素に持つ。そのため一時ファイルは 1画素 5バイト
+# (色 3 + 重み 2。ブレンドしないときは 4) になる。メモリ上に開くのは max_open 個のチャンクまでなので、
+# メモリの使用量はキャンバスの大きさによらず max_open * chunk^2 * 5 バイト以下 (既定で 320MB) に収まる。
+import json
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def feather_weights(h, w, width):
+    """タイルの端からの距離で width px かけて 1-255 に増える重み (uint8)"""
+    bw = max(1, int(width))
+    ramp_y = np.minimum(np.arange(h), np.arange(h)[::-1]) + 1
+    ramp_x = np.minimum(np.arange(w), np.arange(w)[::-1]) + 1
+    dist = np.minimum(ramp_y[:, None], ramp_x[None, :])
+    return np.clip(dist * 255 // bw, 1, 255).astype(np.uint8)
+
+
+def blend_into(dest, acc, img, weight):
+    """dest (h, w, 3) に img を重み weight で混ぜ、acc (その画素の重みの合計) に weight を足す
+
+    acc が 0 の画素は img (weight > 0 の画素だけ) になる。acc の dtype の最大値で頭打ちにする。
+    """
+    if not acc.any():
+        # まだ何も描かれていない範囲は、重みのある画素をそのまま書く
+        visible = weight > 0
+        dest[visible] = img[visible]
+        acc[:] = weight
+        return
+    # (old*W + img*w) / (W + w)。W に小さな値を足して、w が 0 の画素 (描かない画素) は元の色のままにする
+    W = acc.astype(np.float32)
+    dest[:] = cv2.blendLinear(np.ascontiguousarray(dest), np.ascontiguousarray(img), W + 1e-3, weight.astype(np.float32))
+    if np.issubdtype(acc.dtype, np.integer):
+        acc[:] = np.minimum(W + weight, np.iinfo(acc.dtype).max).astype(acc.dtype)
+    else:
+        acc += weight
+
+
+class ChunkedCanvas:
+    def __init__(self, path, height, width, chunk=1024, background=255, max_open=64, slots=None, weighted=False):
+        self.path = path
+        self.height, self.width = int(height), int(width)
+        self.chunk = int(chunk)
+        self.background = background
+        self.max_open = max_open
+        self.weighted = bool(weighted)
+        self.mask_dtype = np.dtype(np.uint16 if self.weighted else np.uint8)
+        self.slots = dict(slots or {})  # {(chunk_y, chunk_x): ファイル内の番号}
+        self._open = OrderedDict()  # 開いているチャンクの memmap (color, mask)。古いものから閉じる
+        self._slot_bytes = self.chunk * self.chunk * (3 + self.mask_dtype.itemsize)
+        if slots is None:
+            open(path, "wb").close()
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """flush() 済みのキャンバスを開き直す"""
+        with open(path + ".idx", "r", encoding="utf-8") as f:
+            idx = json.load(f)
+        slots = {tuple(k): n for k, n in idx["slots"]}
+        return cls(path, idx["height"], idx["width"], chunk=idx["chunk"], slots=slots,
+                   weighted=idx.get("weighted", False), **kwargs)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path) and os.path.exists(path + ".idx")
+
+    @property
+    def allocated_bytes(self):
+        return len(self.slots) * self._slot_bytes
+
+    def _chunk(self, cy, cx, create):
+        key = (cy, cx)
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+        if key not in self.slots:
+            if not create:
+                return None
+            # ファイルを1チャンク分伸ばす (伸ばした部分は 0 なので、マスクの初期化は不要)
+            self.slots[key] = len(self.slots)
+            with open(self.path, "r+b") as f:
+                f.truncate(len(self.slots) * self._slot_bytes)
+            created = True
+        else:
+            created = False
+        offset = self.slots[key] * self._slot_bytes
+        c = self.chunk
+        color = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=offset, shape=(c, c, 3))
+        mask = np.memmap(self.path, dtype=self.mask_dtype, mode="r+", offset=offset + c * c * 3, shape=(c, c))
+        if created:
+            color[:] = self.background
+        self._open[key] = (color, mask)
+        if len(self._open) > self.max_open:
+            _, (old_color, old_mask) = self._open.popitem(last=False)
+            old_color.flush(); old_mask.flush()
+        return color, mask
+
+    def _spans(self, y0, y1, x0, x1):
+        """矩形 [y0, y1) x [x0, x1) が掛かるチャンクごとに (cy, cx, チャンク内の範囲, 矩形内の範囲) を返す"""
+        c = self.chunk
+        for cy in range(y0 // c, (y1 - 1) // c + 1):
+            sy0, sy1 = max(y0, cy * c), min(y1, (cy + 1) * c)
+            for cx in range(x0 // c, (x1 - 1) // c + 1):
+                sx0, sx1 = max(x0, cx * c), min(x1, (cx + 1) * c)
+                yield cy, cx, (slice(sy0 - cy * c, sy1 - cy * c), slice(sx0 - cx * c, sx1 - cx * c)), \
+                    (slice(sy0 - y0, sy1 - y0), slice(sx0 - x0, sx1 - x0))
+
+    def paste(self, y, x, img, visible=None, weight=None):
+        """img (h, w, 3) を (y, x) に書き込む。visible (h, w) の bool を渡すと、その画素だけを書く
+
+        weight (h, w) の uint8 (0 は描かない) を渡すと上書きせず、すでに描かれた画素と重みで混ぜる。
+        はみ出した部分は呼び出し側で切り取っておくこと。
+        """
+        h, w = img.shape[:2]
+        for cy, cx, dst, src in self._spans(y, y + h, x, x + w):
+            color, mask = self._chunk(cy, cx, create=True)
+            if weight is not None:
+                blend_into(color[dst], mask[dst], img[src], weight[src])
+            elif visible is None:
+                color[dst] = img[src]
+                mask[dst] = 255
+            else:
+                v = visible[src]
+                color[dst][v] = img[src][v]
+                mask[dst][v] = 255
+
+    def bounds(self):
+        """描画された画素を囲む矩形 (y0, y1, x0, x1) (y1, x1 は含まない)。何も無ければ None"""
+        ys, xs = [], []
+        for cy, cx in self.slots:
+            _, mask = self._chunk(cy, cx, create=False)
+            rows = np.flatnonzero(mask.any(axis=1))
+            if rows.size == 0:
+                continue
+            cols = np.flatnonzero(mask.any(axis=0))
+            ys += [cy * self.chunk + rows[0], cy * self.chunk + rows[-1] + 1]
+            xs += [cx * self.chunk + cols[0], cx * self.chunk + cols[-1] + 1]
+        if not ys:
+            return None
+        return (int(min(ys)), min(int(max(ys)), self.height), int(min(xs)), min(int(max(xs)), self.width))
+
+    def read(self, y0, y1, x0, x1):
+        """矩形を通常の配列として読み出す。確保されていないチャンクは背景色"""
+        out = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+        out[:] = self.background
+        for cy, cx, src, dst in self._spans(y0, y1, x0, x1):
+            chunk = self._chunk(cy, cx, create=False)
+            if chunk is not None:
+                out[dst] = chunk[0][src]
+        return out
+
+    def flush(self):
+        for color, mask in self._open.values():
+            color.flush(); mask.flush()
+        tmp = self.path + ".idx.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"height": self.height, "width": self.width, "chunk": self.chunk, "weighted": self.weighted,
+                       "slots": [[list(k), n] for k, n in self.slots.items()]}, f)
+        os.replace(tmp, self.path + ".idx")
+
+    def close(self):
+        for color, mask in self._open.values():
+            color.flush(); mask.flush()
+        self._open.clear()
+
+    def remove(self):
+        self.close()
+        for f in [self.path, self.path + ".idx"]:
+            if os.path.exists(f):
+                os.remove(f)
@@ -8,13 +8,35 @@ DEFAULT_CONFIG = {
     "save_folder": os.path.join(os.getcwd(), "map_screenshots"),
     "dpi": 300,
     "png_compress_level": 1,
+    "tile_format": "png",
+    "capture_container": False,
     "current_row": 1,
     "key_right_presses": 5,
     "key_down_presses": 5,
+    "pan_method": "keys",
+    "pan_overlap_h_pct": 60,
+    "pan_overlap_v_pct": 40,
+    "drag_duration": 0.3,
+    "pan_gain": None,
     "auto_cols": 10,
     "auto_rows": 10,
     "auto_delay": 1.5,
-    "rows_per_block": 10
+    "stuck_check": True,
+    "stuck_action": "pause",
+    "rows_per_block": 10,
+    "block_workers": 0,
+    "range_halo": 1,
+    "orb_guide_radius": 48,
+    "v_template_width_pct": 50,
+    "v_max_drift_px": 64,
+    "auto_calibrate": False,
+    "calibration_pairs": 12,
+    "adaptive_pairs": False,
+    "adaptive_sample_pct": 20,
+    "adaptive_tolerance_px": 4,
+    "blend": False,
+    "blend_width": 64,
+    "use_stitch_service": False
 }
 
 def load_config():
@@ -0,0 +1,155 @@
+# grid_index.py
+# 入力フォルダのタイル一覧 (グリッド) を軽量に作る
+#
+# os.scandir を1回だけ回して (r, c) -> パス の対応を作り、タイルの大きさは
+# PNG の IHDR などファイルの先頭だけを読んで求める (画像全体はデコードしない)。
+# GUI で結合前の検証に使い、作ったインデックスはそのままワーカーに渡して再利用する。
+import os
+import struct
+
+import tile_formats
+import tile_container
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG のカラータイプ -> cv2.IMREAD_UNCHANGED で読み込んだときのチャンネル数
+# (グレー+アルファは BGRA に変換される。パレットは tRNS の有無で変わるためデコードして調べる)
+_PNG_CHANNELS = {0: 1, 2: 3, 4: 4, 6: 4}
+
+
+def _shape_from_channels(h, w, ch):
+    return (h, w) if ch == 1 else (h, w, ch)
+
+
+def read_tile_shape(path):
+    """タイルの形状 (h, w[, ch]) を、できるだけファイルの先頭だけを読んで返す"""
+    if tile_container.is_container_ref(path):
+        folder, r, c = tile_container.parse_ref(path)
+        return tile_container.open_container(folder).shape(r, c)
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        with open(path, "rb") as f:
+            head = f.read(33)
+        if head[:8] == _PNG_SIGNATURE and head[12:16] == b"IHDR":
+            w, h, _depth, color_type = struct.unpack(">IIBB", head[16:26])
+            if color_type in _PNG_CHANNELS:
+                return _shape_from_channels(h, w, _PNG_CHANNELS[color_type])
+    elif ext == ".npy":
+        import numpy as np
+        return tuple(np.load(path, mmap_mode="r", allow_pickle=False).shape)  # ヘッダーのみ読む
+    elif ext == ".qoi":
+        with open(path, "rb") as f:
+            head = f.read(14)
+        if head[:4] == b"qoif":
+            w, h, ch = struct.unpack(">IIB", head[4:13])
+            return _shape_from_channels(h, w, ch)
+
+    from advanced_stitcher import imread_safe  # ヘッダーで判定できない形式 (WebP 等) のみデコードする
+    img = imread_safe(path)
+    if img is None:
+        raise ValueError(f"基準画像の読み込みに失敗しました: {path}")
+    return img.shape
+
+
+class GridIndex:
+    """入力フォルダのタイル一覧。プロセス間で受け渡せるよう単純な属性だけを持つ"""
+
+    def __init__(self, input_dir, file_map, has_container, tile_shape=None):
+        self.input_dir = input_dir
+        self.file_map = file_map  # (r, c) -> パス (コンテナ内のタイルは仮想パス)
+        self.has_container = has_container
+        rows = sorted({r for r, _ in file_map})
+        cols = sorted({c for _, c in file_map})
+        self.grid_info = None
+        if rows and cols:
+            self.grid_info = {"min_r": rows[0], "max_r": rows[-1], "min_c": cols[0], "max_c": cols[-1],
+                              "rows": rows, "cols": cols}
+        self._tile_shape = tile_shape
+
+    @property
+    def tile_shape(self):
+        """基準タイル (最小の R, C) の形状。初回のみヘッダーを読む"""
+        if self._tile_shape is None and self.file_map:
+            self._tile_shape = read_tile_shape(self.file_map[min(self.file_map)])
+        return self._tile_shape
+
+    def active_area(self, stitch_range=None, halo=0):
+        """部分結合で扱う (行リスト, 列リスト)。stitch_range の外側 halo 行/列も含める"""
+        rows, cols = self.grid_info["rows"], self.grid_info["cols"]
+        if not stitch_range:
+            return rows, cols
+
+        def _window(items, lo, hi):
+            idx = [i for i, v in enumerate(items) if lo <= v <= hi]
+            return items[max(0, idx[0] - halo):idx[-1] + halo + 1] if idx else []
+
+        return (_window(rows, stitch_range["r_min"], stitch_range["r_max"]),
+                _window(cols, stitch_range["c_min"], stitch_range["c_max"]))
+
+    def missing(self, rows=None, cols=None):
+        """グリッド (rows, cols を指定すればその範囲) の中で欠けている (r, c) の一覧"""
+        if not self.grid_info:
+            return []
+        rows = self.grid_info["rows"] if rows is None else rows
+        cols = self.grid_info["cols"] if cols is None else cols
+        return [(r, c) for r in rows for c in cols if (r, c) not in self.file_map]
+
+    def verify(self, rows=None, cols=None):
+        missing = self.missing(rows, cols)
+        if missing:
+            names = [f"R{r:02d}_C{c:02d}" for r, c in missing[:5]]
+            raise ValueError(f"画像ファイルが{len(missing)}件見つかりません。\n"
+                             "撮影が不完全であるか、入力フォルダが正しくありません。\n\n"
+                             "見つからないファイル (最初の5件):\n" + "\n".join(names))
+        return True
+
+    def estimate_canvas_size(self, overlap_h_pct=60, overlap_v_pct=40, stitch_range=None):
+        """重なり率から、最終画像のおおよその大きさ (幅, 高さ) を求める"""
+        rows, cols = self.grid_info["rows"], self.grid_info["cols"]
+        if stitch_range:
+            rows = [r for r in rows if stitch_range["r_min"] <= r <= stitch_range["r_max"]] or rows
+            cols = [c for c in cols if stitch_range["c_min"] <= c <= stitch_range["c_max"]] or cols
+        h, w = self.tile_shape[:2]
+        width = w + (len(cols) - 1) * w * (1 - overlap_h_pct / 100.0)
+        height = h + (len(rows) - 1) * h * (1 - overlap_v_pct / 100.0)
+        return int(round(width)), int(round(height))
+
+
+def build_grid_index(input_dir):
+    """フォルダを1回走査して GridIndex を作る"""
+    file_map = {}
+    mtimes = {}
+    has_container = False
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            name = entry.name
+            if name == tile_container.CONTAINER_INDEX:
+                has_container = True
+                continue
+            parsed = tile_formats.parse_tile_filename(name)
+            if parsed is None:
+                continue
+            r, c, _ = parsed
+            prev = file_map.get((r, c))
+            if prev is not None:
+                # 同じ位置に複数形式のファイルがある場合 (撮り直し時に形式を変えた等) は新しい方を採用する
+                if prev not in mtimes:
+                    mtimes[prev] = os.path.getmtime(prev)
+                mtime = entry.stat().st_mtime
+                if mtime <= mtimes[prev]:
+                    continue
+                mtimes[entry.path] = mtime
+            file_map[(r, c)] = entry.path
+    if has_container:
+        # 単一ファイルのタイルコンテナ (tiles.dat + tiles.idx) のタイル。同じ位置に個別のファイルもある場合
+        # (コンテナに保存した後で、撮り直しを個別のファイルに保存した等) は新しい方を採用する
+        container = tile_container.open_container(input_dir)
+        for r, c in container.keys():
+            path = file_map.get((r, c))
+            if path is not None:
+                if path not in mtimes:
+                    mtimes[path] = os.path.getmtime(path)
+                if mtimes[path] > container.saved_time(r, c):
+                    continue
+            file_map[(r, c)] = tile_container.make_ref(input_dir, r, c)
+    return GridIndex(input_dir, file_map, has_container)
@@ -1,7 +1,16 @@
 # main_app.py
 
+# --- 起動時間の計測モード (python main_app.py --startup-time) ---
+# 各モジュールの読み込み時間を測るため、他の import より先にフックを入れる
+import sys
+STARTUP_TIMING = "--startup-time" in sys.argv
+if STARTUP_TIMING:
+    import startup_timer
+    startup_timer.install()
+
 # --- 標準ライブラリ ---
 import os
+import json
 import time
 import threading
 import tkinter as tk
@@ -11,19 +20,37 @@ import ctypes
 import platform # OS判定用
 
 # --- 外部ライブラリ ---
-import cv2
-cv2.ocl.setUseOpenCL(False)
-
-import pyautogui
+# cv2 / numpy / pyautogui と結合エンジン (stitcher_app -> advanced_stitcher) は
+# 起動を速くするため、最初に使うときに読み込む
 import keyboard
 
 import gc
-import numpy as np
 
 # --- 自作モジュール ---
 import config_manager
+import tile_formats
+import panning
 from utils import open_folder_in_explorer
-from stitcher_app import StitcherApp
+
+if STARTUP_TIMING:
+    startup_timer.mark("main_app imports")
+
+_cv2 = None
+
+def import_cv2():
+    """cv2 を初回の呼び出し時に読み込んで返す"""
+    global _cv2
+    if _cv2 is None:
+        import cv2
+        cv2.ocl.setUseOpenCL(False)
+        _cv2 = cv2
+    return _cv2
+
+def screenshot_to_bgr(screenshot):
+    """pyautogui (PIL) のスクリーンショットを BGR 配列に変換する"""
+    import numpy as np
+    cv2 = import_cv2()
+    return cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
 
 # --- 翻訳辞書 ---
 TRANSLATIONS = {
@@ -42,6 +69,11 @@ TRANSLATIONS = {
         "lbl_right": "右移動(回):",
         "lbl_down": "下移動(回):",
         "lbl_delay": "間隔(秒):",
+        "lbl_format": "保存形式:",
+        "chk_container": "1ファイルにまとめる",
+        "lbl_pan": "移動方式:",
+        "lbl_pan_over_h": "ドラッグ時の横重なり(%):",
+        "lbl_pan_over_v": "ドラッグ時の縦重なり(%):",
         "step3": "3.実行",
         "hint_start": "開始5秒内にブラウザをクリック",
         "btn_start": "▶ 開始",
@@ -53,6 +85,12 @@ TRANSLATIONS = {
         "btn_next": "次の行へ (x)",
         "btn_prev": "前の行へ (c)",
         "btn_reset": "リセット",
+        "btn_retake": "撮り直し (リスト読込)",
+        "status_retake": "撮り直し",
+        "msg_retake_empty": "撮り直し対象のタイルがありません。",
+        "msg_retake_start": "撮り直しは R1_C1 の位置から移動します。\nブラウザに R1_C1 と同じ位置を表示してから OK を押してください (5秒後に開始します)。",
+        "msg_stuck": "R{r}-C{c}: 移動しても画面が変わりません (ブラウザのフォーカスや地図の端を確認してください)。\n再試行で移動と撮影をやり直します。",
+        "msg_duplicate": "R{r}-C{c}: 以前と同じ画面が撮影されました。\n再試行で移動と撮影をやり直します。",
         "stitch_desc": "画像結合\nツール",
         "btn_stitch_open": "ツールを開く",
         "msg_reset": "リセットしますか？",
@@ -78,6 +116,11 @@ TRANSLATIONS = {
         "lbl_right": "Right(→):",
         "lbl_down": "Down(↓):",
         "lbl_delay": "Delay(s):",
+        "lbl_format": "Format:",
+        "chk_container": "Single container",
+        "lbl_pan": "Pan:",
+        "lbl_pan_over_h": "Drag Overlap H(%):",
+        "lbl_pan_over_v": "Drag Overlap V(%):",
         "step3": "3.Run",
         "hint_start": "Click Map in 5s",
         "btn_start": "▶ Run",
@@ -89,6 +132,12 @@ TRANSLATIONS = {
         "btn_next": "↓ Next (x)",
         "btn_prev": "↑ Prev (c)",
         "btn_reset": "Reset",
+        "btn_retake": "Retake (Load List)",
+        "status_retake": "Retake",
+        "msg_retake_empty": "No tiles to retake.",
+        "msg_retake_start": "Retakes pan from the R1_C1 position.\nShow the same view as R1_C1 in the browser, then press OK (starts in 5 seconds).",
+        "msg_stuck": "R{r}-C{c}: The view did not move after panning (check browser focus or the map edge).\nRetry pans and shoots again.",
+        "msg_duplicate": "R{r}-C{c}: Captured the same view as an earlier tile.\nRetry pans and shoots again.",
         "stitch_desc": "Stitcher\nTool",
         "btn_stitch_open": "Open Tool",
         "msg_reset": "Reset counters?",
@@ -152,6 +201,7 @@ class Application(ttk.Frame):
         
         self.shot_col_count = 1
         self.automation_running = False
+        self.last_frame = None
         self.is_manual_open = False
 
         self.setup_window()
@@ -318,9 +368,31 @@ class Application(ttk.Frame):
         self.key_down_var = tk.StringVar(value=self.config.get('key_down_presses', 5))
         add_mini_input(step2_frame, self.t('lbl_down'), self.key_down_var)
 
+        pan_f = ttk.Frame(step2_frame)
+        pan_f.pack(fill="x", pady=1)
+        ttk.Label(pan_f, text=self.t('lbl_pan'), style="Small.TLabel").pack(anchor="w")
+        self.pan_method_var = tk.StringVar(value=self.config.get('pan_method', 'keys'))
+        ttk.Combobox(pan_f, textvariable=self.pan_method_var, values=panning.PAN_METHODS, state="readonly").pack(fill="x")
+
+        self.pan_over_h_var = tk.StringVar(value=self.config.get('pan_overlap_h_pct', 60))
+        add_mini_input(step2_frame, self.t('lbl_pan_over_h'), self.pan_over_h_var)
+
+        self.pan_over_v_var = tk.StringVar(value=self.config.get('pan_overlap_v_pct', 40))
+        add_mini_input(step2_frame, self.t('lbl_pan_over_v'), self.pan_over_v_var)
+
+        ttk.Separator(step2_frame, orient="horizontal").pack(fill="x", pady=3)
+
         self.auto_delay_var = tk.StringVar(value=self.config.get('auto_delay', 1.5))
         add_mini_input(step2_frame, self.t('lbl_delay'), self.auto_delay_var)
 
+        fmt_f = ttk.Frame(step2_frame)
+        fmt_f.pack(fill="x", pady=1)
+        ttk.Label(fmt_f, text=self.t('lbl_format'), style="Small.TLabel").pack(anchor="w")
+        self.tile_format_var = tk.StringVar(value=self.config.get('tile_format', 'png'))
+        ttk.Combobox(fmt_f, textvariable=self.tile_format_var, values=tile_formats.available_formats(), state="readonly").pack(fill="x")
+        self.container_var = tk.BooleanVar(value=self.config.get('capture_container', False))
+        ttk.Checkbutton(fmt_f, text=self.t('chk_container'), variable=self.container_var).pack(anchor="w")
+
         # --- Step 3 ---
         step3_frame = ttk.LabelFrame(scrollable_frame, text=self.t('step3'), style="Step.TLabelframe", padding=2)
         step3_frame.pack(fill="x", pady=2, padx=2)
@@ -348,6 +420,7 @@ class Application(ttk.Frame):
         ttk.Button(self.manual_frame, text=self.t('btn_next'), command=self.go_to_next_row).pack(fill="x", pady=1)
         ttk.Button(self.manual_frame, text=self.t('btn_prev'), command=self.go_to_previous_row).pack(fill="x", pady=1)
         ttk.Button(self.manual_frame, text=self.t('btn_reset'), command=self.reset_counters).pack(fill="x", pady=3)
+        ttk.Button(self.manual_frame, text=self.t('btn_retake'), command=self.start_retake).pack(fill="x", pady=1)
 
     def create_stitcher_tab(self):
         stitcher_frame = ttk.Frame(self.notebook, padding="5")
@@ -382,7 +455,8 @@ class Application(ttk.Frame):
         self.region_label.config(text=f"{r[2]}x{r[3]} (x{r[0]},y{r[1]})")
 
     def open_stitcher_window(self):
-        StitcherApp(self, config=self.config)
+        from stitcher_app import StitcherApp
+        return StitcherApp(self, config=self.config)
 
     def open_save_folder(self):
         open_folder_in_explorer(self.config['save_folder'])
@@ -422,7 +496,10 @@ class Application(ttk.Frame):
         try:
             os.makedirs(self.config['save_folder'], exist_ok=True)
             r, c = (row, col) if is_auto else (self.config['current_row'], self.shot_col_count)
-            filename = os.path.join(self.config['save_folder'], f"R{r:02d}_C{c:02d}.png")
+            if not is_auto:
+                self.config['tile_format'] = self.tile_format_var.get()
+                self.config['capture_container'] = self.container_var.get()
+            filename = os.path.join(self.config['save_folder'], tile_formats.tile_filename(r, c, self.config.get('tile_format', 'png')))
             
             if not is_auto:
                 self.master.withdraw()
@@ -436,19 +513,36 @@ class Application(ttk.Frame):
 
     def capture_and_show(self, filename, is_auto, retry_count=0):
         try:
+            import pyautogui
             screenshot = pyautogui.screenshot(region=tuple(self.config['region']))
+            img_cv = None
 
             if is_auto:
-                img_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-                mean_color = cv2.mean(img_cv)[:3]
+                img_cv = screenshot_to_bgr(screenshot)
+                mean_color = import_cv2().mean(img_cv)[:3]
                 if all(c > 250 for c in mean_color) or all(120 < c < 140 for c in mean_color):
                     if retry_count < 3:
                         print(f"Retry {retry_count}...")
                         time.sleep(2.0)
                         return self.capture_and_show(filename, is_auto, retry_count + 1)
 
-            screenshot.save(filename, dpi=(self.config['dpi'], self.config['dpi']), compress_level=self.config['png_compress_level'])
+            fmt = self.config.get('tile_format', 'png')
+            if self.config.get('capture_container', False):
+                # コンテナ (tiles.dat + tiles.idx) に追記する。npy 指定時は無圧縮(raw)で格納
+                import tile_container
+                r, c, _ = tile_formats.parse_tile_filename(os.path.basename(filename))
+                if img_cv is None: img_cv = screenshot_to_bgr(screenshot)
+                with tile_container.TileContainerWriter(os.path.dirname(filename), 'raw' if fmt == 'npy' else fmt, self.config['png_compress_level']) as writer:
+                    writer.add(r, c, img_cv)
+            elif fmt == 'png':
+                screenshot.save(filename, dpi=(self.config['dpi'], self.config['dpi']), compress_level=self.config['png_compress_level'])
+            else:
+                # PNG以外はBGR配列に変換して高速デコード形式で保存する
+                if img_cv is None: img_cv = screenshot_to_bgr(screenshot)
+                tile_formats.write_tile(filename, img_cv, fmt, self.config['png_compress_level'])
             print(f"Saved: {os.path.basename(filename)}")
+            if is_auto:
+                self.last_frame = img_cv  # ドラッグ移動の補正に使う
             if not is_auto:
                 self.shot_col_count += 1
                 messagebox.showinfo(self.t('msg_done'))
@@ -469,8 +563,12 @@ class Application(ttk.Frame):
             delay = float(self.auto_delay_var.get())
             key_right = int(self.key_right_var.get())
             key_down = int(self.key_down_var.get())
+            pan_over_h = float(self.pan_over_h_var.get())
+            pan_over_v = float(self.pan_over_v_var.get())
             if any(x < 0 for x in [cols, rows, delay, key_right, key_down]): raise ValueError
-            self.config.update({'auto_cols': cols, 'auto_rows': rows, 'auto_delay': delay, 'key_right_presses': key_right, 'key_down_presses': key_down})
+            if not (0 < pan_over_h < 100 and 0 < pan_over_v < 100): raise ValueError
+            self.config.update({'auto_cols': cols, 'auto_rows': rows, 'auto_delay': delay, 'key_right_presses': key_right, 'key_down_presses': key_down, 'tile_format': self.tile_format_var.get(), 'capture_container': self.container_var.get(),
+                                'pan_method': self.pan_method_var.get(), 'pan_overlap_h_pct': pan_over_h, 'pan_overlap_v_pct': pan_over_v})
         except ValueError:
             messagebox.showerror("Err", "Value Error"); return
         
@@ -493,6 +591,7 @@ class Application(ttk.Frame):
         ES_DISPLAY_REQUIRED = 0x00000002
         is_sleep_prevented = False
         final_status = self.t('status_wait')
+        panner = None
 
         try:
             ctypes.windll.kernel32.SetThreadExecutionState(ES_CONTINUOUS | ES_SYSTEM_REQUIRED | ES_DISPLAY_REQUIRED)
@@ -501,8 +600,8 @@ class Application(ttk.Frame):
             cfg = self.config
             cols, rows = cfg['auto_cols'], cfg['auto_rows']
             delay = cfg['auto_delay']
-            key_right, key_down = cfg['key_right_presses'], cfg['key_down_presses']
-            KEY_INTERVAL = 0.5
+            # 移動方式 (キー連打 / ドラッグ) は panning モジュールで切り替える
+            panner = panning.create_panner(cfg)
             
             for i in range(5, 0, -1):
                 if not self.automation_running: raise InterruptedError
@@ -510,14 +609,17 @@ class Application(ttk.Frame):
                 time.sleep(1)
 
             self._update_status_label(self.t('status_check'))
-            for key, presses in [('right', key_right), ('left', key_right)]:
+            for key in ['right', 'left']:
                 if not self.automation_running: raise InterruptedError
-                pyautogui.press(key, presses=presses, interval=KEY_INTERVAL)
+                panner.pan(key)
                 time.sleep(0.5)
             time.sleep(1.0)
 
             total = rows * cols
             cur = 0
+            prev_frame, last_dir = None, None
+            # パンしても画面が動かなければ、同じ画面を撮り続ける前に一時停止 (または中断) する
+            motion = panning.MotionCheck() if cfg.get('stuck_check', True) else None
             
             for r in range(1, rows + 1):
                 for c_step in range(cols):
@@ -529,18 +631,27 @@ class Application(ttk.Frame):
                     
                     if not self.take_screenshot(is_auto=True, row=r, col=c):
                         raise RuntimeError("Shot Err")
+                    if motion:
+                        self._check_motion(motion, lambda d=last_dir: panner.pan(d), r, c, panned=bool(last_dir))
+
+                    # 直前の移動で実際に動いた距離を測り、次の移動量を補正する
+                    if prev_frame is not None and last_dir:
+                        panner.observe(prev_frame, self.last_frame, last_dir)
+                    prev_frame, last_dir = self.last_frame, None
 
                     time.sleep(delay)
 
                     if c_step < cols - 1:
                         k = 'right' if r % 2 == 1 else 'left'
-                        pyautogui.press(k, presses=key_right, interval=KEY_INTERVAL)
+                        panner.pan(k)
+                        last_dir = k
                         time.sleep(0.5)
 
                 if r < rows:
                     if not self.automation_running: raise InterruptedError
                     self._update_status_label(self.t('status_move'))
-                    pyautogui.press('down', presses=key_down, interval=KEY_INTERVAL)
+                    panner.pan('down')
+                    last_dir = 'down'
                     time.sleep(1.0)
                     if r % 5 == 0: gc.collect()
             
@@ -549,15 +660,140 @@ class Application(ttk.Frame):
         
         except InterruptedError:
             final_status = "Stop"
+        except panning.PanStuckError as e:
+            final_status = str(e).splitlines()[0]
         except Exception as e:
             final_status = "Err"
             print(e)
         finally:
             if is_sleep_prevented:
                 ctypes.windll.kernel32.SetThreadExecutionState(ES_CONTINUOUS)
+            self._save_pan_calibration(panner)
             self.automation_running = False
             self.master.after(0, self._finalize_automation_ui, final_status)
 
+    def start_retake(self):
+        """結合ツールが出力した撮り直しリスト (*_retake.json) の位置だけを撮影し直す"""
+        if self.automation_running: return
+        path = filedialog.askopenfilename(initialdir=self.config['save_folder'], filetypes=[("Retake list", "*.json")])
+        if not path: return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                retake = json.load(f)
+            targets = sorted({(int(t['r']), int(t['c'])) for t in retake.get('tiles', [])},
+                             key=lambda k: (k[0], k[1] if k[0] % 2 == 1 else -k[1]))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            messagebox.showerror(self.t('msg_err'), str(e)); return
+        if not targets:
+            messagebox.showinfo(self.t('msg_done'), self.t('msg_retake_empty')); return
+        if not messagebox.askokcancel(self.t('btn_retake'), self.t('msg_retake_start')): return
+
+        self.automation_running = True
+        self.auto_run_button.config(state="disabled")
+        self.auto_stop_button.config(state="normal")
+        threading.Thread(target=self.retake_thread, args=(targets,), daemon=True).start()
+
+    def _pan_to(self, panner, cur, target):
+        """R/C位置 cur から target まで、パン方式の1ステップ単位で移動する"""
+        dr, dc = target[0] - cur[0], target[1] - cur[1]
+        if dr: panner.pan('down' if dr > 0 else 'up', steps=abs(dr))
+        if dc: panner.pan('right' if dc > 0 else 'left', steps=abs(dc))
+
+    def _save_pan_calibration(self, panner):
+        """測定したドラッグ倍率を設定に残し、撮り直しや次回の撮影で使う"""
+        calibration = panner.calibration() if panner is not None else None
+        if calibration:
+            self.config['pan_gain'] = calibration
+
+    def retake_thread(self, targets):
+        # 撮影開始時と同じく、ブラウザが R1_C1 の位置を表示している状態から始める (start_retake で確認済み)。
+        # 倍率は前回の撮影で測った値 (config['pan_gain']) から始め、隣の位置への移動のたびに測り直す
+        final_status = self.t('status_wait')
+        panner = None
+        try:
+            panner = panning.create_panner(self.config)
+            for i in range(5, 0, -1):
+                if not self.automation_running: raise InterruptedError
+                self._update_status_label(f"{self.t('status_start')} {i}s...")
+                time.sleep(1)
+
+            cur = (1, 1)
+            prev_frame = None
+            motion = panning.MotionCheck() if self.config.get('stuck_check', True) else None
+            for n, (r, c) in enumerate(targets, 1):
+                if not self.automation_running: raise InterruptedError
+                self._update_status_label(f"{self.t('status_retake')} R{r}-C{c} ({n}/{len(targets)})")
+                prev = cur
+                self._pan_to(panner, cur, (r, c))
+                cur = (r, c)
+                time.sleep(self.config['auto_delay'])
+                if not self.take_screenshot(is_auto=True, row=r, col=c):
+                    raise RuntimeError("Shot Err")
+                if motion:
+                    # 再試行では、移動が効かなかったものとして同じ移動をやり直す
+                    self._check_motion(motion, lambda p=prev, t=(r, c): self._pan_to(panner, p, t), r, c, panned=prev != (r, c))
+                # 隣の位置への1ステップの移動なら、直前の撮影とのズレを測って倍率を補正する
+                # (複数ステップの移動は途中のフレームが無いので測れない)
+                step = (r - prev[0], c - prev[1])
+                if prev_frame is not None and abs(step[0]) + abs(step[1]) == 1:
+                    direction = {(1, 0): 'down', (-1, 0): 'up', (0, 1): 'right', (0, -1): 'left'}[step]
+                    panner.observe(prev_frame, self.last_frame, direction)
+                prev_frame = self.last_frame
+            final_status = self.t('msg_done')
+        except InterruptedError:
+            final_status = "Stop"
+        except panning.PanStuckError as e:
+            final_status = str(e).splitlines()[0]
+        except Exception as e:
+            final_status = "Err"
+            print(e)
+        finally:
+            self._save_pan_calibration(panner)
+            self.automation_running = False
+            self.master.after(0, self._finalize_automation_ui, final_status)
+
+    def _check_motion(self, motion, redo_pan, r, c, panned=True):
+        """撮影したフレームが直前のフレームから動いているか確かめる
+
+        動いていなければ stuck_action に従い、一時停止して再試行 (redo_pan でパンをやり直して撮り直す) するか、
+        PanStuckError で中断する。pause では「キャンセル」を選ぶと中断する。
+        """
+        while True:
+            problem = motion.check(self.last_frame, panned=panned)
+            if problem is None:
+                return
+            msg = self.t('msg_stuck' if problem == 'stuck' else 'msg_duplicate').format(r=r, c=c)
+            self._update_status_label(msg.splitlines()[0])
+            if self.config.get('stuck_action', 'pause') == 'abort' or \
+                    not self._ask_on_ui_thread(messagebox.askretrycancel, self.t('msg_err'), msg):
+                raise panning.PanStuckError(msg)
+            if not self.automation_running: raise InterruptedError
+            redo_pan()
+            time.sleep(self.config['auto_delay'])
+            if not self.take_screenshot(is_auto=True, row=r, col=c):
+                raise RuntimeError("Shot Err")
+
+    def _ask_on_ui_thread(self, ask, *args):
+        """撮影スレッドから Tk のダイアログ (ask) を出し、答えを待つ
+
+        Tk はスレッドセーフでないので、ダイアログは master.after でメインスレッドに出してもらう。
+        答えを待つ間に撮影が止められた場合は False を返す。
+        """
+        answered = threading.Event()
+        answer = []
+
+        def show():
+            try:
+                answer.append(ask(*args))
+            finally:
+                answered.set()
+
+        self.master.after(0, show)
+        while not answered.wait(0.2):
+            if not self.automation_running:
+                return False
+        return bool(answer and answer[0])
+
     def _finalize_automation_ui(self, status_text):
         self.auto_status_label.config(text=status_text)
         self.auto_run_button.config(state="normal")
@@ -578,4 +814,14 @@ if __name__ == "__main__":
     config = config_manager.load_config()
     root = tk.Tk()
     app = Application(master=root, config=config)
-    app.mainloop()
\ No newline at end of file
+    if STARTUP_TIMING:
+        # 撮影画面と結合ウィンドウが表示されるまでの時間を出力して終了する
+        root.update()
+        startup_timer.mark("capture window shown")
+        app.open_stitcher_window()
+        root.update()
+        startup_timer.mark("stitcher window shown")
+        startup_timer.report()
+        root.destroy()
+    else:
+        app.mainloop()
\ No newline at end of file
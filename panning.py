@@ -0,0 +1,285 @@
+# panning.py
+# 自動撮影時の画面移動(パン)方式
+#
+# KeyPanner  : 従来通り矢印キーを複数回押して移動する
+# DragPanner : 重なり率から計算した距離を1回のマウスドラッグで移動し、
+#              直前のフレームとの実際のズレを測って次のドラッグ距離を補正する
+# MotionCheck : パンの後のフレームが直前のフレームから動いたか (同じ画面を撮り続けていないか) を安く判定する
+# SimulatedViewport : 大きな画像上を動く仮想ビューポート。GUIやブラウザなしで動作確認するためのもの
+#
+# 撮影画面の起動時に読み込まれるため、cv2 / numpy はズレの測定を行うときに読み込む。
+import time
+from collections import deque
+
+PAN_METHODS = ("keys", "drag")
+
+# 方向 -> 画面(地図)が動く向きの単位ベクトル
+_DIRECTIONS = {"right": (1, 0), "left": (-1, 0), "down": (0, 1), "up": (0, -1)}
+
+
+def _to_gray(frame):
+    import cv2
+    return frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def _overlap_crops(a, b, ex, ey):
+    """前フレーム a を (ex, ey) だけ動かしたときに新フレーム b と重なる部分を切り出す"""
+    h, w = a.shape[:2]
+    ca = a[max(ey, 0):h + min(ey, 0), max(ex, 0):w + min(ex, 0)]
+    cb = b[max(-ey, 0):h + min(-ey, 0), max(-ex, 0):w + min(-ex, 0)]
+    return ca, cb
+
+
+def measure_shift(prev_frame, frame, direction, coarse_scale=0.5):
+    """2フレーム間のビューポートの移動量 (dx, dy) を測る
+
+    1. 縮小したフレーム全体の位相相関でおおよその移動量を求める。位相相関は画像サイズで
+       折り返すため、パンの向き (direction) から正しい候補を選ぶ。
+    2. その移動量だけずらした重なり部分同士で位相相関を取り直し、サブピクセルで補正する。
+    戻り値は (dx, dy, score)。score は重なり部分の正規化相関 (-1〜1)。
+    """
+    import cv2
+    import numpy as np
+    a, b = _to_gray(prev_frame), _to_gray(frame)
+    h, w = a.shape[:2]
+    ux, uy = _DIRECTIONS[direction]
+
+    sa = np.float32(cv2.resize(a, None, fx=coarse_scale, fy=coarse_scale, interpolation=cv2.INTER_AREA))
+    sb = np.float32(cv2.resize(b, None, fx=coarse_scale, fy=coarse_scale, interpolation=cv2.INTER_AREA))
+    sh, sw = sa.shape[:2]
+    window = cv2.createHanningWindow((sw, sh), cv2.CV_32F)
+    (sx, sy), _ = cv2.phaseCorrelate(sa, sb, window)
+    # 中身が左にずれる = 画面が右に動いた、なので符号を反転する
+    cx, cy = -sx, -sy
+    if ux:
+        cx = cx % sw if ux > 0 else cx % sw - sw
+        cy = (cy + sh / 2) % sh - sh / 2
+    else:
+        cy = cy % sh if uy > 0 else cy % sh - sh
+        cx = (cx + sw / 2) % sw - sw / 2
+    ex = int(round(min(max(cx / coarse_scale, -w + 16), w - 16)))
+    ey = int(round(min(max(cy / coarse_scale, -h + 16), h - 16)))
+
+    ca, cb = _overlap_crops(a, b, ex, ey)
+    window = cv2.createHanningWindow((ca.shape[1], ca.shape[0]), cv2.CV_32F)
+    (rx, ry), _ = cv2.phaseCorrelate(np.float32(ca), np.float32(cb), window)
+    if abs(rx) > 2 / coarse_scale or abs(ry) > 2 / coarse_scale:
+        rx, ry = 0.0, 0.0  # 粗い推定の誤差範囲を超える補正は信用しない
+    dx, dy = ex - rx, ey - ry
+
+    ca, cb = _overlap_crops(a, b, int(round(dx)), int(round(dy)))
+    score = float(cv2.matchTemplate(ca, cb, cv2.TM_CCOEFF_NORMED)[0, 0]) if ca.size and ca.shape == cb.shape else 0.0
+    return dx, dy, score
+
+
+class KeyPanner:
+    def __init__(self, key_right, key_down, press_fn, interval=0.5):
+        self.key_right = key_right
+        self.key_down = key_down
+        self.press_fn = press_fn
+        self.interval = interval
+
+    def pan(self, direction, steps=1):
+        presses = (self.key_right if direction in ("right", "left") else self.key_down) * steps
+        if presses > 0:
+            self.press_fn(direction, presses=presses, interval=self.interval)
+
+    def observe(self, prev_frame, frame, direction):
+        """キー移動では補正しない (移動量はキー回数で決まる)"""
+        return None
+
+    def calibration(self):
+        return None
+
+
+class DragPanner:
+    def __init__(self, region, overlap_h_pct, overlap_v_pct, drag_fn, duration=0.3, min_score=0.5, calibration=None):
+        x, y, w, h = region
+        self.region = (x, y, w, h)
+        # 1回の移動で画面が動くべき距離 (px)
+        self.step_x = w * (1 - overlap_h_pct / 100.0)
+        self.step_y = h * (1 - overlap_v_pct / 100.0)
+        self.drag_fn = drag_fn
+        self.duration = duration
+        self.min_score = min_score
+        # ドラッグ距離1pxあたりの実際の移動量 (ブラウザの拡大率やスクロールの慣性で1からずれる)
+        self.gain_x = 1.0
+        self.gain_y = 1.0
+        self.measured_x = False
+        self.measured_y = False
+        # 前回の撮影で測った倍率 (calibration() の値) があれば、それから始める (撮り直しで最初から正しい距離を動かすため)
+        if calibration:
+            if calibration.get("gain_x"):
+                self.gain_x, self.measured_x = float(calibration["gain_x"]), True
+            if calibration.get("gain_y"):
+                self.gain_y, self.measured_y = float(calibration["gain_y"]), True
+        # 目標位置からの累積誤差 (次のドラッグで1度だけ打ち消す)
+        self.error_x = 0.0
+        self.error_y = 0.0
+        self.last_drag = None
+
+    def _target(self, direction, steps):
+        ux, uy = _DIRECTIONS[direction]
+        return ux * self.step_x * steps, uy * self.step_y * steps
+
+    def pan(self, direction, steps=1):
+        # 1回のドラッグは1ステップまで (撮影範囲からはみ出さないように分割する)
+        for _ in range(steps - 1):
+            self._drag_one(direction)
+            self.last_drag = None  # 途中のフレームは無いので補正しない
+        self._drag_one(direction)
+
+    def _drag_one(self, direction):
+        steps = 1
+        tx, ty = self._target(direction, steps)
+        # 前回までの誤差を加味して、今回画面を動かすべき距離。
+        # 加えた誤差はこのドラッグで使い切る (測定しないドラッグが続いても同じ補正を重ねない)
+        want_x = tx + self.error_x if tx else 0.0
+        want_y = ty + self.error_y if ty else 0.0
+        if tx:
+            self.error_x = 0.0
+        if ty:
+            self.error_y = 0.0
+        drag_x = want_x / self.gain_x
+        drag_y = want_y / self.gain_y
+
+        # 地図を右へ動かす = マウスを左へドラッグする。移動方向の反対側の端から始める
+        x, y, w, h = self.region
+        cx, cy = x + w / 2.0, y + h / 2.0
+        start = (cx + drag_x / 2.0, cy + drag_y / 2.0)
+        end = (start[0] - drag_x, start[1] - drag_y)
+        self.drag_fn(start, end, self.duration)
+        self.last_drag = (direction, steps, drag_x, drag_y, want_x, want_y)
+
+    def observe(self, prev_frame, frame, direction):
+        """直前の移動で実際に動いた距離を測り、倍率と累積誤差を更新する"""
+        if self.last_drag is None or self.last_drag[0] != direction:
+            return None
+        _, steps, drag_x, drag_y, want_x, want_y = self.last_drag
+        dx, dy, score = measure_shift(prev_frame, frame, direction)
+        self.last_drag = None
+        if score < self.min_score:
+            return None  # 測定できない (平坦な画面など) 場合は補正しない
+        # 最初の測定はそのまま採用し、以降は平滑化する
+        if abs(drag_x) > 1 and 0.25 < dx / drag_x < 4:
+            self.gain_x = 0.5 * self.gain_x + 0.5 * (dx / drag_x) if self.measured_x else dx / drag_x
+            self.error_x = want_x - dx
+            self.measured_x = True
+        if abs(drag_y) > 1 and 0.25 < dy / drag_y < 4:
+            self.gain_y = 0.5 * self.gain_y + 0.5 * (dy / drag_y) if self.measured_y else dy / drag_y
+            self.error_y = want_y - dy
+            self.measured_y = True
+        return dx, dy
+
+    def calibration(self):
+        """測定済みの倍率 (設定の pan_gain に保存して次回に使う)。1度も測っていなければ None"""
+        if not (self.measured_x or self.measured_y):
+            return None
+        return {"gain_x": self.gain_x if self.measured_x else None, "gain_y": self.gain_y if self.measured_y else None}
+
+
+class PanStuckError(RuntimeError):
+    """パンしても画面が動かない (または以前と同じ画面になった) ため、自動撮影を中断した"""
+
+
+class MotionCheck:
+    """パンの後のフレームを直前のフレームと比べ、画面が動いたかを判定する
+
+    フレームを size x size のグレースケールに縮小し (1枚あたり1ms程度)、平均絶対差が min_diff 未満なら同じ画面とみなす。
+      "stuck"     : 直前のフレームと同じ (ブラウザのフォーカスが外れた、地図の端に着いた等でパンが効いていない)
+      "duplicate" : 直前ではないが、最近 (history 枚以内) のフレームと同じ (行き来している)
+    模様の少ない画面 (海や無地の背景) は動いても同じに見えるため、縮小画像の標準偏差が min_texture 未満なら判定しない。
+    """
+
+    def __init__(self, size=32, min_diff=1.5, min_texture=4.0, history=4):
+        self.size = size
+        self.min_diff = min_diff
+        self.min_texture = min_texture
+        self.recent = deque(maxlen=history)
+
+    def _thumb(self, frame):
+        import cv2
+        import numpy as np
+        return np.float32(cv2.resize(_to_gray(frame), (self.size, self.size), interpolation=cv2.INTER_AREA))
+
+    def check(self, frame, panned=True):
+        """戻り値: None (問題なし) / "stuck" / "duplicate"。問題のあったフレームは比較対象に残さない
+
+        panned: 直前のフレームから移動したはずか (行の最初の撮影など、移動していない場合は False)
+        """
+        import numpy as np
+        thumb = self._thumb(frame)
+        problem = None
+        if panned and self.recent and thumb.std() >= self.min_texture:
+            diffs = [float(np.mean(np.abs(thumb - old))) for old in self.recent]
+            if diffs[-1] < self.min_diff:
+                problem = "stuck"
+            elif min(diffs) < self.min_diff:
+                problem = "duplicate"
+        if problem is None:
+            self.recent.append(thumb)
+        return problem
+
+
+def _pyautogui_drag(start, end, duration):
+    import pyautogui
+    pyautogui.moveTo(int(round(start[0])), int(round(start[1])))
+    pyautogui.mouseDown()
+    pyautogui.moveTo(int(round(end[0])), int(round(end[1])), duration=duration)
+    # 慣性スクロールを防ぐため、止めてから離す
+    time.sleep(0.1)
+    pyautogui.mouseUp()
+
+
+def _pyautogui_press(key, presses=1, interval=0.5):
+    import pyautogui
+    pyautogui.press(key, presses=presses, interval=interval)
+
+
+def create_panner(config, press_fn=None, drag_fn=None):
+    """設定 (pan_method 等) からパン方式のオブジェクトを作る"""
+    method = config.get("pan_method", "keys")
+    if method == "drag":
+        return DragPanner(config["region"],
+                          config.get("pan_overlap_h_pct", 60), config.get("pan_overlap_v_pct", 40),
+                          drag_fn or _pyautogui_drag, duration=config.get("drag_duration", 0.3),
+                          calibration=config.get("pan_gain"))
+    if method == "keys":
+        return KeyPanner(config.get("key_right_presses", 5), config.get("key_down_presses", 5), press_fn or _pyautogui_press)
+    raise ValueError(f"未対応の移動方式です: {method}")
+
+
+class SimulatedViewport:
+    """大きな画像上を移動する仮想ビューポート
+
+    drag() / press() をパン方式に渡し、screenshot() でフレームを得る。
+    gain でドラッグ量と実移動量のずれ、key_step でキー1回あたりの移動量を再現する。
+    """
+
+    def __init__(self, world, width, height, x=0, y=0, gain=1.0, key_step=40):
+        self.world = world
+        self.width = width
+        self.height = height
+        self.x = float(x)
+        self.y = float(y)
+        self.gain = gain
+        self.key_step = key_step
+
+    def _clamp(self):
+        self.x = min(max(self.x, 0), self.world.shape[1] - self.width)
+        self.y = min(max(self.y, 0), self.world.shape[0] - self.height)
+
+    def drag(self, start, end, duration=0):
+        self.x -= (end[0] - start[0]) * self.gain
+        self.y -= (end[1] - start[1]) * self.gain
+        self._clamp()
+
+    def press(self, key, presses=1, interval=0):
+        ux, uy = _DIRECTIONS[key]
+        self.x += ux * self.key_step * presses
+        self.y += uy * self.key_step * presses
+        self._clamp()
+
+    def screenshot(self):
+        x, y = int(round(self.x)), int(round(self.y))
+        return self.world[y:y + self.height, x:x + self.width].copy()
@@ -0,0 +1,140 @@
+# progress_channel.py
+# 結合ワーカーから GUI / CLI への進捗通知をまとめて送るための仕組み
+#
+# AdvancedStitcher はペアごと・1%ごとに status_queue へメッセージを送るが、受け取る側が
+# 必要なのは種類ごとの最新の値だけである。ここでは
+#   CoalescingQueue : status_queue の代わりに渡すラッパー。種類ごとに最新の値だけを残し、
+#                     min_interval 秒に1回まとめて転送する
+#   ProgressChannel : GUI 用。進捗率は共有メモリの整数に書くだけでメッセージを送らない
+# を提供する。"done" / "error" / "cancelled" は溜めずに、必ずその時点で送る。
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+TERMINAL_TYPES = ("done", "error", "cancelled")
+
+
+class CoalescingQueue:
+    """put((type, value)) を受け、終了メッセージ以外は種類ごとに最新の値だけを一定間隔で q に転送する"""
+
+    def __init__(self, q, min_interval=0.1):
+        self.q = q
+        self.min_interval = min_interval
+        self._init_local()
+
+    def _init_local(self):
+        self._pending = {}
+        # 転送中のメッセージが終了メッセージより後に届かないよう、転送もロックの中で行う
+        self._lock = threading.RLock()
+        self._finished = False
+        self._flusher = None
+        self._pid = os.getpid()
+
+    # Process の引数として子プロセスへ渡せるよう、ロックとスレッドは引き継がない
+    def __getstate__(self):
+        return {"q": self.q, "min_interval": self.min_interval}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def _forward(self, mtype, value):
+        self.q.put((mtype, value))
+
+    def put(self, item):
+        mtype, value = item
+        if mtype in TERMINAL_TYPES:
+            with self._lock:
+                self.flush()
+                self._finished = True
+                self._forward(mtype, value)
+            return
+        if self._finished:
+            self._forward(mtype, value)
+            return
+        with self._lock:
+            # 同じ種類は最新の値で置き換え、送る順序は最後に更新された順にする
+            self._pending.pop(mtype, None)
+            self._pending[mtype] = value
+        if self._flusher is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def flush(self):
+        with self._lock:
+            items, self._pending = list(self._pending.items()), {}
+            for mtype, value in items:
+                self._forward(mtype, value)
+
+    def _flush_loop(self):
+        # 長い処理の直前に送られたメッセージも min_interval 以内に届くよう、別スレッドで定期的に送る
+        while not self._finished:
+            time.sleep(self.min_interval)
+            self.flush()
+
+
+class ProgressSender(CoalescingQueue):
+    """ProgressChannel の送信側。進捗率は共有メモリに書き、それ以外は CoalescingQueue と同じ"""
+
+    def __init__(self, progress, q, min_interval=0.1):
+        self.progress = progress
+        super().__init__(q, min_interval)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["progress"] = self.progress
+        return state
+
+    def put(self, item):
+        if item[0] == "progress":
+            self.progress.value = int(item[1])
+            return
+        super().put(item)
+
+
+class ProgressChannel:
+    """GUI 側で作り、sender をワーカープロセスに status_queue として渡す
+
+    poll() は前回から変わった進捗率と、種類ごとの最新メッセージ、終了メッセージの順で返す。
+    """
+
+    def __init__(self, min_interval=0.1):
+        self._progress = multiprocessing.Value("i", -1, lock=False)
+        self._queue = multiprocessing.Queue()
+        self._last_progress = -1
+        self.sender = ProgressSender(self._progress, self._queue, min_interval)
+
+    def reset(self):
+        """新しいジョブを始める前に、前回の残りを捨てる"""
+        self._progress.value = -1
+        self._last_progress = -1
+        self.sender = ProgressSender(self._progress, self._queue, self.sender.min_interval)
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def poll(self):
+        latest, terminal = {}, None
+        try:
+            while terminal is None:
+                mtype, value = self._queue.get_nowait()
+                if mtype in TERMINAL_TYPES:
+                    terminal = (mtype, value)
+                else:
+                    latest.pop(mtype, None)
+                    latest[mtype] = value
+        except queue.Empty:
+            pass
+        messages = list(latest.items())
+        progress = self._progress.value
+        if progress >= 0 and progress != self._last_progress:
+            self._last_progress = progress
+            messages.insert(0, ("progress", progress))
+        if terminal:
+            messages.append(terminal)
+        return messages
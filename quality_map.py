@@ -0,0 +1,149 @@
+# quality_map.py
+# タイルごとの品質を1枚の画像にまとめた「品質マップ」(matplotlib を使わず NumPy/cv2 だけで描く)
+#
+# グリッドの1タイルを cell x cell px の1マスとして、グリッドと同じ並びで描く。
+#   マスの色        : 最適化後の残差 (そのタイルを含むペアのオフセットと最適化後の座標の差の最大値)。
+#                     緑 (0px) -> 黄 -> 赤 (residual_max px 以上)。ペアが1つも無いタイルは灰色、タイルが無い位置は黒
+#   マスの下端の帯  : そのタイルを含むペアの最小スコア (暗いほど低い)
+#   マスの中央の点  : そのタイルを含むペアに ORB で求めたものがある (テンプレートマッチングだけなら点なし)
+#   マスの境界の線  : 採用しなかったペア (マゼンタ)
+# 描画はタイル数の配列に対する演算と拡大だけなので、10万タイルのグリッドでも短時間で描ける。
+import cv2
+import numpy as np
+
+MISSING_COLOR = (0, 0, 0)
+NO_PAIR_COLOR = (128, 128, 128)
+FAILED_COLOR = (255, 0, 255)
+ORB_COLOR = (255, 96, 0)
+
+
+def build_tile_quality(rows, cols, positions, pairwise_matches, failed_pairs):
+    """タイルごとの残差・最小スコア・ORB の有無を (行数, 列数) の配列で返す
+
+    戻り値: {"present", "residual", "score", "orb", "failed_h", "failed_v"}
+      failed_h[r, c] : (r, c) と右隣のペアを採用しなかった / failed_v[r, c] : (r, c) と下隣
+    """
+    row_idx = {r: i for i, r in enumerate(rows)}
+    col_idx = {c: i for i, c in enumerate(cols)}
+    shape = (len(rows), len(cols))
+    row_order, col_order = np.argsort(rows), np.argsort(cols)
+    rows_arr, cols_arr = np.asarray(rows)[row_order], np.asarray(cols)[col_order]
+
+    def grid_index(keys):
+        """キー (行, 列) の配列をグリッド上の番号にする。グリッドに無いものは -1"""
+        keys = np.array(keys).reshape(-1, 2)
+        ri = np.clip(np.searchsorted(rows_arr, keys[:, 0]), 0, len(rows) - 1)
+        ci = np.clip(np.searchsorted(cols_arr, keys[:, 1]), 0, len(cols) - 1)
+        ok = (rows_arr[ri] == keys[:, 0]) & (cols_arr[ci] == keys[:, 1])
+        return np.where(ok, row_order[ri], -1), np.where(ok, col_order[ci], -1)
+
+    # タイルの座標をグリッドの配列にしておき、ペアの両端の座標は配列から引く
+    present = np.zeros(shape, dtype=bool)
+    grid_pos = np.full(shape + (2,), np.nan)
+    if positions:
+        ri, ci = grid_index(list(positions))
+        ok = ri >= 0
+        present[ri[ok], ci[ok]] = True
+        grid_pos[ri[ok], ci[ok]] = np.array(list(positions.values()), dtype=float).reshape(-1, 2)[ok]
+
+    # ペアの値を、左/上のタイルの位置に方向ごとに置く (隣接ペアだけなので、タイルごとの集計は4方向のずらし合わせで済む)
+    # 列: 残差, スコア, ORB か。NaN はペアが無い
+    edge = {"h": np.full(shape + (3,), np.nan), "v": np.full(shape + (3,), np.nan)}
+    if pairwise_matches:
+        matches = list(pairwise_matches.values())
+        ra, ca = grid_index([a for a, _ in pairwise_matches])
+        rb, cb = grid_index([b for _, b in pairwise_matches])
+        offsets = np.array([m[0] for m in matches], dtype=float).reshape(-1, 2)
+        ok = (ra >= 0) & (rb >= 0)
+        diff = np.full((len(matches), 2), np.nan)
+        diff[ok] = grid_pos[rb[ok], cb[ok]] - grid_pos[ra[ok], ca[ok]] - offsets[ok]
+        data = np.stack([np.hypot(diff[:, 0], diff[:, 1]), [m[1] for m in matches], [m[3] > 0 for m in matches]], axis=1)
+        ok &= np.isfinite(data[:, 0])
+        for name, sel in (("h", ok & (ra == rb) & (np.abs(ca - cb) == 1)), ("v", ok & (ca == cb) & (np.abs(ra - rb) == 1))):
+            edge[name][np.minimum(ra, rb)[sel], np.minimum(ca, cb)[sel]] = data[sel]
+    # タイルごとに、右/左/下/上のペアの値を重ねる
+    h, v = edge["h"], edge["v"]
+    stack = np.full((4,) + shape + (3,), np.nan)
+    stack[0] = h
+    stack[1][:, 1:] = h[:, :-1]
+    stack[2] = v
+    stack[3][1:] = v[:-1]
+    has_pair = np.isfinite(stack[..., 0]).any(axis=0)
+    residual = np.where(has_pair, np.nanmax(np.where(np.isfinite(stack[..., 0]), stack[..., 0], -1), axis=0), -1.0)
+    score = np.nanmin(np.where(np.isfinite(stack[..., 1]), stack[..., 1], np.inf), axis=0)
+    orb = (np.nan_to_num(stack[..., 2]) > 0).any(axis=0)
+
+    failed_h = np.zeros(shape, dtype=bool)
+    failed_v = np.zeros(shape, dtype=bool)
+    for (a, b), (direction, _, _) in failed_pairs.items():
+        if a[0] not in row_idx or b[0] not in row_idx or a[1] not in col_idx or b[1] not in col_idx:
+            continue
+        ra, ca, rb, cb = row_idx[a[0]], col_idx[a[1]], row_idx[b[0]], col_idx[b[1]]
+        if ra == rb and abs(ca - cb) == 1:
+            failed_h[ra, min(ca, cb)] = True
+        elif ca == cb and abs(ra - rb) == 1:
+            failed_v[min(ra, rb), ca] = True
+    return {"present": present, "residual": residual, "score": score, "orb": orb,
+            "failed_h": failed_h, "failed_v": failed_v}
+
+
+def _residual_colors(residual, residual_max):
+    """残差を緑 -> 黄 -> 赤の BGR にする"""
+    t = np.clip(residual / float(residual_max), 0, 1)
+    colors = np.empty(residual.shape + (3,), dtype=np.uint8)
+    colors[..., 0] = 0
+    colors[..., 1] = np.round(255 * np.clip(2 - 2 * t, 0, 1))
+    colors[..., 2] = np.round(255 * np.clip(2 * t, 0, 1))
+    return colors
+
+
+def render_quality_map(quality, cell=None, residual_max=8.0, max_side=4096):
+    """build_tile_quality() の結果を BGR 画像にする。cell 省略時は長辺が max_side に収まる大きさ (4-32px)"""
+    n_rows, n_cols = quality["present"].shape
+    if cell is None:
+        cell = int(min(32, max(4, max_side // max(n_rows, n_cols, 1))))
+    present, residual = quality["present"], quality["residual"]
+
+    colors = _residual_colors(residual, residual_max)
+    colors[present & (residual < 0)] = NO_PAIR_COLOR
+    colors[~present] = MISSING_COLOR
+    # 1タイル = 1画素の画像を作ってから、最近傍で cell 倍に拡大する
+    img = cv2.resize(colors, (n_cols * cell, n_rows * cell), interpolation=cv2.INTER_NEAREST)
+    cells = img.reshape(n_rows, cell, n_cols, cell, 3)
+
+    # 下端の帯: 最小スコア (0-1) を明るさで表す
+    band = max(1, cell // 4)
+    score = quality["score"]
+    gray = np.where(np.isfinite(score) & present, np.clip(score, 0, 1) * 255, -1)
+    strip_colors = np.where((gray >= 0)[..., None], np.maximum(gray, 0).astype(np.uint8)[..., None], colors)
+    cells[:, cell - band:] = cv2.resize(strip_colors, (n_cols * cell, n_rows), interpolation=cv2.INTER_NEAREST)[:, None, :, :].reshape(n_rows, 1, n_cols, cell, 3)
+
+    # 中央の点: ORB を使ったペアがある
+    if cell >= 6:
+        d0, d1 = cell // 3, cell - cell // 3
+        dot_colors = np.where(quality["orb"][..., None], np.array(ORB_COLOR, dtype=np.uint8), colors)
+        cells[:, d0:d1, :, d0:d1] = cv2.resize(dot_colors, (n_cols * (d1 - d0), n_rows), interpolation=cv2.INTER_NEAREST).reshape(n_rows, 1, n_cols, d1 - d0, 3)
+
+    # 境界の線: 採用しなかったペア。2マスの境目の2px を塗る
+    rr, cc = np.nonzero(quality["failed_h"])
+    if rr.size:
+        ys = (rr[:, None] * cell + np.arange(cell)[None, :]).ravel()
+        for dx in (-1, 0):
+            xs = np.repeat((cc + 1) * cell + dx, cell)
+            img[ys, xs] = FAILED_COLOR
+    rr, cc = np.nonzero(quality["failed_v"])
+    if rr.size:
+        xs = (cc[:, None] * cell + np.arange(cell)[None, :]).ravel()
+        for dy in (-1, 0):
+            ys = np.repeat((rr + 1) * cell + dy, cell)
+            img[ys, xs] = FAILED_COLOR
+    return img
+
+
+def save_quality_map(out_path, rows, cols, positions, pairwise_matches, failed_pairs, **kwargs):
+    """品質マップを作って保存する。戻り値: build_tile_quality() の結果"""
+    from advanced_stitcher import imwrite_safe
+    quality = build_tile_quality(rows, cols, positions, pairwise_matches, failed_pairs)
+    if not imwrite_safe(out_path, render_quality_map(quality, **kwargs)):
+        raise ValueError(f"品質マップを保存できませんでした: {out_path}")
+    return quality
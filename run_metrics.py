@@ -0,0 +1,86 @@
+# run_metrics.py
+# 結合処理の計測 (フェーズごとの時間とカウンター) と JSON レポートの出力
+#
+# 常に有効にしておけるよう、計測はフェーズの境界での時刻取得とカウンターの加算だけにしている。
+# メモリ使用量 (RSS) もフェーズの境界でのみ取得し、OS が記録している最大値があればそれも使う。
+import json
+import os
+import platform
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def _rss_bytes():
+    """(現在の RSS, OS が記録している最大 RSS) をバイトで返す。取得できなければ 0"""
+    rss = peak = 0
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        rss = info.rss
+        peak = getattr(info, "peak_wset", 0)  # Windows
+    except Exception:
+        pass
+    if not peak:
+        try:
+            import resource
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak = maxrss if sys.platform == "darwin" else maxrss * 1024  # Linux は KB 単位
+        except Exception:
+            pass
+    return rss, peak
+
+
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+        self.phases = {}  # 名前 -> {"wall_s", "cpu_s", "calls"} (最初に実行した順)
+        self.counters = defaultdict(int)
+        self.peak_rss = 0
+        self.sample_rss()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def sample_rss(self):
+        rss, peak = _rss_bytes()
+        self.peak_rss = max(self.peak_rss, rss, peak)
+
+    @contextmanager
+    def phase(self, name):
+        """with metrics.phase("matching"): ... の区間の経過時間と CPU 時間を加算する"""
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            p = self.phases.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+            p["wall_s"] += time.perf_counter() - t0
+            p["cpu_s"] += time.process_time() - c0
+            p["calls"] += 1
+            self.sample_rss()
+
+    def to_dict(self, **extra):
+        self.sample_rss()
+        report = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_s": round(time.perf_counter() - self._t0, 4),
+            "cpu_s": round(time.process_time() - self._c0, 4),
+            "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1),
+            "phases": {k: {"wall_s": round(v["wall_s"], 4), "cpu_s": round(v["cpu_s"], 4), "calls": v["calls"]}
+                       for k, v in self.phases.items()},
+            "counters": dict(sorted(self.counters.items())),
+            "platform": {"python": platform.python_version(), "system": platform.system(), "cpus": os.cpu_count()},
+        }
+        report.update(extra)
+        return report
+
+    def save(self, path, **extra):
+        """レポートを JSON で書き出す (一時ファイル経由で置き換える)"""
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(**extra), f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp, path)
+        return path
@@ -0,0 +1,178 @@
+# shared_tile_store.py
+# 複数のワーカープロセスで、デコード済みのタイルを共有するストア (multiprocessing.shared_memory)
+#
+# ブロック分割 (block_stitcher) では各ワーカーが自分の _gray_cache を持つので、ブロックの境界の
+# タイルや、4つのペアで使う内側のタイルをワーカーごとにデコードし直してしまう。このストアは
+#   data  : 同じ大きさのスロットを並べた共有メモリ (1スロット = 1タイル)
+#   index : スロットごとの (キーのハッシュ, 状態, 参照数, 最後に使った時刻, 形, デコード中のプロセス) の小さな共有メモリ
+# をロック1つで守り、get() はスロットをそのまま指す NumPy 配列 (コピーなし) を返す。
+# あるワーカーがデコード中のタイルを別のワーカーが要求すると、デコードを待ってから同じスロットを使うので、
+# ストアに収まる限り各タイルは実行全体で1回だけデコードされる。
+# 参照数が 0 のスロットだけを、最後に使った時刻が古い順に追い出す。全て参照中なら共有せずにその場でデコードする。
+# デコードしていたワーカーが落ちた (メモリ不足で強制終了された、中断で pool.terminate() された等) 場合に
+# 待ち続けないよう、デコード中のプロセスが無くなっていればスロットを空きに戻し、
+# LOAD_TIMEOUT_S 秒待っても終わらなければ共有せずにその場でデコードする。
+import hashlib
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+EMPTY, LOADING, READY = 0, 1, 2
+# 別のワーカーのデコードを待つ上限 (秒)
+LOAD_TIMEOUT_S = 30.0
+
+_INDEX_DTYPE = np.dtype([("key", np.int64), ("state", np.int32), ("refs", np.int32), ("tick", np.int64),
+                         ("h", np.int32), ("w", np.int32), ("c", np.int32), ("pid", np.int32)])
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+def _pid_alive(pid):
+    try:
+        import psutil
+        return psutil.pid_exists(pid)
+    except ImportError:
+        pass
+    if os.name == "nt":
+        return True  # Windows の os.kill はプロセスを終了させるので使えない。タイムアウトに任せる
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedTileStore:
+    def __init__(self, data, index, lock, slot_bytes, owner=False):
+        self._data, self._index_shm, self.lock = data, index, lock
+        self.slot_bytes = slot_bytes
+        self.owner = owner
+        self.index = np.ndarray((index.size // _INDEX_DTYPE.itemsize,), dtype=_INDEX_DTYPE, buffer=index.buf)
+        self.slots = min(len(self.index), data.size // slot_bytes)
+        self.stats = {"hits": 0, "decodes": 0, "waits": 0, "evictions": 0, "unshared": 0, "reclaimed": 0}
+
+    @classmethod
+    def create(cls, slot_bytes, slots, lock=None):
+        """親プロセスでストアを作る。使い終わったら close() と unlink() を呼ぶこと"""
+        slots = max(1, int(slots))
+        data = shared_memory.SharedMemory(create=True, size=slot_bytes * slots)
+        index = shared_memory.SharedMemory(create=True, size=_INDEX_DTYPE.itemsize * slots)
+        store = cls(data, index, lock or multiprocessing.Lock(), slot_bytes, owner=True)
+        store.index[:] = 0
+        return store
+
+    def handle(self):
+        """ワーカーに渡す値 (Pool の initargs で渡す。ロックは継承でしか渡せないため)"""
+        return self._data.name, self._index_shm.name, self.lock, self.slot_bytes
+
+    @classmethod
+    def attach(cls, handle):
+        data_name, index_name, lock, slot_bytes = handle
+        return cls(shared_memory.SharedMemory(name=data_name), shared_memory.SharedMemory(name=index_name),
+                   lock, slot_bytes)
+
+    def _view(self, slot):
+        e = self.index[slot]
+        shape = (int(e["h"]), int(e["w"])) if e["c"] == 0 else (int(e["h"]), int(e["w"]), int(e["c"]))
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._data.buf, offset=slot * self.slot_bytes)
+
+    def _find(self, h):
+        hits = np.flatnonzero((self.index["key"][:self.slots] == h) & (self.index["state"][:self.slots] != EMPTY))
+        return int(hits[0]) if hits.size else None
+
+    def _victim(self):
+        free = np.flatnonzero(self.index["state"][:self.slots] == EMPTY)
+        if free.size:
+            return int(free[0])
+        idle = np.flatnonzero((self.index["state"][:self.slots] == READY) & (self.index["refs"][:self.slots] == 0))
+        if not idle.size:
+            return None
+        self.stats["evictions"] += 1
+        return int(idle[np.argmin(self.index["tick"][idle])])
+
+    def get(self, key, loader):
+        """key のタイルを返す。無ければ loader() でデコードしてストアに入れる
+
+        戻り値: (配列 or None, 共有しているか, この呼び出しでデコードしたか)
+        共有している場合は参照数を1つ増やしているので、使い終わったら release(key) を呼ぶこと。
+        """
+        h = _key_hash(key)
+        deadline = None
+        while True:
+            with self.lock:
+                slot = self._find(h)
+                if slot is not None and self.index[slot]["state"] == READY:
+                    self.index[slot]["refs"] += 1
+                    self.index[slot]["tick"] = time.monotonic_ns()
+                    self.stats["hits"] += 1
+                    return self._view(slot), True, False
+                if slot is not None and not _pid_alive(int(self.index[slot]["pid"])):
+                    # デコードしていたワーカーが落ちた。スロットを空きに戻して、このワーカーがデコードし直す
+                    self.index[slot] = (0, EMPTY, 0, 0, 0, 0, 0, 0)
+                    self.stats["reclaimed"] += 1
+                    slot = None
+                if slot is None:
+                    slot = self._victim()
+                    if slot is not None:
+                        self.index[slot] = (h, LOADING, 1, time.monotonic_ns(), 0, 0, 0, os.getpid())
+                        break
+                    waited_out = False
+                else:
+                    # 別のワーカーがデコード中
+                    deadline = deadline or time.monotonic() + LOAD_TIMEOUT_S
+                    waited_out = time.monotonic() > deadline
+            if slot is None or waited_out:
+                # 全てのスロットが参照中か、デコード中のワーカーが終わらない。共有せずにその場でデコードする
+                self.stats["unshared"] += 1
+                self.stats["decodes"] += 1
+                return loader(), False, True
+            self.stats["waits"] += 1
+            time.sleep(0.002)
+
+        self.stats["decodes"] += 1
+        try:
+            img = loader()
+        except Exception:
+            img = None
+        with self.lock:
+            if img is None or img.nbytes > self.slot_bytes or img.dtype != np.uint8:
+                self.index[slot] = (0, EMPTY, 0, 0, 0, 0, 0, 0)
+                return img, False, True
+            e = self.index[slot]
+            e["h"], e["w"] = img.shape[:2]
+            e["c"] = img.shape[2] if img.ndim == 3 else 0
+            view = self._view(slot)
+            view[...] = img
+            e["state"] = READY
+            return view, True, True
+
+    def release(self, key):
+        h = _key_hash(key)
+        with self.lock:
+            slot = self._find(h)
+            if slot is not None and self.index[slot]["refs"] > 0:
+                self.index[slot]["refs"] -= 1
+
+    def close(self):
+        # 配列のビューが残っていると共有メモリを閉じられないので、先に参照を外す
+        self.index = None
+        for shm in (self._data, self._index_shm):
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+    def unlink(self):
+        if self.owner:
+            for shm in (self._data, self._index_shm):
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,64 @@
+# startup_timer.py
+# 起動時間の計測モード (python main_app.py --startup-time)
+#
+# install() 以降の import をフックして、モジュールごとの読み込み時間を記録する。
+# 累積 (cumulative) はそのモジュールが内部で読み込んだモジュールを含む時間、
+# 自身 (self) はそれを除いた時間。mark() で「ウィンドウ表示まで」などの区切りを記録し、
+# report() で一覧を出力する。
+import builtins
+import sys
+import time
+
+_t0 = None
+_orig_import = None
+_records = {}   # モジュール名 -> [累積秒, 自身の秒]
+_stack = []     # 読み込み中のモジュールごとの、子の読み込みにかかった秒
+_marks = []     # (ラベル, 起動からの秒)
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name in sys.modules:
+        return _orig_import(name, globals, locals, fromlist, level)
+    _stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _orig_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        rec = _records.setdefault(name, [0.0, 0.0])
+        rec[0] += elapsed
+        rec[1] += elapsed - children
+
+
+def install():
+    """import の計測を始める。計測したいモジュールを読み込む前に呼ぶ"""
+    global _t0, _orig_import
+    if _orig_import is not None:
+        return
+    _t0 = time.perf_counter()
+    _orig_import = builtins.__import__
+    builtins.__import__ = _timed_import
+
+
+def is_installed():
+    return _orig_import is not None
+
+
+def mark(label):
+    """install() からの経過時間を区切りとして記録する"""
+    if _t0 is not None:
+        _marks.append((label, time.perf_counter() - _t0))
+
+
+def report(top=25, file=None):
+    file = file or sys.stdout
+    print("=== startup time ===", file=file)
+    for label, t in _marks:
+        print(f"{label:<32}{t * 1000:>10.1f} ms", file=file)
+    print(f"\n{'module':<32}{'cumulative':>12}{'self':>10}", file=file)
+    # 最上位の import (他のモジュールの中で読み込まれたものを含む) を累積時間の順に出す
+    for name, (cum, own) in sorted(_records.items(), key=lambda kv: -kv[1][0])[:top]:
+        print(f"{name:<32}{cum * 1000:>10.1f}ms{own * 1000:>8.1f}ms", file=file)
@@ -0,0 +1,150 @@
+# stitch_checkpoint.py
+# 長時間の結合処理のチェックポイント (中断・再開用)
+#
+# 作業フォルダ (config['work_dir']、省略時は一時フォルダ内に出力ファイルごとに作る) に
+# 次のファイルを書く。どれも一時ファイルに書いてから os.replace で置き換えるので、
+# 書き込み途中で落ちても前回のチェックポイントが残る。
+#   meta.json      : 入力フォルダ・設定・タイル一覧の指紋 (違えば再開しない)
+#   matches.json   : ペアマッチングの結果 (N ペアごとに更新)
+#   positions.json : 最適化後の座標
+#   block_positions.json : ブロック分割 (block_stitcher) のブロックごとの局所最適化の座標 (全体最適化の初期値)
+#   render.json    : 描画済みのタイル数 (行ごとに更新)。キャンバス本体は canvas.chunks (+ .idx)
+# 作業フォルダはユーザーが既存のフォルダ (入力・出力フォルダなど) を指定することもあるので、
+# 消すのは上のファイルだけで、フォルダは空になったときだけ削除する。
+import hashlib
+import json
+import os
+import tempfile
+
+# 結果に影響しない設定 (変えても再開できる)
+_IGNORED_KEYS = {"resume", "work_dir", "checkpoint_every", "generate_preview", "preview_path", "preview_scale",
+                 "generate_heatmap", "heatmap_path", "retake_list", "retake_path", "cache_max_items", "memory_budget_mb",
+                 "run_report", "report_path", "block_workers", "save_layout", "layout_path",
+                 "canvas_chunk_px", "shared_tile_store_mb"}
+
+
+class StitchCancelled(Exception):
+    """キャンセル要求を受けて処理を中断したときに送出する"""
+
+
+def default_work_dir(output_file):
+    digest = hashlib.sha1(os.path.abspath(output_file).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f"stitcher_work_{digest}")
+
+
+def fingerprint(input_dir, config, tile_keys):
+    relevant = {k: v for k, v in config.items() if k not in _IGNORED_KEYS}
+    payload = json.dumps({"input_dir": os.path.abspath(input_dir), "config": relevant,
+                          "tiles": sorted(list(k) for k in tile_keys)}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _key(k):
+    return list(k)
+
+
+def _pair(p):
+    return [list(p[0]), list(p[1])]
+
+
+# このモジュールが作業フォルダに書くファイル (reset/remove で消してよいのはこれだけ)
+CHECKPOINT_FILES = ("meta.json", "matches.json", "positions.json", "block_positions.json", "render.json",
+                    "canvas.chunks", "canvas.chunks.idx")
+
+
+class CheckpointStore:
+    def __init__(self, work_dir, fingerprint):
+        self.work_dir = work_dir
+        self.fingerprint = fingerprint
+        os.makedirs(work_dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def save(self, name, data):
+        tmp = self.path(name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path(name))
+
+    def load(self, name):
+        try:
+            with open(self.path(name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_valid(self):
+        """作業フォルダのチェックポイントが今回の入力・設定のものなら True"""
+        meta = self.load("meta.json")
+        return bool(meta) and meta.get("fingerprint") == self.fingerprint
+
+    def _remove_files(self):
+        for name in CHECKPOINT_FILES:
+            for f in (self.path(name), self.path(name + ".tmp")):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def reset(self):
+        """古いチェックポイントを消して、今回の指紋で作り直す"""
+        self._remove_files()
+        self.save("meta.json", {"fingerprint": self.fingerprint})
+
+    def remove(self):
+        """チェックポイントのファイルを消す。作業フォルダは他のファイルが無ければ削除する"""
+        self._remove_files()
+        try:
+            os.rmdir(self.work_dir)
+        except OSError:
+            pass
+
+    # --- matches ---
+    def save_matches(self, done, pairwise_matches, failed_pairs):
+        self.save("matches.json", {
+            "done": done,
+            "matches": [[_pair(p), [list(v[0]), v[1], v[2], v[3], v[4]]] for p, v in pairwise_matches.items()],
+            "failed": [[_pair(p), list(v)] for p, v in failed_pairs.items()],
+        })
+
+    def load_matches(self):
+        """(処理済みペア数, pairwise_matches, failed_pairs)。無ければ None"""
+        data = self.load("matches.json")
+        if not data:
+            return None
+        to_pair = lambda p: (tuple(p[0]), tuple(p[1]))
+        matches = {to_pair(p): (tuple(v[0]), v[1], v[2], v[3], v[4]) for p, v in data["matches"]}
+        failed = {to_pair(p): tuple(v) for p, v in data["failed"]}
+        return data["done"], matches, failed
+
+    # --- positions ---
+    def save_positions(self, positions):
+        # 描画順が変わらないよう、辞書の順序のままリストで保存する
+        self.save("positions.json", [[_key(k), list(v)] for k, v in positions.items()])
+
+    def load_positions(self):
+        data = self.load("positions.json")
+        if data is None:
+            return None
+        return {tuple(k): tuple(v) for k, v in data}
+
+    # --- block positions ---
+    def save_block_positions(self, block_positions):
+        self.save("block_positions.json", [[[_key(k), list(v)] for k, v in positions.items()]
+                                           for positions in block_positions])
+
+    def load_block_positions(self):
+        data = self.load("block_positions.json")
+        if data is None:
+            return None
+        return [{tuple(k): tuple(v) for k, v in positions} for positions in data]
+
+    # --- render ---
+    def save_render(self, rendered, canvas_shape, origin):
+        self.save("render.json", {"rendered": rendered, "canvas_shape": list(canvas_shape), "origin": list(origin)})
+
+    def load_render(self):
+        return self.load("render.json")
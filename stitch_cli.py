@@ -0,0 +1,389 @@
+# stitch_cli.py
+# GUIを使わずに AdvancedStitcher を実行するコマンドラインツール (ヘッドレスサーバー向け)
+#
+# 使い方:
+#   python stitch_cli.py FOLDER [FOLDER ...] [--jobs N] [--memory-budget MB] [オプション]
+#   python stitch_cli.py --job-file jobs.json
+#   python stitch_cli.py --render-layout out_layout.json -o out.webp [--crop x,y,w,h] [--scale 0.5]
+#     (保存済みのレイアウトから描画だけを行う。マッチングと最適化はしない)
+#
+# 進捗は1行1件のJSONとして標準出力に出す。失敗したジョブがあれば終了コード1を返す。
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+
+import stitch_service
+from progress_channel import CoalescingQueue
+import tile_formats
+import tile_container
+
+# メモリ上限を超えたジョブに中断を要求してから、強制終了するまでの猶予 (秒)
+TERMINATE_GRACE_S = 10.0
+# 1回のループで処理するメッセージの上限と時間。メッセージが続いてもジョブの開始・回収とメモリの確認は必ず行う
+DRAIN_MAX_MESSAGES = 1000
+DRAIN_TIMEOUT_S = 0.2
+
+# AdvancedStitcher が読む設定キー: (キー, 型, 説明)
+# 型 "bool" は --xxx / --no-xxx、"range" は r_min,r_max,c_min,c_max、"color" は B,G,R
+STITCHER_OPTIONS = [
+    ("min_score_threshold", float, "マッチングの信頼度閾値 (既定 0.75)"),
+    ("initial_pos_weight", float, "格子維持の重み (既定 0.01)"),
+    ("overlap_h_pct", int, "横の重なり率 %% (既定 60)"),
+    ("overlap_v_pct", int, "縦の重なり率 %% (既定 40)"),
+    ("stitch_range", "range", "部分結合の範囲 r_min,r_max,c_min,c_max"),
+    ("range_halo", int, "部分結合で範囲の外側もマッチングに使う行/列の数 (既定 1)"),
+    ("orb_guide_radius", int, "ORB の対応付けで予測位置から探す半径 px (既定 48、0 で総当たり)"),
+    ("v_template_width_pct", float, "縦方向のテンプレートの幅 (タイル幅に対する%%, 既定 50)"),
+    ("v_max_drift_px", int, "縦方向のペアで測れる左右のずれの最大値 px (既定 64)"),
+    ("auto_calibrate", "bool", "一部のペアから重なり率・ずれの幅・信頼度閾値を推定して使う"),
+    ("calibration_pairs", int, "キャリブレーションで調べるペアの数 (横/縦それぞれ, 既定 12)"),
+    ("adaptive_pairs", "bool", "全域木と標本のペアだけをマッチングし、予測と合わない場所だけ全ペアをマッチング"),
+    ("adaptive_sample_pct", float, "全域木以外のペアから確かめる標本の割合 %% (既定 20)"),
+    ("adaptive_tolerance_px", float, "標本の予測とのずれの許容値 px (既定 4)"),
+    ("nfeatures", int, "ORB特徴点の最大数 (既定 2000)"),
+    ("lsqr_iter", int, "最適化の反復回数上限 (既定 200)"),
+    ("cache_max_items", int, "画像キャッシュの最大枚数 (既定 128)"),
+    ("canvas_chunk_px", int, "描画用キャンバスのチャンクの大きさ px (既定 1024)"),
+    ("memory_budget_mb", int, "メモリ上限 MB。画像キャッシュの枚数をこれに合わせて制限する"),
+    ("sentinel_color", "color", "memmap用の番兵色 B,G,R"),
+    ("blend", "bool", "境界のフェザーブレンド"),
+    ("blend_width", int, "ブレンド幅 px (既定 64)"),
+    ("generate_preview", "bool", "低解像度プレビューを生成"),
+    ("preview_path", str, "プレビューの出力先"),
+    ("preview_scale", float, "プレビューの縮小率 (既定 0.25)"),
+    ("generate_heatmap", "bool", "タイルの品質マップ (残差・スコア・ORB・不採用ペア) を生成"),
+    ("heatmap_path", str, "品質マップの出力先 (既定: <出力>_quality.png)"),
+    ("retake_list", "bool", "撮り直しリストを出力 (既定 有効)"),
+    ("retake_path", str, "撮り直しリストの出力先"),
+    ("resume", "bool", "前回中断した処理のチェックポイントから再開"),
+    ("checkpoint_every", int, "マッチング結果を保存する間隔 (ペア数、既定 50)"),
+    ("work_dir", str, "チェックポイントとキャンバスの作業フォルダ"),
+    ("block_workers", int, "ブロックに分けて並列に処理するプロセス数 (既定 0 = 分けない)"),
+    ("rows_per_block", int, "ブロックの行数 (既定 10)"),
+    ("cols_per_block", int, "ブロックの列数 (既定 0 = 列方向に分けない)"),
+    ("block_overlap", int, "隣のブロックと共有する行/列の数 (既定 1)"),
+    ("shared_tile_store_mb", int, "ブロックのワーカーでタイルを共有する共有メモリの大きさ MB (既定 512、0 で無効)"),
+    ("save_layout", "bool", "最適化後の配置を <出力>_layout.json に保存 (既定 有効)"),
+    ("layout_path", str, "レイアウトの出力先"),
+    ("run_report", "bool", "フェーズごとの時間とカウンターを JSON で出力 (既定 有効)"),
+    ("report_path", str, "実行レポートの出力先 (既定 <出力>_report.json)"),
+]
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+
+
+def _parse_range(text):
+    vals = [int(v) for v in text.split(",")]
+    if len(vals) != 4:
+        raise argparse.ArgumentTypeError("範囲は r_min,r_max,c_min,c_max の形式で指定してください。")
+    return dict(zip(("r_min", "r_max", "c_min", "c_max"), vals))
+
+
+def _parse_crop(text):
+    vals = [int(v) for v in text.split(",")]
+    if len(vals) != 4:
+        raise argparse.ArgumentTypeError("切り出し範囲は x,y,w,h の形式で指定してください。")
+    return vals
+
+
+def _parse_color(text):
+    vals = [int(v) for v in text.split(",")]
+    if len(vals) != 3:
+        raise argparse.ArgumentTypeError("色は B,G,R の形式で指定してください。")
+    return vals
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="AdvancedStitcher のコマンドライン実行 (複数フォルダのバッチ処理)")
+    parser.add_argument("inputs", nargs="*", help="入力フォルダ (Rxx_Cxx 形式のタイル)")
+    parser.add_argument("--job-file", help="ジョブファイル (.json: [{input_dir, output_file, config}], それ以外: 1行1フォルダ)")
+    parser.add_argument("-o", "--output", help="出力ファイル (入力フォルダが1つの場合のみ)")
+    parser.add_argument("--output-dir", help="出力先フォルダ (省略時は入力フォルダの隣に <名前>_stitched.png)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="同時に実行するジョブ数")
+    parser.add_argument("--memory-budget", type=int, default=0, help="1ジョブあたりのメモリ上限 MB (0 は無制限)")
+    parser.add_argument("--config", help="設定のJSONファイル (コマンドラインの指定が優先)")
+    parser.add_argument("--force", action="store_true", help="出力が最新でも再実行する")
+    parser.add_argument("--service", action="store_true", help="常駐の結合サービス (stitch_service.py) にジョブを投げる")
+    parser.add_argument("--progress-interval", type=float, default=0.5, help="進捗を出す最短間隔 (秒)")
+    parser.add_argument("--render-layout", metavar="LAYOUT", help="保存済みのレイアウト (<出力>_layout.json) から描画だけを行う")
+    parser.add_argument("--crop", type=_parse_crop, help="--render-layout の切り出し範囲 x,y,w,h (元の解像度のキャンバス座標)")
+    parser.add_argument("--scale", type=float, default=1.0, help="--render-layout の出力倍率 (既定 1.0)")
+
+    group = parser.add_argument_group("stitcher options")
+    for key, typ, help_text in STITCHER_OPTIONS:
+        flag = "--" + key.replace("_", "-")
+        if typ == "bool":
+            group.add_argument(flag, dest=key, action=argparse.BooleanOptionalAction, default=None, help=help_text)
+        elif typ == "range":
+            group.add_argument(flag, dest=key, type=_parse_range, default=None, help=help_text)
+        elif typ == "color":
+            group.add_argument(flag, dest=key, type=_parse_color, default=None, help=help_text)
+        else:
+            group.add_argument(flag, dest=key, type=typ, default=None, help=help_text)
+    return parser
+
+
+def default_output_path(input_dir, output_dir=None):
+    input_dir = os.path.normpath(input_dir)
+    base_name = os.path.basename(input_dir)
+    return os.path.join(output_dir or os.path.dirname(input_dir), f"{base_name}_stitched.png")
+
+
+def load_jobs(args, base_config):
+    jobs = []
+    if args.job_file:
+        if args.job_file.lower().endswith(".json"):
+            with open(args.job_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        else:
+            with open(args.job_file, "r", encoding="utf-8") as f:
+                entries = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        for e in entries:
+            if isinstance(e, str):
+                e = {"input_dir": e}
+            config = dict(base_config)
+            config.update(e.get("config", {}))
+            jobs.append({"input_dir": e["input_dir"],
+                         "output_file": e.get("output_file") or default_output_path(e["input_dir"], args.output_dir),
+                         "config": config})
+    for input_dir in args.inputs:
+        output_file = args.output if (args.output and len(args.inputs) == 1) else default_output_path(input_dir, args.output_dir)
+        jobs.append({"input_dir": input_dir, "output_file": output_file, "config": dict(base_config)})
+    return jobs
+
+
+# ----------------------- up-to-date check -----------------------
+def _config_digest(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _stamp_path(output_file):
+    return os.path.splitext(output_file)[0] + "_job.json"
+
+
+def _latest_input_mtime(input_dir):
+    latest = 0.0
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            name = entry.name
+            if tile_formats.parse_tile_filename(name) or name in (tile_container.CONTAINER_DATA, tile_container.CONTAINER_INDEX):
+                latest = max(latest, entry.stat().st_mtime)
+    return latest
+
+
+def is_up_to_date(job):
+    """出力が全入力タイルより新しく、前回と同じ設定で作られていれば True"""
+    output_file, stamp = job["output_file"], _stamp_path(job["output_file"])
+    if not (os.path.isfile(output_file) and os.path.isfile(stamp)):
+        return False
+    try:
+        with open(stamp, "r", encoding="utf-8") as f:
+            if json.load(f).get("config_digest") != _config_digest(job["config"]):
+                return False
+        return os.path.getmtime(output_file) >= _latest_input_mtime(job["input_dir"])
+    except (OSError, ValueError):
+        return False
+
+
+def write_stamp(job):
+    with open(_stamp_path(job["output_file"]), "w", encoding="utf-8") as f:
+        json.dump({"input_dir": os.path.abspath(job["input_dir"]), "config_digest": _config_digest(job["config"]),
+                   "finished": time.time()}, f, indent=2)
+
+
+# ----------------------- worker -----------------------
+class _JobQueue:
+    """AdvancedStitcher の status_queue として渡し、メッセージにジョブ番号を付けて転送する"""
+
+    def __init__(self, job_id, q):
+        self.job_id = job_id
+        self.q = q
+
+    def put(self, item):
+        self.q.put((self.job_id,) + tuple(item))
+
+
+def run_job(job_id, input_dir, output_file, config, q, cancel_event=None, progress_interval=0.5):
+    # Ctrl+C は親プロセスが受けて cancel_event で伝える (チェックポイントを書いてから止まるように)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 同じ種類のメッセージは最新の値だけを一定間隔で出す (ペアごとに JSON 行を出さない)
+    status_queue = CoalescingQueue(_JobQueue(job_id, q), progress_interval)
+    try:
+        from block_stitcher import stitcher_class_for
+        stitcher = stitcher_class_for(config)(input_dir=input_dir, output_file=output_file, status_queue=status_queue, config=config,
+                                    cancel_event=cancel_event)
+        stitcher.run()
+    except Exception as e:
+        import traceback
+        status_queue.put(("error", f"Error: {e}\n\nDetails:\n{traceback.format_exc()}"))
+
+
+def _emit(event):
+    print(json.dumps(event, ensure_ascii=False, default=str), flush=True)
+
+
+def _rss_mb(proc):
+    try:
+        import psutil
+        p = psutil.Process(proc.pid)
+        return sum(c.memory_info().rss for c in [p] + p.children(recursive=True)) / 1024 / 1024
+    except Exception:
+        return 0.0
+
+
+def run_jobs(jobs, concurrency=1, memory_budget_mb=0, force=False, use_service=False, progress_interval=0.5):
+    """ジョブを最大 concurrency 個ずつ並列実行する。失敗数を返す
+
+    use_service の場合は常駐サービスにジョブを投げる (メモリ上限の監視はサービス側では行わない)。
+    """
+    q = queue.Queue() if use_service else multiprocessing.Queue()
+    pending = list(enumerate(jobs))
+    running = {}   # job_id -> Process / ServiceJob
+    state = {}     # job_id -> "done" / "error" / "cancelled"
+    failures = 0
+    cancel_events = {}  # job_id -> multiprocessing.Event (ジョブごとに中断を要求できるように)
+    stopping = {}  # job_id -> 強制終了する時刻 (中断を要求したジョブ)
+
+    def on_interrupt(signum, frame):
+        # 実行中のジョブにはチェックポイントを書いて止まるよう伝え、未実行のジョブは取り消す
+        for ev in list(cancel_events.values()):
+            ev.set()
+        pending.clear()
+        if use_service:
+            for p in list(running.values()):
+                p.cancel()
+        _emit({"type": "cancelling", "value": sorted(running)})
+
+    previous_handler = signal.signal(signal.SIGINT, on_interrupt)
+
+    def handle(job_id, mtype, value):
+        if mtype in ("done", "error", "cancelled") and job_id not in state:
+            state[job_id] = mtype
+        _emit({"job": job_id, "input_dir": jobs[job_id]["input_dir"], "type": mtype, "value": value})
+
+    def drain(timeout, until=None):
+        """メッセージを timeout 秒まで (多くても DRAIN_MAX_MESSAGES 件) 処理する。until() が真になれば戻る"""
+        deadline = time.monotonic() + timeout
+        for _ in range(DRAIN_MAX_MESSAGES):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (until and until()):
+                return
+            try:
+                handle(*q.get(timeout=remaining))
+            except queue.Empty:
+                return
+
+    while pending or running:
+        while pending and len(running) < max(1, concurrency):
+            job_id, job = pending.pop(0)
+            if not force and is_up_to_date(job):
+                _emit({"job": job_id, "input_dir": job["input_dir"], "type": "skipped", "value": job["output_file"]})
+                continue
+            config = dict(job["config"])
+            if memory_budget_mb:
+                config.setdefault("memory_budget_mb", memory_budget_mb)
+            if use_service:
+                p = stitch_service.ServiceJob(job["input_dir"], job["output_file"], _JobQueue(job_id, q), config)
+            else:
+                cancel_events[job_id] = multiprocessing.Event()
+                p = multiprocessing.Process(target=run_job, args=(job_id, job["input_dir"], job["output_file"], config, q,
+                                                                  cancel_events[job_id], progress_interval))
+            p.start()
+            running[job_id] = p
+            _emit({"job": job_id, "input_dir": job["input_dir"], "type": "started", "value": job["output_file"]})
+
+        drain(DRAIN_TIMEOUT_S)
+
+        for job_id, p in list(running.items()):
+            if p.is_alive():
+                if job_id in stopping:
+                    if time.monotonic() < stopping[job_id]:
+                        continue
+                    # 中断要求に応じないので強制終了する (キューへの書き込み中だとキューが壊れることがあるため最後の手段)
+                    p.terminate()
+                    p.join()
+                elif memory_budget_mb and not use_service and _rss_mb(p) > memory_budget_mb:
+                    # まず中断を要求する (チェックポイントを書いて止まる)。猶予を過ぎても動いていれば強制終了する
+                    handle(job_id, "error", f"メモリ上限 ({memory_budget_mb} MB) を超えたため中断しました。")
+                    cancel_events[job_id].set()
+                    stopping[job_id] = time.monotonic() + TERMINATE_GRACE_S
+                    continue
+                else:
+                    continue
+            p.join()
+            # 終了したプロセスの残りのメッセージを回収する (他のジョブのメッセージが続いていても、このジョブの終了までは読む)
+            drain(2.0, until=lambda: job_id in state)
+            del running[job_id]
+            cancel_events.pop(job_id, None)
+            stopping.pop(job_id, None)
+            job = jobs[job_id]
+            if state.get(job_id) == "done" and p.exitcode == 0:
+                write_stamp(job)
+                _emit({"job": job_id, "input_dir": job["input_dir"], "type": "finished", "value": job["output_file"]})
+            else:
+                failures += 1
+                _emit({"job": job_id, "input_dir": job["input_dir"], "type": "failed",
+                       "value": {"exitcode": p.exitcode, "state": state.get(job_id)}})
+    signal.signal(signal.SIGINT, previous_handler)
+    return failures
+
+
+def render_only(args, parser):
+    if not args.output:
+        parser.error("--render-layout には -o/--output で出力ファイルを指定してください。")
+    import stitch_layout
+
+    class _Events:
+        def put(self, item):
+            _emit({"type": item[0], "value": item[1]})
+
+    try:
+        stitch_layout.render_layout(args.render_layout, args.output, crop=args.crop, scale=args.scale,
+                                    status_queue=CoalescingQueue(_Events(), args.progress_interval))
+    except Exception as e:
+        _emit({"type": "error", "value": str(e)})
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    base_config = {}
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            base_config.update(json.load(f))
+    for key, _, _ in STITCHER_OPTIONS:
+        value = getattr(args, key)
+        if value is not None:
+            base_config[key] = value
+
+    if args.render_layout:
+        return render_only(args, parser)
+
+    jobs = load_jobs(args, base_config)
+    if not jobs:
+        parser.error("入力フォルダまたは --job-file を指定してください。")
+    missing = [j["input_dir"] for j in jobs if not os.path.isdir(j["input_dir"])]
+    if missing:
+        parser.error("入力フォルダが見つかりません: " + ", ".join(missing))
+
+    if args.service and not stitch_service.ping():
+        parser.error("結合サービスに接続できません。先に python stitch_service.py serve で起動してください。")
+
+    failures = run_jobs(jobs, args.jobs, args.memory_budget, args.force, args.service, args.progress_interval)
+    _emit({"type": "summary", "value": {"jobs": len(jobs), "failed": failures}})
+    return EXIT_FAILED if failures else EXIT_OK
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# stitch_layout.py
+# 最適化後の配置 (レイアウト) の保存と、レイアウトからの再描画 (マッチング・最適化なし)
+#
+# AdvancedStitcher は最適化の後に <出力>_layout.json を書く。中身は
+#   tiles    : 描画するタイルのパス (input_dir からの相対パス) と座標 (描画順)
+#   canvas   : キャンバスの原点 (座標の最小値) と大きさ
+#   pairs    : 採用したペアのオフセットと、最適化後の座標との残差
+#   failed   : 採用しなかったペア
+#   render   : 描画の設定 (blend / blend_width)。ブレンドした結合は再描画でも同じように混ぜる
+# render_layout() はこれを読み、任意の矩形・縮小率・形式 (出力ファイルの拡張子) で描画し直す。
+# 同じ地図を用途ごとに何度も書き出すときは、重いマッチングと最適化をやり直さずに済む。
+import json
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+import tile_container
+from chunked_canvas import ChunkedCanvas, feather_weights
+
+# 2: タイルのパスを input_dir からの相対パスで持つ (1 は走査したときのパスのまま。相対パスだと実行場所で変わる)
+LAYOUT_VERSION = 2
+
+
+def default_layout_path(output_file):
+    return os.path.splitext(output_file)[0] + "_layout.json"
+
+
+def _relative_tile_path(path, input_dir):
+    """タイルのパス (コンテナの仮想パスを含む) を input_dir からの相対パスにする"""
+    if tile_container.is_container_ref(path):
+        data_path, name = path.split(tile_container.REF_SEP, 1)
+        return os.path.relpath(data_path, input_dir) + tile_container.REF_SEP + name
+    return os.path.relpath(path, input_dir)
+
+
+def resolve_tile_path(path, input_dir):
+    """レイアウトのタイルのパスを、レイアウトの input_dir を基準に絶対パスにする"""
+    return os.path.normpath(os.path.join(input_dir, path))
+
+
+def build_layout(input_dir, tile_shape, render_positions, file_map, pairwise_matches, failed_pairs, positions,
+                 blend=False, blend_width=64):
+    """レイアウトの辞書を作る。render_positions は描画するタイルの {key: (x, y)} (描画順)"""
+    h, w = tile_shape[:2]
+    min_x = min(p[0] for p in render_positions.values())
+    min_y = min(p[1] for p in render_positions.values())
+    max_x = max(p[0] + w for p in render_positions.values())
+    max_y = max(p[1] + h for p in render_positions.values())
+
+    pairs = []
+    for (a, b), (offset, score, direction, match_count, tmpl_val) in pairwise_matches.items():
+        entry = {"a": list(a), "b": list(b), "direction": direction, "offset": list(offset),
+                 "score": round(float(score), 4), "match_count": int(match_count)}
+        if a in positions and b in positions:
+            # 最適化後の座標の差とペアのオフセットのずれ (px)。大きいペアは配置と矛盾している
+            entry["residual"] = [int(positions[b][0] - positions[a][0] - offset[0]),
+                                 int(positions[b][1] - positions[a][1] - offset[1])]
+        pairs.append(entry)
+
+    return {
+        "version": LAYOUT_VERSION,
+        "input_dir": os.path.abspath(input_dir),
+        "tile_shape": list(tile_shape),
+        "canvas": {"min_x": int(min_x), "min_y": int(min_y), "width": int(max_x - min_x), "height": int(max_y - min_y)},
+        "tiles": [{"r": k[0], "c": k[1], "path": _relative_tile_path(file_map[k], input_dir), "x": int(p[0]), "y": int(p[1])}
+                  for k, p in render_positions.items() if k in file_map],
+        "pairs": pairs,
+        "failed": [{"a": list(a), "b": list(b), "direction": d, "score": round(float(s), 4), "reason": reason}
+                   for (a, b), (d, s, reason) in failed_pairs.items()],
+        "render": {"blend": bool(blend), "blend_width": int(blend_width)},
+    }
+
+
+def save_layout(path, layout):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(layout, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return path
+
+
+def load_layout(path):
+    with open(path, "r", encoding="utf-8") as f:
+        layout = json.load(f)
+    if layout.get("version") == 1:
+        # 旧形式。タイルは input_dir の直下にあるので、ファイル名 (コンテナなら tiles.dat) だけを残す
+        for t in layout["tiles"]:
+            t["path"] = os.path.basename(t["path"].replace("\\", "/"))
+        layout["version"] = LAYOUT_VERSION
+    if layout.get("version") != LAYOUT_VERSION:
+        raise ValueError(f"対応していないレイアウトファイルです: {path}")
+    return layout
+
+
+def _parse_crop(crop, canvas):
+    """crop (x, y, w, h) をキャンバス内に収める。None はキャンバス全体"""
+    cw, ch = canvas["width"], canvas["height"]
+    if not crop:
+        return 0, 0, cw, ch
+    x, y, w, h = (int(v) for v in crop)
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(cw, x + w), min(ch, y + h)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"切り出し範囲 {crop} がキャンバス ({cw}x{ch}) の外にあります。")
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def render_layout(layout, output_file, crop=None, scale=1.0, status_queue=None, memmap_threshold_mb=256):
+    """レイアウトを描画して output_file に保存する (形式は拡張子で決まる)
+
+    crop: (x, y, w, h) 元の解像度でのキャンバス内の矩形。scale: 出力の倍率
+    """
+    from advanced_stitcher import imread_safe, imwrite_safe
+
+    def update(mtype, value):
+        if status_queue:
+            status_queue.put((mtype, value))
+
+    if isinstance(layout, str):
+        layout = load_layout(layout)
+    canvas = layout["canvas"]
+    cx, cy, cw, ch = _parse_crop(crop, canvas)
+    scale = float(scale)
+    out_w, out_h = max(1, int(round(cw * scale))), max(1, int(round(ch * scale)))
+
+    # 切り出し範囲に掛かるタイルだけを読み込む
+    th, tw = layout["tile_shape"][:2]
+    tiles = []
+    for t in layout["tiles"]:
+        x, y = t["x"] - canvas["min_x"] - cx, t["y"] - canvas["min_y"] - cy
+        if x < cw and y < ch and x + tw > 0 and y + th > 0:
+            tiles.append((t, x, y))
+    if not tiles:
+        raise ValueError("切り出し範囲に描画対象のタイルがありません。")
+
+    # ブレンドは元の結合と同じ設定で行う (ブレンド幅は出力の倍率に合わせる)。
+    # 重みの合計は結合時と同じく、ディスク上のチャンクのキャンバス (uint16 の重み) に持ち、最後に出力へ写す
+    render_opts = layout.get("render", {})
+    blend = bool(render_opts.get("blend", False))
+    blend_width = max(1, int(round(render_opts.get("blend_width", 64) * scale)))
+    feather_cache = {}
+
+    mmap_file = None
+    if out_w * out_h * 3 > memmap_threshold_mb * 1024 * 1024:
+        fd, mmap_file = tempfile.mkstemp(prefix="stitcher_render_", suffix=".mmap")
+        os.close(fd)
+        out = np.memmap(mmap_file, dtype=np.uint8, mode="w+", shape=(out_h, out_w, 3))
+    else:
+        out = np.empty((out_h, out_w, 3), dtype=np.uint8)
+    blended = None
+    if blend:
+        fd, blend_file = tempfile.mkstemp(prefix="stitcher_blend_", suffix=".chunks")
+        os.close(fd)
+        blended = ChunkedCanvas(blend_file, out_h, out_w, background=255, weighted=True)
+    try:
+        out[:] = 255
+        update("status", f"レイアウトから描画中 ({len(tiles)}枚, {out_w}x{out_h})...")
+        last_progress = -1
+        for i, (t, x, y) in enumerate(tiles):
+            tile_path = resolve_tile_path(t["path"], layout["input_dir"])
+            img = imread_safe(tile_path, cv2.IMREAD_UNCHANGED)
+            if img is None:
+                # 抜けたタイルを背景色のまま「完了」にしないよう、ここで止める
+                raise ValueError(f"タイルを読み込めませんでした (R{t['r']:02d}_C{t['c']:02d}): {tile_path}")
+            if img.ndim == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            # 縮小後の座標は、タイルの両端をそれぞれ丸めて求める (隣のタイルとの間に隙間ができないように)
+            x0, y0 = int(round(x * scale)), int(round(y * scale))
+            x1, y1 = int(round((x + img.shape[1]) * scale)), int(round((y + img.shape[0]) * scale))
+            if x1 <= x0 or y1 <= y0:
+                continue
+            if scale != 1.0:
+                img = cv2.resize(img, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+            sx0, sy0 = max(0, -x0), max(0, -y0)
+            dx0, dy0 = max(0, x0), max(0, y0)
+            dx1, dy1 = min(out_w, x1), min(out_h, y1)
+            if dx1 <= dx0 or dy1 <= dy0:
+                continue
+            src = img[sy0:sy0 + (dy1 - dy0), sx0:sx0 + (dx1 - dx0)]
+            dest = out[dy0:dy1, dx0:dx1]
+            if blended is not None:
+                if img.shape[:2] not in feather_cache:
+                    feather_cache[img.shape[:2]] = feather_weights(img.shape[0], img.shape[1], blend_width)
+                weight = feather_cache[img.shape[:2]][sy0:sy0 + (dy1 - dy0), sx0:sx0 + (dx1 - dx0)]
+                if src.shape[2] == 4:
+                    weight = np.where(src[:, :, 3] > 0, weight, 0).astype(np.uint8)
+                blended.paste(dy0, dx0, np.ascontiguousarray(src[:, :, :3]), weight=weight)
+            elif src.shape[2] == 4:
+                visible = src[:, :, 3] > 0
+                dest[visible] = src[:, :, :3][visible]
+            else:
+                dest[:] = src
+
+            progress = int((i + 1) / len(tiles) * 100)
+            if progress > last_progress:
+                update("progress", progress)
+                last_progress = progress
+
+        if blended is not None:
+            # チャンクの高さごとに出力へ写す (出力全体の大きさの一時配列は作らない)
+            for y0 in range(0, out_h, blended.chunk):
+                y1 = min(out_h, y0 + blended.chunk)
+                out[y0:y1] = blended.read(y0, y1, 0, out_w)
+
+        update("status", "画像をファイルに保存中...")
+        ext = os.path.splitext(output_file)[1].lower()
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1] if ext == ".png" else None
+        if not imwrite_safe(output_file, out, params):
+            raise ValueError(f"画像を保存できませんでした (形式 {ext} に対応していない可能性があります): {output_file}")
+        update("done", f"レイアウトから描画しました: {output_file}")
+        return output_file
+    finally:
+        del out
+        if blended is not None:
+            blended.remove()
+        if mmap_file:
+            try:
+                os.remove(mmap_file)
+            except OSError:
+                pass
@@ -0,0 +1,399 @@
+# stitch_service.py
+# 常駐型のローカル結合サービス
+#
+# 起動時にワーカープロセスをあらかじめ立ち上げ、cv2/scipy などのインポート、ORB検出器、
+# タイルのキャッシュをジョブ間で使い回す。短い部分結合 (stitch_range) のように
+# 起動コストが処理時間を上回るジョブを素早く処理するためのもの。
+#
+# GUI (StitcherApp) や CLI (stitch_cli.py --service) からジョブを投げると、
+# 進捗は status_queue と同じ (type, value) 形式のメッセージで同じ接続に返ってくる。
+#
+# 起動: python stitch_service.py serve --workers 2
+# 停止: python stitch_service.py stop
+import argparse
+import itertools
+import multiprocessing
+import os
+import secrets
+import sys
+import threading
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+
+DEFAULT_ADDRESS = ("127.0.0.1", 47631)
+# 接続の認証鍵。接続では pickle を送受信するので、鍵を知っているプロセスはサービス内でコードを実行できる。
+# そのため固定の鍵は使わず、初回起動時に乱数で作ってユーザーだけが読めるファイル (0600) に保存する。
+# 環境変数 STITCH_SERVICE_KEY があればそちらを使う。
+AUTHKEY_ENV = "STITCH_SERVICE_KEY"
+AUTHKEY_FILE = os.path.join(os.path.expanduser("~"), ".map_screenshot_stitcher", "service.key")
+# 1ワーカーがキャッシュを保持しておく入力フォルダの数
+WARM_DIRS_PER_WORKER = 2
+
+
+def load_authkey(create=False, path=AUTHKEY_FILE):
+    """認証鍵を返す。鍵ファイルが無ければ create=True のときだけ作り、それ以外は None"""
+    env = os.environ.get(AUTHKEY_ENV)
+    if env:
+        return env.encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            key = f.read().strip()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+    if not create:
+        return None
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    key = secrets.token_hex(32).encode("ascii")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, key)
+    finally:
+        os.close(fd)
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, path)
+    return key
+
+
+# ----------------------- worker process -----------------------
+def _input_signature(input_dir):
+    """フォルダ内のタイルの更新状況。変わっていればキャッシュを捨てる"""
+    import tile_formats
+    import tile_container
+    latest, count = 0.0, 0
+    with os.scandir(input_dir) as it:
+        for entry in it:
+            if tile_formats.parse_tile_filename(entry.name) or entry.name == tile_container.CONTAINER_INDEX:
+                latest = max(latest, entry.stat().st_mtime)
+                count += 1
+    return latest, count
+
+
+class _WarmState:
+    """ワーカープロセス内でジョブ間に保持する資源"""
+
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        self.detectors = {}
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+        self.caches = OrderedDict()  # input_dir -> (signature, gray_cache, rgb_cache)
+
+    def resources_for(self, input_dir, config):
+        nfeatures = config.get("nfeatures", 2000)
+        if nfeatures not in self.detectors:
+            self.detectors[nfeatures] = self.cv2.ORB_create(nfeatures=nfeatures)
+
+        key = os.path.normcase(os.path.abspath(input_dir))
+        signature = _input_signature(input_dir)
+        cached = self.caches.get(key)
+        if cached is None or cached[0] != signature:
+            cached = (signature, OrderedDict(), OrderedDict())
+        self.caches[key] = cached
+        self.caches.move_to_end(key)
+        while len(self.caches) > WARM_DIRS_PER_WORKER:
+            self.caches.popitem(last=False)
+        return {"detector": self.detectors[nfeatures], "matcher": self.matcher,
+                "gray_cache": cached[1], "rgb_cache": cached[2]}
+
+
+class _EventQueue:
+    """AdvancedStitcher の status_queue として渡し、ジョブ番号付きでサービスへ送る"""
+
+    def __init__(self, job_id, q):
+        self.job_id = job_id
+        self.q = q
+
+    def put(self, item):
+        self.q.put((self.job_id,) + tuple(item))
+
+
+def _worker_main(worker_idx, job_q, event_q, cancel_event):
+    # 重いモジュールはジョブを待つ前に読み込んでおく
+    from block_stitcher import stitcher_class_for
+    from progress_channel import CoalescingQueue
+    import scipy.sparse.linalg  # noqa: F401
+    warm = _WarmState()
+    while True:
+        job = job_q.get()
+        if job is None:
+            break
+        job_id, input_dir, output_file, config = job
+        cancel_event.clear()
+        event_q.put((job_id, "_started", worker_idx))
+        status_queue = CoalescingQueue(_EventQueue(job_id, event_q))
+        try:
+            stitcher = stitcher_class_for(config)(input_dir, output_file, status_queue, config,
+                                        resources=warm.resources_for(input_dir, config), cancel_event=cancel_event)
+            stitcher.run()
+        except Exception as e:
+            import traceback
+            status_queue.put(("error", f"Error: {e}\n\nDetails:\n{traceback.format_exc()}"))
+        # ジョブの終わりを知らせる (done/error を送らずに終わった場合の保険)
+        event_q.put((job_id, "_finished", None))
+
+
+# ----------------------- service -----------------------
+class StitchService:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, workers=2):
+        self.address = address
+        self.authkey = authkey or load_authkey(create=True)
+        self.job_q = multiprocessing.Queue()
+        self.event_q = multiprocessing.Queue()
+        # ワーカーごとの中断要求。ワーカーはジョブを始めるたびにクリアする
+        self.cancel_events = [multiprocessing.Event() for _ in range(max(1, workers))]
+        self.workers = [multiprocessing.Process(target=_worker_main, args=(i, self.job_q, self.event_q, ev), daemon=True)
+                        for i, ev in enumerate(self.cancel_events)]
+        self._job_ids = itertools.count(1)
+        self._clients = {}  # job_id -> (conn, lock)
+        self._clients_lock = threading.Lock()
+        self._running = {}  # job_id -> worker_idx
+        self._cancel_pending = set()  # まだワーカーに渡っていないジョブへの中断要求
+        self._stopping = False
+        self._dispatcher = threading.Thread(target=self._dispatch_events, daemon=True)
+        self.listener = None
+
+    def _send(self, job_id, message):
+        with self._clients_lock:
+            client = self._clients.get(job_id)
+        if client is None:
+            return
+        conn, lock = client
+        try:
+            with lock:
+                conn.send(message)
+        except (OSError, EOFError):
+            self._drop(job_id)
+
+    def _drop(self, job_id):
+        with self._clients_lock:
+            self._clients.pop(job_id, None)
+
+    def _dispatch_events(self):
+        finished = set()
+        while True:
+            item = self.event_q.get()
+            if item is None:
+                break
+            job_id, mtype, value = item
+            if mtype == "_started":
+                with self._clients_lock:
+                    self._running[job_id] = value
+                    if job_id in self._cancel_pending:
+                        self._cancel_pending.discard(job_id)
+                        self.cancel_events[value].set()
+                continue
+            if mtype == "_finished":
+                if job_id not in finished:
+                    self._send(job_id, ("error", "ジョブが結果を返さずに終了しました。"))
+                finished.discard(job_id)
+                with self._clients_lock:
+                    self._running.pop(job_id, None)
+                self._drop(job_id)
+                continue
+            if mtype in ("done", "error", "cancelled"):
+                finished.add(job_id)
+            self._send(job_id, (mtype, value))
+
+    def _handle_client(self, conn):
+        lock = threading.Lock()
+        try:
+            request = conn.recv()
+            command = request[0]
+            if command == "ping":
+                conn.send(("pong", len(self.workers)))
+            elif command == "shutdown":
+                conn.send(("ok", None))
+                self.stop()
+            elif command == "submit":
+                _, input_dir, output_file, config = request
+                job_id = next(self._job_ids)
+                conn.send(("accepted", job_id))
+                with self._clients_lock:
+                    self._clients[job_id] = (conn, lock)
+                self.job_q.put((job_id, input_dir, output_file, config))
+                return  # 接続は結果を返し終わるまで開いたままにする
+            elif command == "cancel":
+                self.cancel(request[1])
+                conn.send(("ok", None))
+            else:
+                conn.send(("error", f"不明なコマンドです: {command}"))
+        except (OSError, EOFError):
+            pass
+        conn.close()
+
+    def cancel(self, job_id):
+        with self._clients_lock:
+            worker_idx = self._running.get(job_id)
+            if worker_idx is None:
+                self._cancel_pending.add(job_id)
+            else:
+                self.cancel_events[worker_idx].set()
+
+    def serve_forever(self):
+        for w in self.workers:
+            w.start()
+        self._dispatcher.start()
+        self.listener = Listener(self.address, authkey=self.authkey)
+        print(f"stitch service: {self.address[0]}:{self.address[1]} (workers={len(self.workers)})", flush=True)
+        try:
+            while not self._stopping:
+                try:
+                    conn = self.listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):
+                    if self._stopping:
+                        break
+                    continue  # 認証失敗など
+                threading.Thread(target=self._handle_client, args=(conn,), daemon=True).start()
+        finally:
+            self._shutdown_workers()
+
+    def stop(self):
+        self._stopping = True
+        # accept() を抜けさせるために自分自身へ接続する
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+
+    def _shutdown_workers(self):
+        for _ in self.workers:
+            self.job_q.put(None)
+        for w in self.workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()
+        self.event_q.put(None)
+        self._dispatcher.join(timeout=5)
+        if self.listener:
+            self.listener.close()
+
+
+# ----------------------- client -----------------------
+def ping(address=DEFAULT_ADDRESS, authkey=None):
+    """サービスが起動していれば True"""
+    authkey = authkey or load_authkey()
+    if authkey is None:
+        return False  # 鍵ファイルが無い = このユーザーはサービスを起動していない
+    try:
+        conn = Client(address, authkey=authkey)
+    except Exception:
+        return False
+    try:
+        conn.send(("ping",))
+        return conn.recv()[0] == "pong"
+    except Exception:
+        return False
+    finally:
+        conn.close()
+
+
+def shutdown(address=DEFAULT_ADDRESS, authkey=None):
+    authkey = authkey or load_authkey()
+    if authkey is None:
+        raise RuntimeError(f"認証鍵が見つかりません: {AUTHKEY_FILE}")
+    conn = Client(address, authkey=authkey)
+    try:
+        conn.send(("shutdown",))
+        conn.recv()
+    finally:
+        conn.close()
+
+
+class ServiceJob:
+    """サービスに投げたジョブ。multiprocessing.Process と同じように start/is_alive/join/terminate で扱える
+
+    受け取った進捗メッセージは status_queue にそのまま put する。
+    """
+
+    def __init__(self, input_dir, output_file, status_queue, config, address=DEFAULT_ADDRESS, authkey=None):
+        self.args = (input_dir, output_file, config)
+        self.status_queue = status_queue
+        self.address = address
+        self.authkey = authkey or load_authkey() or b""
+        self.exitcode = None
+        self.pid = None
+        self.job_id = None
+        self._conn = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            self._conn = Client(self.address, authkey=self.authkey)
+            self._conn.send(("submit",) + self.args)
+            reply = self._conn.recv()
+            if reply[0] != "accepted":
+                raise RuntimeError(str(reply[1]))
+            self.job_id = reply[1]
+            while True:
+                mtype, value = self._conn.recv()
+                self.status_queue.put((mtype, value))
+                if mtype in ("done", "error", "cancelled"):
+                    self.exitcode = 0 if mtype == "done" else 1
+                    break
+        except Exception as e:
+            if self.exitcode is None:
+                self.status_queue.put(("error", f"結合サービスとの通信に失敗しました: {e}"))
+                self.exitcode = 1
+        finally:
+            if self._conn is not None:
+                self._conn.close()
+
+    def start(self):
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def cancel(self):
+        """サービスに中断を要求する (チェックポイントを書いてから止まる)"""
+        if self.job_id is None:
+            return
+        try:
+            conn = Client(self.address, authkey=self.authkey)
+            try:
+                conn.send(("cancel", self.job_id))
+                conn.recv()
+            finally:
+                conn.close()
+        except Exception:
+            pass
+
+    def terminate(self):
+        # 接続を閉じるとサービス側は結果の送信をやめる (処理自体は最後まで行われる)
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="常駐型の結合サービス")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_serve = sub.add_parser("serve", help="サービスを起動する")
+    p_serve.add_argument("--workers", type=int, default=2)
+    for p in (p_serve, sub.add_parser("stop", help="サービスを停止する"), sub.add_parser("ping", help="起動確認")):
+        p.add_argument("--port", type=int, default=DEFAULT_ADDRESS[1])
+    args = parser.parse_args(argv)
+    address = (DEFAULT_ADDRESS[0], args.port)
+
+    if args.command == "serve":
+        StitchService(address, workers=args.workers).serve_forever()
+    elif args.command == "stop":
+        shutdown(address)
+    else:
+        alive = ping(address)
+        print("running" if alive else "not running")
+        return 0 if alive else 1
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
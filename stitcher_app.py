@@ -2,22 +2,28 @@
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import queue
 import multiprocessing
+import importlib.util
 import os
 import shutil
 import tempfile
 import sys
 import platform # OS判定用
 
-# AdvancedStitcherを動的にインポートする試み
-try:
-    from advanced_stitcher import AdvancedStitcher
-except ImportError:
+import stitch_service
+from grid_index import build_grid_index
+from progress_channel import ProgressChannel
+
+def load_stitcher_class(config=None):
+    """AdvancedStitcher (ブロック分割が有効なら BlockStitcher) を読み込んで返す。読み込めなければ None (実行時にエラーチェック)
+
+    結合エンジンは cv2 などの重いモジュールを読み込むため、ウィンドウを開いただけでは読み込まない。
+    """
     try:
-        from advanced_stitcher import AdvancedStitcher
+        from block_stitcher import stitcher_class_for
     except ImportError:
-        AdvancedStitcher = None # 実行時にエラーチェック
+        return None
+    return stitcher_class_for(config)
 
 # --- 翻訳辞書 ---
 TRANSLATIONS = {
@@ -36,9 +42,14 @@ TRANSLATIONS = {
         "lbl_over_h": "横の重なり(%):",
         "lbl_over_v": "縦の重なり(%):",
         "chk_preview": "低解像度プレビューを生成",
-        "chk_heatmap": "オフセットヒートマップを生成",
+        "chk_heatmap": "タイルの品質マップを生成",
         "lbl_dest_any": "  ← 出力先 (任意):",
+        "chk_resume": "前回中断した処理の続きから再開",
+        "chk_calibrate": "重なり率と閾値を自動で調整 (一部のペアから推定)",
+        "chk_blend": "タイルの境界をぼかして合成 (フェザーブレンド)",
         "btn_run": "結合開始",
+        "btn_cancel": "中断",
+        "status_cancelling": "中断しています (チェックポイントを保存中)...",
         "grp_status": "進捗",
         "status_ready": "準備完了",
         "status_done": "完了",
@@ -66,9 +77,14 @@ TRANSLATIONS = {
         "lbl_over_h": "Overlap H(%):",
         "lbl_over_v": "Overlap V(%):",
         "chk_preview": "Generate Low-Res Preview",
-        "chk_heatmap": "Generate Offset Heatmap",
+        "chk_heatmap": "Generate Tile Quality Map",
         "lbl_dest_any": "  ← Dest (Opt):",
+        "chk_resume": "Resume the previously interrupted run",
+        "chk_calibrate": "Auto-calibrate overlaps and threshold (from sample pairs)",
+        "chk_blend": "Feather-blend tile seams",
         "btn_run": "Start Stitching",
+        "btn_cancel": "Cancel",
+        "status_cancelling": "Cancelling (saving checkpoint)...",
         "grp_status": "Progress",
         "status_ready": "Ready",
         "status_done": "Done",
@@ -83,11 +99,12 @@ TRANSLATIONS = {
     }
 }
 
-def stitcher_worker_wrapper(input_dir, output_file, q, config):
+def stitcher_worker_wrapper(input_dir, output_file, q, config, cancel_event=None, grid_index=None):
     try:
+        AdvancedStitcher = load_stitcher_class(config)
         if AdvancedStitcher is None:
             raise ImportError("advanced_stitcher module not found.")
-        stitcher = AdvancedStitcher(input_dir=input_dir, output_file=output_file, status_queue=q, config=config)
+        stitcher = AdvancedStitcher(input_dir=input_dir, output_file=output_file, status_queue=q, config=config, cancel_event=cancel_event, grid_index=grid_index)
         stitcher.run()
     except Exception as e:
         import traceback
@@ -106,8 +123,10 @@ class StitcherApp(tk.Toplevel):
         self.geometry("600x750")
         self.transient(master); self.grab_set()
         
-        self.status_queue = multiprocessing.Queue()
+        # 進捗は種類ごとに最新の値だけをまとめて受け取る (進捗率は共有メモリ経由)
+        self.progress_channel = ProgressChannel()
         self.stitching_process = None
+        self.cancel_event = None
         
         self.setup_styles()
 
@@ -203,6 +222,11 @@ class StitcherApp(tk.Toplevel):
         self.overlap_v_var = tk.StringVar(value="40") 
         ttk.Entry(settings_frame, textvariable=self.overlap_v_var, width=8).grid(row=1, column=3, sticky="w", padx=(5, 0), pady=(5,0))
 
+        self.calibrate_var = tk.BooleanVar(value=bool(self.config.get("auto_calibrate", False)))
+        ttk.Checkbutton(settings_frame, text=self.t('chk_calibrate'), variable=self.calibrate_var).grid(row=2, column=0, columnspan=4, sticky="w", pady=(5,0))
+        self.blend_var = tk.BooleanVar(value=bool(self.config.get("blend", False)))
+        ttk.Checkbutton(settings_frame, text=self.t('chk_blend'), variable=self.blend_var).grid(row=3, column=0, columnspan=4, sticky="w", pady=(5,0))
+
         # Extra Outputs
         self.gen_preview = tk.BooleanVar(value=False); self.gen_heatmap = tk.BooleanVar(value=False)
         extras_frame = ttk.Frame(option_frame); extras_frame.pack(fill="x", pady=5)
@@ -225,9 +249,14 @@ class StitcherApp(tk.Toplevel):
         self.heatmap_path_entry.grid(row=1, column=3, sticky="ew")
         self.heatmap_path_button = ttk.Button(extras_frame, text="...", command=self.select_heatmap_path, width=3)
         self.heatmap_path_button.grid(row=1, column=4, padx=(2,0))
+
+        self.resume_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(option_frame, text=self.t('chk_resume'), variable=self.resume_var).pack(anchor="w")
     
     def _create_run_widgets(self, parent):
         run_frame = ttk.Frame(parent); run_frame.pack(fill="x", pady=(10, 5))
+        self.cancel_button = ttk.Button(run_frame, text=self.t('btn_cancel'), command=self.cancel_stitching, state="disabled")
+        self.cancel_button.pack(side="right", fill="y", padx=(5, 0))
         self.run_button = ttk.Button(run_frame, text=self.t('btn_run'), command=self.start_stitching, style="Accent.TButton")
         self.run_button.pack(fill="x", ipady=6)
     
@@ -272,7 +301,7 @@ class StitcherApp(tk.Toplevel):
         if filename: self.preview_path_var.set(filename)
 
     def select_heatmap_path(self):
-        h_name = os.path.splitext(os.path.basename(self.output_path.get()))[0] + "_heatmap.png"
+        h_name = os.path.splitext(os.path.basename(self.output_path.get()))[0] + "_quality.png"
         filename = filedialog.asksaveasfilename(initialfile=h_name, defaultextension=".png", filetypes=[("PNG", "*.png")])
         if filename: self.heatmap_path_var.set(filename)
 
@@ -294,13 +323,21 @@ class StitcherApp(tk.Toplevel):
                 raise ValueError("Overlap must be 1-100")
             stitcher_config["overlap_h_pct"] = overlap_h
             stitcher_config["overlap_v_pct"] = overlap_v
+            stitcher_config["auto_calibrate"] = self.calibrate_var.get()
 
             if self.use_range.get():
                 stitcher_config["stitch_range"] = {k: int(v.get()) for k, v in [("r_min", self.r_min_var), ("r_max", self.r_max_var), ("c_min", self.c_min_var), ("c_max", self.c_max_var)]}
+                stitcher_config["range_halo"] = int(self.config.get("range_halo", 1))
             
             stitcher_config["generate_preview"] = self.gen_preview.get()
             stitcher_config["generate_heatmap"] = self.gen_heatmap.get()
-            stitcher_config["blend"] = False
+            stitcher_config["blend"] = self.blend_var.get()
+            stitcher_config["blend_width"] = int(self.config.get("blend_width", 64))
+            stitcher_config["resume"] = self.resume_var.get()
+            # 大きなグリッドはブロックに分けて並列に処理する (block_workers が 0 なら分けない)
+            if self.config.get("block_workers"):
+                stitcher_config["block_workers"] = int(self.config["block_workers"])
+                stitcher_config["rows_per_block"] = int(self.config.get("rows_per_block", 10))
 
             p_path = self.preview_path_var.get()
             if p_path: stitcher_config["preview_path"] = p_path
@@ -310,20 +347,26 @@ class StitcherApp(tk.Toplevel):
             messagebox.showerror(self.t('status_err'), self.t('msg_val_err').format(e), parent=self)
             return
 
-        if AdvancedStitcher is None:
+        # 結合エンジン本体はワーカー側で読み込む (ここでは存在だけ確認する)
+        if importlib.util.find_spec("advanced_stitcher") is None:
             messagebox.showerror(self.t('status_err'), self.t('msg_mod_err'), parent=self)
             return
         
         try:
-            temp_stitcher = AdvancedStitcher(input_dir, output_file, None, stitcher_config)
-            temp_stitcher.verify_grid()
+            # ファイル名とPNGヘッダーだけでグリッドを検証する。作った一覧はワーカーに渡して再利用する
+            grid_index = build_grid_index(input_dir)
+            if not grid_index.file_map:
+                raise ValueError("指定されたフォルダに Rxx_Cxx 形式の画像ファイル (.png/.npy/.webp/.qoi) が見つかりません。")
+            # 部分結合では範囲とその周囲 (range_halo) だけを検証する
+            grid_index.verify(*grid_index.active_area(stitcher_config.get("stitch_range"), stitcher_config.get("range_halo", 1)))
         except Exception as e:
             messagebox.showerror(self.t('msg_grid_err'), str(e), parent=self)
             return
         
         try:
-            h, w, _ = temp_stitcher.base_image_shape
-            est_bytes = temp_stitcher.grid_info['max_r'] * temp_stitcher.grid_info['max_c'] * h * w * 1.5
+            # キャンバス (BGR 3バイト) とマスク (1バイト) の一時ファイルの大きさ
+            canvas_w, canvas_h = grid_index.estimate_canvas_size(overlap_h, overlap_v, stitcher_config.get("stitch_range"))
+            est_bytes = canvas_w * canvas_h * 4
             _, _, free = shutil.disk_usage(tempfile.gettempdir())
             free_mb = free // 1024 // 1024
             est_mb = int(est_bytes // 1024 // 1024)
@@ -331,31 +374,39 @@ class StitcherApp(tk.Toplevel):
                  if not messagebox.askyesno("Warning", self.t('msg_disk_warn').format(est_mb, free_mb), parent=self): return
         except Exception: pass
         
-        self.run_button.config(state="disabled"); self.progress['value'] = 0; self.pair_label.config(text="")
-        self.stitching_process = multiprocessing.Process(target=stitcher_worker_wrapper, args=(input_dir, output_file, self.status_queue, stitcher_config))
+        self.run_button.config(state="disabled"); self.cancel_button.config(state="normal")
+        self.progress['value'] = 0; self.pair_label.config(text="")
+        self.progress_channel.reset()
+        # 常駐サービスが起動していればそちらに投げる (起動待ちなしで結合を開始できる)
+        if self.config.get("use_stitch_service") and stitch_service.ping():
+            self.cancel_event = None
+            self.stitching_process = stitch_service.ServiceJob(input_dir, output_file, self.progress_channel.sender, stitcher_config)
+        else:
+            self.cancel_event = multiprocessing.Event()
+            self.stitching_process = multiprocessing.Process(target=stitcher_worker_wrapper, args=(input_dir, output_file, self.progress_channel.sender, stitcher_config, self.cancel_event, grid_index))
         self.stitching_process.start()
         self.check_status()
 
     def check_status(self):
-        try:
-            while True:
-                message, value = self.status_queue.get_nowait()
-                if message == "progress": self.progress['value'] = int(value)
-                elif message == "status": self.status_label.config(text=str(value))
-                elif message == "progress_pair": self.pair_label.config(text=f"{value}")
-                elif message == "done":
-                    self.progress['value'] = 100
-                    self.status_label.config(text=str(value))
-                    messagebox.showinfo(self.t('status_done'), self.t('msg_done_desc').format(value, self.output_path.get()), parent=self)
-                    self._reset_ui_after_run()
-                    return
-                elif message == "error":
-                    self.status_label.config(text=self.t('status_err'))
-                    messagebox.showerror(self.t('status_err'), str(value), parent=self)
-                    self._reset_ui_after_run()
-                    return
-        except queue.Empty:
-            pass
+        for message, value in self.progress_channel.poll():
+            if message == "progress": self.progress['value'] = int(value)
+            elif message == "status": self.status_label.config(text=str(value))
+            elif message == "progress_pair": self.pair_label.config(text=f"{value}")
+            elif message == "done":
+                self.progress['value'] = 100
+                self.status_label.config(text=str(value))
+                messagebox.showinfo(self.t('status_done'), self.t('msg_done_desc').format(value, self.output_path.get()), parent=self)
+                self._reset_ui_after_run()
+                return
+            elif message == "error":
+                self.status_label.config(text=self.t('status_err'))
+                messagebox.showerror(self.t('status_err'), str(value), parent=self)
+                self._reset_ui_after_run()
+                return
+            elif message == "cancelled":
+                self.status_label.config(text=str(value))
+                self._reset_ui_after_run()
+                return
         
         if self.stitching_process and self.stitching_process.is_alive():
             self.after(120, self.check_status)
@@ -363,13 +414,31 @@ class StitcherApp(tk.Toplevel):
             self._reset_ui_after_run()
 
     def _reset_ui_after_run(self):
-        self.run_button.config(state="normal")
+        self.run_button.config(state="normal"); self.cancel_button.config(state="disabled")
         self.stitching_process = None
+        self.cancel_event = None
+
+    def _request_cancel(self):
+        """実行中の結合処理に中断を要求する (チェックポイントを書いてから止まる)"""
+        if isinstance(self.stitching_process, stitch_service.ServiceJob):
+            self.stitching_process.cancel()
+        elif self.cancel_event is not None:
+            self.cancel_event.set()
+
+    def cancel_stitching(self):
+        if self.stitching_process and self.stitching_process.is_alive():
+            self._request_cancel()
+            self.cancel_button.config(state="disabled")
+            self.status_label.config(text=self.t('status_cancelling'))
 
     def on_closing(self):
         if self.stitching_process and self.stitching_process.is_alive():
             if messagebox.askyesno("Confirm", self.t('msg_close_warn'), parent=self):
-                self.stitching_process.terminate()
+                self._request_cancel()
+                # チェックポイントの保存を待ち、止まらなければ強制終了する
+                self.stitching_process.join(timeout=10)
+                if self.stitching_process.is_alive():
+                    self.stitching_process.terminate()
                 self.destroy()
         else:
             self.destroy()
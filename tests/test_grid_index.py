@@ -0,0 +1,32 @@
+# test_grid_index.py
+# 入力フォルダの走査 (grid_index.build_grid_index) で、同じ位置のタイルのうち新しい方が使われることを確かめる
+#
+# 実行: python -m pytest tests
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import grid_index  # noqa: E402
+import tile_container  # noqa: E402
+import tile_formats  # noqa: E402
+
+
+def test_newer_source_wins(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    tile = np.zeros((20, 30, 3), dtype=np.uint8)
+    monkeypatch.setattr(tile_container.time, "time", lambda: 1000.0)  # コンテナに書き込んだ時刻
+    with tile_container.TileContainerWriter(folder, "png") as writer:
+        writer.add(1, 1, tile)
+        writer.add(1, 2, tile)
+    # R01_C01 はコンテナより後に撮り直して個別のファイルに保存した。R01_C02 のファイルはコンテナより古い
+    for (r, c), mtime in {(1, 1): 2000.0, (1, 2): 500.0}.items():
+        path = os.path.join(folder, tile_formats.tile_filename(r, c, "png"))
+        cv2.imwrite(path, tile)
+        os.utime(path, (mtime, mtime))
+
+    index = grid_index.build_grid_index(folder)
+    assert index.file_map[(1, 1)] == os.path.join(folder, tile_formats.tile_filename(1, 1, "png"))
+    assert tile_container.is_container_ref(index.file_map[(1, 2)])
@@ -0,0 +1,104 @@
+# test_panning.py
+# panning.py のパン方式とフレームの動き判定を、SimulatedViewport と合成フレームで確かめる
+#
+# 実行: python -m pytest tests
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import panning  # noqa: E402
+
+VIEW_W, VIEW_H = 400, 300
+
+
+def make_world(width=3000, height=2000, seed=0):
+    """位相相関で測れる程度の模様を持つ、地図の代わりの大きな画像"""
+    rng = np.random.RandomState(seed)
+    world = cv2.GaussianBlur(rng.randint(0, 256, (height, width)).astype(np.uint8), (0, 0), 3)
+    world = cv2.normalize(world, None, 0, 255, cv2.NORM_MINMAX)
+    return cv2.cvtColor(world, cv2.COLOR_GRAY2BGR)
+
+
+def test_drag_gain_converges_on_misscaled_viewport():
+    # ドラッグ量の 1.6 倍動くビューポート (ブラウザの拡大率がずれている状態)
+    viewport = panning.SimulatedViewport(make_world(), VIEW_W, VIEW_H, gain=1.6)
+    panner = panning.create_panner({"pan_method": "drag", "region": [0, 0, VIEW_W, VIEW_H]}, drag_fn=viewport.drag)
+    moves = []
+    for _ in range(5):
+        prev, x0 = viewport.screenshot(), viewport.x
+        panner.pan("right")
+        panner.observe(prev, viewport.screenshot(), "right")
+        moves.append(viewport.x - x0)
+
+    assert abs(panner.gain_x - 1.6) < 0.03
+    # 最初の移動は行き過ぎるが、以降は累積誤差も打ち消して目標の距離を動く
+    assert abs(moves[0] - 1.6 * panner.step_x) < 2
+    assert abs(sum(moves) - 5 * panner.step_x) < 2
+    assert all(abs(m - panner.step_x) < 2 for m in moves[2:])
+
+
+def test_pending_error_is_applied_once():
+    # 測定しないドラッグ (複数ステップの途中や、測定できなかった移動) が続いても、誤差の補正は1度だけ
+    viewport = panning.SimulatedViewport(make_world(), VIEW_W, VIEW_H, gain=1.0)
+    panner = panning.create_panner({"pan_method": "drag", "region": [0, 0, VIEW_W, VIEW_H]}, drag_fn=viewport.drag)
+    panner.error_x = 40.0
+    panner.pan("right", steps=3)
+    assert abs(viewport.x - (3 * panner.step_x + 40)) < 1
+    x0 = viewport.x
+    panner.pan("right")
+    assert abs(viewport.x - x0 - panner.step_x) < 1
+
+
+def test_observe_measures_against_the_corrected_target():
+    # 誤差を加えたドラッグを測ると、その目標どおりに動いていれば新しい誤差は 0 になる
+    viewport = panning.SimulatedViewport(make_world(), VIEW_W, VIEW_H, gain=1.0)
+    panner = panning.create_panner({"pan_method": "drag", "region": [0, 0, VIEW_W, VIEW_H]}, drag_fn=viewport.drag)
+    panner.error_x = 20.0
+    prev = viewport.screenshot()
+    panner.pan("right")
+    panner.observe(prev, viewport.screenshot(), "right")
+    assert abs(panner.error_x) < 1
+
+
+def test_saved_calibration_is_reused():
+    viewport = panning.SimulatedViewport(make_world(), VIEW_W, VIEW_H, gain=1.6)
+    config = {"pan_method": "drag", "region": [0, 0, VIEW_W, VIEW_H], "pan_gain": {"gain_x": 1.6, "gain_y": None}}
+    panner = panning.create_panner(config, drag_fn=viewport.drag)
+    panner.pan("right", steps=3)
+    assert abs(viewport.x - 3 * panner.step_x) < 2
+    assert panner.gain_y == 1.0
+
+
+def test_stuck_at_map_edge():
+    world = make_world()
+    viewport = panning.SimulatedViewport(world, VIEW_W, VIEW_H, x=world.shape[1] - VIEW_W - 10, key_step=40)
+    motion = panning.MotionCheck()
+    assert motion.check(viewport.screenshot(), panned=False) is None
+    viewport.press("right")  # 端で止まり 10px しか動かない
+    assert motion.check(viewport.screenshot()) is None
+    viewport.press("right")  # もう動かない
+    assert motion.check(viewport.screenshot()) == "stuck"
+
+
+def test_duplicate_on_back_pan():
+    viewport = panning.SimulatedViewport(make_world(), VIEW_W, VIEW_H, x=500, y=500, key_step=200)
+    motion = panning.MotionCheck()
+    assert motion.check(viewport.screenshot(), panned=False) is None
+    viewport.press("right")
+    assert motion.check(viewport.screenshot()) is None
+    viewport.press("left")  # 1つ前の画面に戻った
+    assert motion.check(viewport.screenshot()) == "duplicate"
+
+
+def test_low_texture_frames_are_skipped():
+    # 海や無地の背景のような模様の無い画面は、動いても同じに見えるので判定しない
+    flat = np.full((2000, 3000, 3), 200, dtype=np.uint8)
+    viewport = panning.SimulatedViewport(flat, VIEW_W, VIEW_H, key_step=200)
+    motion = panning.MotionCheck()
+    assert motion.check(viewport.screenshot(), panned=False) is None
+    viewport.press("right")
+    assert motion.check(viewport.screenshot()) is None
+    assert motion.check(viewport.screenshot()) is None
@@ -0,0 +1,93 @@
+# test_stitch_layout.py
+# レイアウトの保存と、レイアウトからの再描画 (stitch_layout.render_layout) を合成タイルで確かめる
+#
+# 実行: python -m pytest tests
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import grid_index  # noqa: E402
+import stitch_layout  # noqa: E402
+import tile_formats  # noqa: E402
+
+TILE_W, TILE_H = 120, 90
+STEP_X, STEP_Y = 80, 60
+
+
+def make_world(width=400, height=300, seed=0):
+    rng = np.random.RandomState(seed)
+    world = cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3)).astype(np.uint8), (0, 0), 2)
+    return world
+
+
+def write_grid(folder, world, rows=3, cols=4, brightness=None):
+    """world を格子状に切り出して R##_C##.png を書く。brightness(r, c) を渡すとタイルごとに明るさを足す"""
+    os.makedirs(folder, exist_ok=True)
+    positions = {}
+    for r in range(1, rows + 1):
+        for c in range(1, cols + 1):
+            x, y = (c - 1) * STEP_X, (r - 1) * STEP_Y
+            tile = world[y:y + TILE_H, x:x + TILE_W]
+            if brightness:
+                tile = cv2.add(tile, np.full_like(tile, brightness(r, c)))
+            cv2.imwrite(os.path.join(folder, tile_formats.tile_filename(r, c, "png")), tile)
+            positions[(r, c)] = (x, y)
+    return positions
+
+
+def build(input_dir, positions, **kwargs):
+    index = grid_index.build_grid_index(input_dir)
+    return stitch_layout.build_layout(input_dir, (TILE_H, TILE_W, 3), positions, index.file_map, {}, {}, positions, **kwargs)
+
+
+def test_render_from_another_working_directory(tmp_path, monkeypatch):
+    world = make_world()
+    monkeypatch.chdir(tmp_path)
+    positions = write_grid("grid", world)
+    # 入力フォルダを相対パスで渡して作ったレイアウト
+    layout_path = stitch_layout.save_layout(str(tmp_path / "out_layout.json"), build("grid", positions))
+    assert all(not os.path.isabs(t["path"]) for t in stitch_layout.load_layout(layout_path)["tiles"])
+
+    other = tmp_path / "elsewhere"
+    other.mkdir()
+    monkeypatch.chdir(other)
+    out = str(tmp_path / "render.png")
+    stitch_layout.render_layout(layout_path, out)
+    rendered = cv2.imread(out)
+    h, w = 2 * STEP_Y + TILE_H, 3 * STEP_X + TILE_W
+    assert np.array_equal(rendered, world[:h, :w])
+
+
+def test_missing_tile_is_an_error(tmp_path):
+    folder = str(tmp_path / "grid")
+    positions = write_grid(folder, make_world())
+    layout = build(folder, positions)
+    os.remove(os.path.join(folder, tile_formats.tile_filename(2, 2, "png")))
+    out = str(tmp_path / "render.png")
+    with pytest.raises(ValueError, match="R02_C02"):
+        stitch_layout.render_layout(layout, out)
+    assert not os.path.exists(out)
+
+
+def test_blended_render_feathers_brightness_seams(tmp_path):
+    # 無地の地図を、偶数列だけ 40 明るく撮れたタイル (露出の違い) で描く。ブレンドしなければ境目で 40 の段差になる
+    folder = str(tmp_path / "grid")
+    flat = np.full((300, 400, 3), 100, dtype=np.uint8)
+    positions = write_grid(folder, flat, rows=1, brightness=lambda r, c: 40 if c % 2 == 0 else 0)
+    row = TILE_H // 2
+    seam = slice(STEP_X - 8, TILE_W + 8)  # 1列目と2列目の重なり (80-120px) とその前後
+
+    stitch_layout.render_layout(build(folder, positions), str(tmp_path / "hard.png"))
+    hard = cv2.imread(str(tmp_path / "hard.png"))[row, seam, 0].astype(int)
+    assert np.abs(np.diff(hard)).max() == 40
+
+    stitch_layout.render_layout(build(folder, positions, blend=True, blend_width=16), str(tmp_path / "soft.png"))
+    soft = cv2.imread(str(tmp_path / "soft.png"))[row, seam, 0].astype(int)
+    assert soft[0] == 100 and soft[-1] == 140
+    assert np.all(np.diff(soft) >= 0)
+    assert np.abs(np.diff(soft)).max() <= 8
+
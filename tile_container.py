@@ -0,0 +1,230 @@
+# tile_container.py
+# 大量のタイルを1つのデータファイル + インデックスにまとめて保存するコンテナ
+#
+# フォルダ内に次の2ファイルを作る:
+#   tiles.dat : タイルのバイト列を追記していくだけのデータファイル
+#   tiles.idx : 1行1タイルのJSONインデックス {"r", "c", "offset", "length", "shape", "format", "time"}
+# 同じ (r, c) が複数回書かれた場合 (撮り直し) は最後の行が有効になる。
+# format が "raw" のタイルは無圧縮の画素列で、読み込み時はメモリマップからコピーなしで参照する。
+# (グリッドの走査でも読み込まれるため、cv2 / numpy は使うときに読み込む)
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import tile_formats
+
+CONTAINER_DATA = "tiles.dat"
+CONTAINER_INDEX = "tiles.idx"
+REF_SEP = "::"
+
+
+def has_container(folder):
+    return os.path.isfile(os.path.join(folder, CONTAINER_INDEX))
+
+
+def is_container_ref(path):
+    return isinstance(path, str) and REF_SEP in path
+
+
+def make_ref(folder, r, c):
+    """コンテナ内のタイルを指す仮想パス (imread_safe にそのまま渡せる)"""
+    return f"{os.path.join(folder, CONTAINER_DATA)}{REF_SEP}R{r:02d}_C{c:02d}"
+
+
+def parse_ref(ref):
+    data_path, name = ref.split(REF_SEP, 1)
+    r, c = name[1:].split("_C")
+    return os.path.dirname(data_path), int(r), int(c)
+
+
+class TileContainerWriter:
+    """撮影ループからタイルを追記するためのライター"""
+
+    def __init__(self, folder, fmt="raw", png_compress_level=1):
+        if fmt != "raw" and fmt not in tile_formats.TILE_FORMATS:
+            raise ValueError(f"未対応のコンテナ形式です: {fmt}")
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.fmt = fmt
+        self.png_compress_level = png_compress_level
+        self._data = open(os.path.join(folder, CONTAINER_DATA), "ab")
+        self._index = open(os.path.join(folder, CONTAINER_INDEX), "a", encoding="utf-8")
+
+    def add(self, r, c, img):
+        import numpy as np
+        img = np.ascontiguousarray(img)
+        if self.fmt == "raw":
+            payload = img.tobytes()
+        else:
+            payload = tile_formats.encode_tile(img, self.fmt, self.png_compress_level)
+        self._data.seek(0, os.SEEK_END)
+        offset = self._data.tell()
+        self._data.write(payload)
+        self._data.flush()
+        # データを書き切ってからインデックスを追記する (途中で落ちても壊れた行を参照しない)
+        entry = {"r": int(r), "c": int(c), "offset": offset, "length": len(payload),
+                 "shape": list(img.shape), "format": self.fmt, "time": time.time()}
+        self._index.write(json.dumps(entry) + "\n")
+        self._index.flush()
+        return len(payload)
+
+    def close(self):
+        for f in (self._data, self._index):
+            try:
+                f.close()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TileContainer:
+    """コンテナの読み込み側。データファイルはメモリマップで開く"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.data_path = os.path.join(folder, CONTAINER_DATA)
+        self.index_path = os.path.join(folder, CONTAINER_INDEX)
+        self.index_size = os.path.getsize(self.index_path)
+        self.index_mtime = os.path.getmtime(self.index_path)
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        self.entries = {}
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中の最終行
+                if e["offset"] + e["length"] > data_size:
+                    continue
+                self.entries[(e["r"], e["c"])] = e
+        import numpy as np
+        self._mm = np.memmap(self.data_path, dtype=np.uint8, mode="r") if data_size else None
+
+    def keys(self):
+        return sorted(self.entries.keys())
+
+    def shape(self, r, c):
+        return tuple(self.entries[(r, c)]["shape"])
+
+    def saved_time(self, r, c):
+        """タイルを書き込んだ時刻。time を持たない古いインデックスではインデックスの更新時刻で代用する"""
+        return self.entries[(r, c)].get("time", self.index_mtime)
+
+    def read(self, r, c, flags=tile_formats.IMREAD_UNCHANGED):
+        e = self.entries.get((r, c))
+        if e is None:
+            return None
+        buf = self._mm[e["offset"]:e["offset"] + e["length"]]
+        if e["format"] == "raw":
+            img = buf.reshape(e["shape"])  # コピーなしのビュー
+            return tile_formats.convert_flags(img, flags)
+        return tile_formats.decode_tile_bytes(buf, tile_formats.tile_extension(e["format"]), flags)
+
+    def read_rows(self, r, c, n, flags=tile_formats.IMREAD_UNCHANGED):
+        """先頭 n 行だけを読む。raw はビューの切り出し、PNG は n 行目でデコードを打ち切る"""
+        e = self.entries.get((r, c))
+        if e is None:
+            return None
+        buf = self._mm[e["offset"]:e["offset"] + e["length"]]
+        if e["format"] == "raw":
+            img = buf.reshape(e["shape"])[:n]
+            return tile_formats.convert_flags(img, flags)
+        if tile_formats.tile_extension(e["format"]) == ".png":
+            img = tile_formats.decode_png_rows(io.BytesIO(buf.tobytes()), n, flags)
+            if img is not None:
+                return img
+        img = self.read(r, c, flags)
+        return None if img is None else img[:n]
+
+
+_OPEN_CONTAINERS = {}
+
+
+def open_container(folder):
+    """開いたコンテナをキャッシュして返す。追記されていれば開き直す"""
+    folder = os.path.normpath(folder)
+    cached = _OPEN_CONTAINERS.get(folder)
+    index_size = os.path.getsize(os.path.join(folder, CONTAINER_INDEX))
+    if cached is None or cached.index_size != index_size:
+        cached = TileContainer(folder)
+        _OPEN_CONTAINERS[folder] = cached
+    return cached
+
+
+def read_ref(ref, flags=tile_formats.IMREAD_UNCHANGED):
+    folder, r, c = parse_ref(ref)
+    return open_container(folder).read(r, c, flags)
+
+
+def read_ref_rows(ref, n, flags=tile_formats.IMREAD_UNCHANGED):
+    folder, r, c = parse_ref(ref)
+    return open_container(folder).read_rows(r, c, n, flags)
+
+
+# ----------------------- converters -----------------------
+def _read_tile_file(path):
+    if path.lower().endswith(".npy"):
+        return tile_formats.load_npy(path)
+    import cv2
+    import numpy as np
+    return cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def folder_to_container(src_dir, dst_dir=None, fmt="raw", png_compress_level=1):
+    """Rxx_Cxx.* のフォルダをコンテナに変換する (dst_dir 省略時は同じフォルダに作成)"""
+    dst_dir = dst_dir or src_dir
+    names = sorted(f for f in os.listdir(src_dir) if tile_formats.parse_tile_filename(f))
+    count = 0
+    with TileContainerWriter(dst_dir, fmt, png_compress_level) as writer:
+        for name in names:
+            r, c, _ = tile_formats.parse_tile_filename(name)
+            img = _read_tile_file(os.path.join(src_dir, name))
+            if img is None:
+                print(f"WARN: 読み込みに失敗したためスキップします: {name}")
+                continue
+            writer.add(r, c, img)
+            count += 1
+    return count
+
+
+def container_to_folder(src_dir, dst_dir, fmt="png", png_compress_level=1):
+    """コンテナを Rxx_Cxx.* のフォルダに展開する"""
+    os.makedirs(dst_dir, exist_ok=True)
+    container = TileContainer(src_dir)
+    for r, c in container.keys():
+        img = container.read(r, c)
+        tile_formats.write_tile(os.path.join(dst_dir, tile_formats.tile_filename(r, c, fmt)), img, fmt, png_compress_level)
+    return len(container.keys())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="タイルコンテナの作成・展開")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_pack = sub.add_parser("pack", help="フォルダ -> コンテナ")
+    p_pack.add_argument("src_dir")
+    p_pack.add_argument("dst_dir", nargs="?")
+    p_pack.add_argument("--format", default="raw", help="raw または tile_formats の形式名")
+    p_unpack = sub.add_parser("unpack", help="コンテナ -> フォルダ")
+    p_unpack.add_argument("src_dir")
+    p_unpack.add_argument("dst_dir")
+    p_unpack.add_argument("--format", default="png")
+    args = parser.parse_args(argv)
+
+    if args.command == "pack":
+        n = folder_to_container(args.src_dir, args.dst_dir, args.format)
+    else:
+        n = container_to_folder(args.src_dir, args.dst_dir, args.format)
+    print(f"{n} タイルを変換しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# tile_formats.py
+# 撮影タイルの保存形式(PNG以外の高速デコード形式を含む)を扱うモジュール
+#
+# ファイル名の組み立て・解析は撮影画面の起動時にも使うため、cv2 / numpy は
+# エンコード・デコードを行う関数の中で読み込む。
+import io
+import re
+
+# cv2.IMREAD_UNCHANGED (cv2 を読み込まずに既定値として使う)
+IMREAD_UNCHANGED = -1
+
+# 形式名 -> (拡張子, 説明)
+# png   : 従来通り (圧縮レベルは png_compress_level に従う)
+# png0  : 圧縮レベル0のPNG (inflateがほぼコピーのみになる)
+# npy   : 無圧縮のNumPy配列 (デコード不要、ディスク使用量は最大)
+# webp  : ロスレスWebP
+# qoi   : QOI (OpenCVのビルドが対応している場合のみ)
+TILE_FORMATS = {
+    "png": (".png", "PNG"),
+    "png0": (".png", "PNG (無圧縮)"),
+    "npy": (".npy", "NumPy (無圧縮)"),
+    "webp": (".webp", "WebP (ロスレス)"),
+    "qoi": (".qoi", "QOI"),
+}
+
+TILE_EXTENSIONS = (".png", ".npy", ".webp", ".qoi")
+TILE_NAME_RE = re.compile(r'^R(\d+)_C(\d+)(\.png|\.npy|\.webp|\.qoi)$', re.IGNORECASE)
+
+
+def is_format_available(fmt):
+    """指定形式がこの環境で書き込み可能かを返す"""
+    if fmt not in TILE_FORMATS:
+        return False
+    if fmt == "qoi":
+        import cv2
+        return bool(cv2.haveImageWriter("tile.qoi"))
+    return True
+
+
+def available_formats():
+    return [f for f in TILE_FORMATS if is_format_available(f)]
+
+
+def tile_extension(fmt):
+    if fmt not in TILE_FORMATS:
+        raise ValueError(f"未対応のタイル形式です: {fmt}")
+    return TILE_FORMATS[fmt][0]
+
+
+def tile_filename(r, c, fmt="png"):
+    """グリッド位置と形式からタイルのファイル名を返す (例: R01_C02.webp)"""
+    return f"R{r:02d}_C{c:02d}{tile_extension(fmt)}"
+
+
+def parse_tile_filename(name):
+    """ファイル名を (r, c, 拡張子) に分解する。タイルでなければ None"""
+    m = TILE_NAME_RE.match(name)
+    if not m:
+        return None
+    return int(m.group(1)), int(m.group(2)), m.group(3).lower()
+
+
+def encode_tile(img, fmt, png_compress_level=1):
+    """BGR(A)画像を指定形式のバイト列に変換する"""
+    import cv2
+    import numpy as np
+    if fmt == "npy":
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(img), allow_pickle=False)
+        return buf.getvalue()
+    if not is_format_available(fmt):
+        raise ValueError(f"この環境ではタイル形式 '{fmt}' を書き込めません。")
+    ext = tile_extension(fmt)
+    if fmt == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compress_level)]
+    elif fmt == "png0":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 0]
+    elif fmt == "webp":
+        # 品質100を超える値でロスレスになる
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        params = []
+    result, buf = cv2.imencode(ext, img, params)
+    if not result:
+        raise ValueError(f"タイルのエンコードに失敗しました (形式: {fmt})")
+    return buf.tobytes()
+
+
+def write_tile(filename, img, fmt, png_compress_level=1):
+    """タイルを書き込む。日本語パスでも動作するようにバイト列経由で保存する"""
+    data = encode_tile(img, fmt, png_compress_level)
+    with open(filename, mode='wb') as f:
+        f.write(data)
+    return len(data)
+
+
+def convert_flags(img, flags):
+    """cv2.imdecode と同じ意味になるように読み込みフラグを適用する"""
+    if img is None or flags == IMREAD_UNCHANGED:
+        return img
+    import cv2
+    if flags == cv2.IMREAD_GRAYSCALE:
+        if img.ndim == 2:
+            return img
+        code = cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(img, code)
+    if flags == cv2.IMREAD_COLOR:
+        if img.ndim == 2:
+            return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        if img.shape[2] == 4:
+            return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
+
+def load_npy(filename, flags=IMREAD_UNCHANGED):
+    import numpy as np
+    img = np.load(filename, allow_pickle=False)
+    return convert_flags(img, flags)
+
+
+def load_npy_rows(filename, n, flags=IMREAD_UNCHANGED):
+    """npy の先頭 n 行だけを読み込む (メモリマップで必要な行だけを読む)"""
+    import numpy as np
+    img = np.load(filename, mmap_mode="r", allow_pickle=False)
+    return convert_flags(np.array(img[:n]), flags)
+
+
+def decode_png_rows(fp, n, flags=IMREAD_UNCHANGED):
+    """PNG の先頭 n 行だけをデコードする。fp はファイルパスかファイルオブジェクト
+
+    PNG の各行は前の行を参照して復元するため、先頭からしか読めないが、n 行目で展開を打ち切れる。
+    Pillow が無い場合や、インターレース・16bit などで対応できない場合は None (呼び出し側で全体をデコードする)
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    import numpy as np
+    im = Image.open(fp)
+    if im.format != "PNG" or im.mode not in ("L", "RGB", "RGBA") or im.info.get("interlace") or len(im.tile) != 1:
+        return None
+    w, h = im.size
+    n = min(n, h)
+    tile = im.tile[0]
+    # デコードする範囲を先頭 n 行に狭める (Pillow の ImageFile は tile の範囲だけを展開する)
+    extents = (0, 0, w, n)
+    im.tile = [tile._replace(extents=extents) if hasattr(tile, "_replace") else (tile[0], extents) + tuple(tile[2:])]
+    im._size = (w, n)
+    im.load()
+    img = np.asarray(im)
+    if img.ndim == 3:
+        import cv2
+        img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA if img.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+    return convert_flags(img, flags)
+
+
+def decode_tile_bytes(data, ext, flags=IMREAD_UNCHANGED):
+    """バイト列からタイルをデコードする (拡張子で形式を判定)"""
+    import cv2
+    import numpy as np
+    if ext == ".npy":
+        img = np.load(io.BytesIO(data), allow_pickle=False)
+        return convert_flags(img, flags)
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)